@@ -0,0 +1,337 @@
+import os
+import re
+import json
+import time
+import zlib
+import shutil
+import tarfile
+import zipfile
+
+from uploads import UploadError
+
+# --- Export / Import ---
+# GET /api/export streams an archive of every character, chat (log and summary) and the
+# uploads the characters' avatars point at. It is built while it is sent: each file is
+# read and compressed a chunk at a time, so memory use doesn't grow with the data. With
+# `since`, only characters and chats changed after that time are included; the manifest
+# records `exported_at`, to be passed as `since` next time.
+#
+#   manifest.json                      {"format", "version", "exported_at", "since"}
+#   characters/<character>.json
+#   chats/<character>/<chat>.jsonl    the chat log, records as in storage.py
+#   chats/<character>/<chat>.summary
+#   uploads/<sha256>.<ext>
+#
+# POST /api/import takes such an archive (zip or tar.gz). The upload is spooled to disk,
+# then every member is checked and the chats are unpacked to a staging folder, line by
+# line. Only if the whole archive is valid are the characters and chats moved into
+# place; an imported chat or character replaces one with the same id. Applying
+# incremental exports in order brings a copy up to date; deletions are not carried over.
+
+ARCHIVE_FORMAT = "localaichat-export"
+ARCHIVE_VERSION = 1
+EXPORT_FORMATS = ('zip', 'tar')
+MANIFEST_NAME = "manifest.json"
+CHUNK_SIZE = 64 * 1024
+MAX_JSON_MEMBER = 4 * 1024 * 1024  # Characters, summaries and the manifest are read whole
+MAX_RECORD_LENGTH = 16 * 1024 * 1024  # Longest chat log line accepted on import
+
+_ID = r'[A-Za-z0-9_-]+'
+_CHARACTER_MEMBER = re.compile(rf'^characters/({_ID})\.json$')
+_CHAT_MEMBER = re.compile(rf'^chats/({_ID})/({_ID})\.(jsonl|summary)$')
+_UPLOAD_MEMBER = re.compile(r'^uploads/([0-9a-f]{64}\.[a-z]+)$')
+_UPLOAD_URL = re.compile(r'^/data/uploads/([0-9a-f]{64}\.[a-z]+)$')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+# --- Export ---
+
+class _Sink:
+    """A write-only file the archive writers write into; the export drains it as it goes."""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class _ZipWriter:
+    mimetype = 'application/zip'
+    extension = 'zip'
+
+    def __init__(self):
+        self._sink = _Sink()
+        # An unseekable target makes zipfile write sizes after the data (data descriptors)
+        self._zip = zipfile.ZipFile(self._sink, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, name, mtime, size, chunks):
+        info = zipfile.ZipInfo(name, date_time=time.localtime(mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with self._zip.open(info, 'w', force_zip64=size > 0x7fffffff) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield self._sink.drain()
+        yield self._sink.drain()
+
+    def close(self):
+        self._zip.close()
+        return self._sink.drain()
+
+
+class _TarWriter:
+    """A gzipped tar written header by header, since tarfile wants to write whole files."""
+    mimetype = 'application/gzip'
+    extension = 'tar.gz'
+
+    def __init__(self):
+        self._gzip = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def add(self, name, mtime, size, chunks):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        yield self._gzip.compress(info.tobuf(tarfile.PAX_FORMAT))
+        for chunk in chunks:
+            yield self._gzip.compress(chunk)
+        yield self._gzip.compress(b"\0" * (-size % tarfile.BLOCKSIZE))
+
+    def close(self):
+        return self._gzip.compress(b"\0" * (2 * tarfile.BLOCKSIZE)) + self._gzip.flush()
+
+
+def _read_chunks(f, size):
+    """Yields exactly size bytes from f, then closes it."""
+    try:
+        while size > 0:
+            chunk = f.read(min(CHUNK_SIZE, size))
+            if not chunk:
+                raise ArchiveError(f"{f.name} got shorter while it was exported")
+            size -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _json_member(data):
+    return json.dumps(data, ensure_ascii=False, indent=4).encode('utf-8')
+
+
+def export_archive(fmt, chat_store, characters, upload_store, since=None):
+    """Returns (mimetype, file name, generator of archive bytes)."""
+    writer = _ZipWriter() if fmt == 'zip' else _TarWriter()
+    exported_at = time.time()
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(exported_at))
+    filename = f"localaichat-{'incremental' if since else 'export'}-{stamp}.{writer.extension}"
+
+    def generate():
+        chat_store.flush_all()
+        manifest = _json_member({"format": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION,
+                                 "exported_at": exported_at, "since": since})
+        yield from writer.add(MANIFEST_NAME, exported_at, len(manifest), [manifest])
+
+        uploads = set()
+        for character in characters.list()[0]:
+            mtime = characters.modified(character['id'])
+            if mtime is None or (since and mtime <= since):
+                continue
+            data = _json_member(character)
+            yield from writer.add(f"characters/{character['id']}.json", mtime, len(data), [data])
+            match = _UPLOAD_URL.match(character.get('avatar_url') or "")
+            if match:
+                uploads.add(match.group(1))
+
+        for character_id in sorted(os.listdir(chat_store.chats_dir)):
+            if not re.fullmatch(_ID, character_id) or not os.path.isdir(os.path.join(chat_store.chats_dir, character_id)):
+                continue
+            for chat_id in sorted(chat_store.list_chat_ids(character_id)):
+                if not re.fullmatch(_ID, chat_id):
+                    continue
+                snapshot = chat_store.open_chat_snapshot(character_id, chat_id)
+                if snapshot is None:
+                    continue
+                f, size, mtime = snapshot
+                if since and mtime <= since:
+                    f.close()
+                    continue
+                yield from writer.add(f"chats/{character_id}/{chat_id}.jsonl", mtime, size, _read_chunks(f, size))
+                summary = chat_store.read_summary(character_id, chat_id)
+                if summary is not None:
+                    data = _json_member(summary)
+                    yield from writer.add(f"chats/{character_id}/{chat_id}.summary", mtime, len(data), [data])
+
+        for name in sorted(uploads):
+            path = os.path.join(upload_store.directory, name)
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            st = os.fstat(f.fileno())
+            yield from writer.add(f"uploads/{name}", st.st_mtime, st.st_size, _read_chunks(f, st.st_size))
+
+        yield writer.close()
+
+    return writer.mimetype, filename, generate()
+
+
+# --- Import ---
+
+def _members(path):
+    """Yields (name, open file) for every regular file in a zip or tar archive, in order."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as f:
+                        yield info.filename, f
+        return
+    try:
+        archive = tarfile.open(path, 'r:*')
+    except tarfile.TarError:
+        raise ArchiveError("Not a zip or tar archive")
+    with archive:
+        for info in archive:
+            if info.isdir():
+                continue
+            if not info.isfile():
+                raise ArchiveError(f"{info.name} is not a regular file")
+            yield info.name, archive.extractfile(info)
+
+
+def _read_json(name, f):
+    data = f.read(MAX_JSON_MEMBER + 1)
+    if len(data) > MAX_JSON_MEMBER:
+        raise ArchiveError(f"{name} is too large")
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        raise ArchiveError(f"{name} is not valid JSON: {e}")
+
+
+def _check_record(line):
+    record = json.loads(line)
+    op = record.get('op') if isinstance(record, dict) else None
+    if op not in ('add', 'set', 'del'):
+        raise ValueError("unknown record")
+    if op != 'add' and (not isinstance(record.get('index'), int) or isinstance(record['index'], bool)):
+        raise ValueError("record without an index")
+    if op != 'del':
+        message = record.get('msg')
+        if not isinstance(message, dict) or not isinstance(message.get('role'), str) or not isinstance(message.get('content'), str):
+            raise ValueError("record without a valid message")
+
+
+def _stage_chat(name, f, staged_path, budget):
+    """Copies a chat log to staged_path, checking every record. Returns the bytes written."""
+    written = 0
+    with open(staged_path, 'wb') as out:
+        for number, line in enumerate(iter(lambda: f.readline(MAX_RECORD_LENGTH + 1), b""), 1):
+            if len(line) > MAX_RECORD_LENGTH:
+                raise ArchiveError(f"{name}: record {number} is too long")
+            if line.strip():
+                try:
+                    _check_record(line)
+                except (ValueError, AttributeError) as e:
+                    raise ArchiveError(f"{name}: record {number} is invalid ({e})")
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            written += len(line)
+            if written > budget:
+                raise ArchiveError("The archive unpacks to more than the import size limit")
+            out.write(line)
+    return written
+
+
+def import_archive(path, chat_store, characters, upload_store, staging_dir, max_unpacked):
+    """Checks and applies an archive. Returns counts of what was imported.
+
+    Raises ArchiveError, changing nothing but possibly adding uploads, if any part of it is invalid.
+    """
+    os.makedirs(staging_dir)
+    try:
+        imported_characters = []
+        chats = {}  # (character_id, chat_id) -> {'log': staged path, 'summary': data}
+        uploads = 0
+        staged = 0  # Chat logs staged so far; names their staging files
+        unpacked = 0
+        seen_manifest = False
+        for name, f in _members(path):
+            if not seen_manifest:
+                manifest = _read_json(name, f) if name == MANIFEST_NAME else None
+                if not isinstance(manifest, dict) or manifest.get('format') != ARCHIVE_FORMAT:
+                    raise ArchiveError(f"Not an export archive: it must start with {MANIFEST_NAME}")
+                if manifest.get('version') != ARCHIVE_VERSION:
+                    raise ArchiveError(f"Unsupported archive version {manifest.get('version')}")
+                seen_manifest = True
+                continue
+
+            match = _CHARACTER_MEMBER.match(name)
+            if match:
+                character = _read_json(name, f)
+                if not isinstance(character, dict) or character.get('id') != match.group(1) \
+                        or not isinstance(character.get('name'), str) or not isinstance(character.get('description'), str):
+                    raise ArchiveError(f"{name} is not a valid character")
+                imported_characters.append(character)
+                continue
+
+            match = _CHAT_MEMBER.match(name)
+            if match:
+                character_id, chat_id, kind = match.groups()
+                chat = chats.setdefault((character_id, chat_id), {'log': None, 'summary': None})
+                if kind == 'summary':
+                    summary = _read_json(name, f)
+                    if not isinstance(summary, dict) or not isinstance(summary.get('end'), int) or not isinstance(summary.get('summary'), str):
+                        raise ArchiveError(f"{name} is not a valid summary")
+                    chat['summary'] = summary
+                else:
+                    staged += 1
+                    chat['log'] = os.path.join(staging_dir, f"{staged}.jsonl")
+                    unpacked += _stage_chat(name, f, chat['log'], max_unpacked - unpacked)
+                continue
+
+            match = _UPLOAD_MEMBER.match(name)
+            if match:
+                # Content-addressed, so storing it before the rest is checked can't overwrite anything
+                try:
+                    upload_store.save(f, expected_name=match.group(1))
+                except UploadError as e:
+                    raise ArchiveError(f"{name}: {e}")
+                uploads += 1
+                continue
+
+            raise ArchiveError(f"Unexpected file in archive: {name}")
+
+        if not seen_manifest:
+            raise ArchiveError("The archive is empty")
+        for (character_id, chat_id), chat in chats.items():
+            if chat['log'] is None:
+                raise ArchiveError(f"chats/{character_id}/{chat_id}.summary has no chat log")
+
+        for character in imported_characters:
+            characters.save(character)
+            os.makedirs(os.path.join(chat_store.chats_dir, character['id']), exist_ok=True)
+        for (character_id, chat_id), chat in chats.items():
+            chat_store.import_chat(character_id, chat_id, chat['log'], chat['summary'])
+        return {"characters": len(imported_characters), "chats": len(chats), "uploads": uploads}
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error) as e:
+        raise ArchiveError(f"The archive is damaged: {e}")
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
@@ -0,0 +1,365 @@
+import sys
+import json
+import asyncio
+import tempfile
+from urllib.parse import parse_qs
+
+import main
+from scheduler import SchedulerFull
+from generations import parse_last_event_id
+from llm_client import AsyncBackendClient, BackendHTTPError, NoBackendAvailable
+
+# --- Async Serving Mode ---
+# An ASGI app with the same routes as main.py. /api/chat/stream runs natively on the
+# event loop: it waits on the backend socket instead of pinning a thread, so hundreds of
+# generations can share one loop. Every other route is handed to the Flask app on a
+# worker thread.
+#
+# Run with:  python asgi.py   (or: uvicorn asgi:app --host 0.0.0.0 --port 5500)
+
+SPOOL_MAX_MEMORY = 1024 * 1024  # Request bodies larger than this are spooled to disk
+
+backend_client = AsyncBackendClient(main.LLM_POOL_SIZE, main.LLM_CONNECT_TIMEOUT, main.LLM_READ_TIMEOUT)
+running_generations = set()  # Keeps producer tasks referenced until they finish
+
+
+async def read_body(receive, spool=False):
+    """Reads the whole request body, into memory or (spool=True) a temporary file."""
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) if spool else bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b"")
+        if spool:
+            body.write(chunk)
+        else:
+            body += chunk
+        if not message.get('more_body'):
+            break
+    if spool:
+        body.seek(0)
+    return body
+
+
+async def send_json(send, payload, status, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                    (b'access-control-allow-origin', b'*'), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# --- Streaming Chat ---
+
+async def handle_streaming_chat(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    try:
+        data = json.loads(bytes(await read_body(receive)) or b"null")
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        await send_json(send, {"error": "Request body must be a JSON object"}, 400)
+        return
+
+    # Loading the character and history touches the disk, so it runs off the loop
+    try:
+        turn, error = await loop.run_in_executor(None, main.prepare_chat_turn, data, True)
+    except Exception as e:
+        print(f"Error preparing chat turn: {e}")
+        main.chat_requests.inc(endpoint='stream', outcome='error')
+        await send_json(send, {"error": f"Could not prepare the chat request: {e}"}, 500)
+        return
+    if error:
+        main.chat_requests.inc(endpoint='stream', outcome='rejected')
+        await send_json(send, error[0], error[1])
+        return
+    try:
+        ticket = main.schedule_turn(turn, (scope.get('client') or ('', 0))[0])
+    except SchedulerFull as e:
+        main.chat_requests.inc(endpoint='stream', outcome='rejected')
+        await send_json(send, {"error": str(e)}, 429, [(b'retry-after', str(main.LLM_RETRY_AFTER).encode())])
+        return
+
+    generation = main.generation_registry.start(turn['character_id'], turn['chat_id'])
+    headers = []
+    if main.SERVER_TIMING:
+        headers.append((b'server-timing', turn['timings'].server_timing().encode('latin-1')))
+    task = asyncio.ensure_future(run_generation(turn, ticket, generation))
+    running_generations.add(task)
+    task.add_done_callback(running_generations.discard)
+    await stream_generation(generation, 0, receive, send, headers)
+
+
+async def run_generation(turn, ticket, generation):
+    """Runs a streamed turn on the event loop, publishing its events to the generation."""
+    loop = asyncio.get_running_loop()
+    count = turn['n_candidates']
+    chunks = [[] for _ in range(count)]
+    timings = turn['timings']
+    outcome = 'error'
+
+    async def stream_reply(payload, key, candidate=None):
+        # candidate tags deltas like main.stream_request does
+        indexed = candidate == 'n'
+        async for delta in backend_client.stream_from_pool(main.backend_pool, key, payload, indexed):
+            index, content = delta if indexed else (candidate, delta)
+            timings.token()
+            if index is None:
+                chunks[0].append(content)
+                generation.publish({'type': 'content', 'content': content})
+            elif index < count:
+                chunks[index].append(content)
+                generation.publish({'type': 'content', 'candidate': index, 'content': content})
+
+    async def stream_candidate(index):
+        payload, key = main.candidate_request(turn, index)
+        try:
+            await stream_reply(payload, key, index)
+        except (BackendHTTPError, NoBackendAvailable, OSError, asyncio.TimeoutError, ValueError) as e:
+            error = str(e) or e.__class__.__name__
+            generation.publish({'type': 'candidate_error', 'candidate': index, 'content': error})
+            return error
+        return None
+
+    async def stream_all():
+        """Returns an error message if every candidate failed."""
+        if count == 1:
+            await stream_reply(turn['payload'], turn['backend_key'])
+        elif main.LLM_CANDIDATES_USE_N:
+            await stream_reply(dict(turn['payload'], n=count), turn['backend_key'], 'n')
+        else:
+            errors = await asyncio.gather(*(stream_candidate(index) for index in range(count)))
+            if all(errors):
+                return errors[0]
+        return None
+
+    try:
+        start = {'type': 'start', 'generation_id': generation.id}
+        if count > 1:
+            start['candidates'] = count
+        generation.publish(start)
+        position = None
+        deadline = loop.time() + main.LLM_QUEUE_TIMEOUT
+        while not generation.cancelled.is_set() and not await ticket.wait_async(0.5 if position is not None else 0):
+            if ticket.position != position:
+                position = ticket.position
+                generation.publish({'type': 'queued', 'position': position})
+            if loop.time() > deadline:
+                raise TimeoutError("Timed out waiting for a free generation slot")
+        timings.mark('queue')
+
+        if not generation.cancelled.is_set():
+            # Cancelling the task closes the backend connections, which stops the generation there
+            streamer = asyncio.ensure_future(stream_all())
+            generation.on_cancel(lambda: loop.call_soon_threadsafe(streamer.cancel))
+            try:
+                error = await streamer
+            except asyncio.CancelledError:
+                if not generation.cancelled.is_set():
+                    raise
+                error = None
+            timings.mark('stream' if timings.first_token is not None else 'backend')
+            if error:
+                generation.publish({'type': 'error', 'content': error})
+                return
+
+        truncated = generation.cancelled.is_set()
+        contents = ["".join(c) for c in chunks]
+        full_content = contents if count > 1 else contents[0]
+        save = main.save_partial_reply if truncated else main.save_reply
+        try:
+            await loop.run_in_executor(None, save, turn, full_content)
+        except Exception as e:
+            print(f"Error saving final message for {turn['character_id']}/{turn['chat_id']}: {e}")
+            generation.publish({'type': 'error', 'content': f'Failed to save the reply: {e}'})
+            return
+        timings.mark('save')
+        outcome = 'cancelled' if truncated else 'ok'
+
+        generation.publish({'type': 'stats', **timings.summary()})
+        done = {'type': 'done', 'truncated': truncated}
+        if count > 1:
+            reply = main.build_reply(full_content)
+            done['candidates'] = reply['candidates']
+            done['selected'] = reply['selected']
+        generation.publish(done)
+    except (BackendHTTPError, NoBackendAvailable) as e:
+        generation.publish({'type': 'error', 'content': str(e)})
+    except (OSError, asyncio.TimeoutError, ValueError) as e:
+        error_msg = str(e) or e.__class__.__name__
+        print(f"Streaming Error: {error_msg}")
+        generation.publish({'type': 'error', 'content': f'Streaming Error: {error_msg}'})
+    except Exception as e:
+        # Anything else must still end the stream, or clients wait until they time out
+        error_msg = str(e) or e.__class__.__name__
+        print(f"Unexpected streaming error: {e.__class__.__name__}: {error_msg}")
+        generation.publish({'type': 'error', 'content': f'Streaming Error: {error_msg}'})
+    finally:
+        main.generation_registry.finish(generation)
+        main.generation_scheduler.release(ticket)
+        main.record_turn_metrics(turn, 'stream', outcome)
+
+
+async def stream_generation(generation, after_seq, receive, send, headers=()):
+    """Sends a generation's events as SSE frames, like main.stream_generation."""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                    (b'access-control-allow-origin', b'*'), (b'x-generation-id', generation.id.encode()), *headers],
+    })
+
+    async def forward():
+        nonlocal after_seq
+        while True:
+            if not await generation.wait_async(after_seq, main.SSE_KEEPALIVE_INTERVAL):
+                await send({'type': 'http.response.body', 'body': b": keep-alive\n\n", 'more_body': True})
+                continue
+            deadline = loop.time() + main.SSE_COALESCE_WINDOW
+            while not generation.finished and generation.pending_bytes(after_seq) < main.SSE_COALESCE_BYTES:
+                remaining = deadline - loop.time()
+                if remaining <= 0 or not await generation.wait_async(generation.last_seq, remaining):
+                    break
+            frames, after_seq = generation.read(after_seq)
+            body = "".join(main.sse_event(payload, f"{generation.id}:{seq}") for seq, payload in frames)
+            if body:
+                await send({'type': 'http.response.body', 'body': body.encode('utf-8'), 'more_body': True})
+            if generation.finished and after_seq == generation.last_seq:
+                return
+
+    async def watch_disconnect():
+        # The body has been read, so the next message is the client going away
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    loop = asyncio.get_running_loop()
+    generation.attach()
+    forwarder = asyncio.ensure_future(forward())
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        await asyncio.wait({forwarder, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        forwarder.cancel()
+        watcher.cancel()
+        # With nobody left, the generation is cancelled after a grace period
+        generation.detach()
+    await send({'type': 'http.response.body', 'body': b"", 'more_body': False})
+
+
+async def handle_resume(scope, receive, send, generation_id):
+    generation = main.generation_registry.get(generation_id)
+    if generation is None:
+        await send_json(send, {"error": "Generation not found or expired"}, 404)
+        return
+    headers = dict(scope['headers'])
+    last_event_id = headers.get(b'last-event-id', b"").decode('latin-1')
+    if not last_event_id:
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        last_event_id = query.get('last_event_id', [""])[0]
+    await stream_generation(generation, parse_last_event_id(last_event_id, generation_id), receive, send)
+
+
+# --- WSGI Bridge ---
+
+def build_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def call_flask(scope, receive, send):
+    """Runs a request through the Flask app on a worker thread, streaming its body back."""
+    loop = asyncio.get_running_loop()
+    body = await read_body(receive, spool=True)
+    environ = build_environ(scope, body)
+    response_start = {}
+
+    def start_response(status, headers, exc_info=None):
+        response_start['status'] = int(status.split(" ", 1)[0])
+        response_start['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    def next_chunk(iterator):
+        return next(iterator, None)
+
+    result = await loop.run_in_executor(None, main.app, environ, start_response)
+    try:
+        iterator = iter(result)
+        # The first chunk is fetched before the headers go out, as start_response may be deferred
+        chunk = await loop.run_in_executor(None, next_chunk, iterator)
+        await send({'type': 'http.response.start', 'status': response_start['status'], 'headers': response_start['headers']})
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(None, next_chunk, iterator)
+        await send({'type': 'http.response.body', 'body': b"", 'more_body': False})
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(None, result.close)
+        body.close()
+
+
+# --- ASGI Entry Point ---
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    if path == '/api/chat/stream' and scope['method'] == 'POST':
+        await handle_streaming_chat(scope, receive, send)
+    elif path.startswith('/api/chat/stream/') and path.count('/') == 4 and scope['method'] == 'GET':
+        await handle_resume(scope, receive, send, path.rsplit('/', 1)[1])
+    else:
+        await call_flask(scope, receive, send)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("The async serving mode needs uvicorn: pip install uvicorn")
+        sys.exit(1)
+    print("--- Local AI Chat Server (async) ---")
+    print("Access the web UI at: http://127.0.0.1:5500")
+    print("Make sure LM Studio is running on port 1234")
+    print("---------------------------------")
+    migrated = main.chat_store.migrate_all()
+    if migrated:
+        print(f"Migrated {migrated} legacy chat file(s) to the chat log format")
+    uvicorn.run(app, host='0.0.0.0', port=5500)
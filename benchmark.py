@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+from storage import ChatStore
+
+# --- Benchmark ---
+# Measures the server end to end so changes can be compared run against run. It starts
+# the mock backend (mock_backend.py) and the server (Flask or the async mode) as child
+# processes, on free ports and with a throwaway data folder seeded with chats of each
+# history size, then runs every scenario:
+#
+#   stream    POST /api/chat/stream   time to first token, inter-token latency, end to end
+#   chat      POST /api/chat          end to end
+#   history   GET  /api/chats/...     latest page (?limit=50) of the chat
+#   full      GET  /api/chats/...     the whole history (skipped above --full-max messages)
+#
+# at each concurrency level (one chat per concurrent client) and reports p50/p99 times,
+# throughput and the server's peak RSS as JSON:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json
+#   python benchmark.py compare before.json after.json
+#
+# Inter-token latency is the gap between SSE content frames, so it includes the server's
+# coalescing window (SSE_COALESCE_WINDOW).
+
+CHARACTER_ID = "bench"
+MESSAGE_LENGTH = 300  # Characters per seeded message
+HISTORY_PAGE = 50
+STARTUP_TIMEOUT = 60
+RSS_SAMPLE_INTERVAL = 0.1
+
+DEFAULT_HISTORY_SIZES = [10, 1000, 10000, 50000]
+DEFAULT_CONCURRENCY = [1, 4, 16]
+DEFAULT_SCENARIOS = ['stream', 'chat', 'history', 'full']
+
+
+# --- Setup ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed_data(data_dir, history_sizes, clients):
+    """Writes the benchmark character and `clients` copies of a chat per history size.
+
+    Returns {history size: [chat ids]}.
+    """
+    os.makedirs(os.path.join(data_dir, "characters"))
+    with open(os.path.join(data_dir, "characters", f"{CHARACTER_ID}.json"), 'w', encoding='utf-8') as f:
+        json.dump({"id": CHARACTER_ID, "name": "Bench", "description": "A character for benchmarks.", "avatar_url": ""}, f)
+    chats_dir = os.path.join(data_dir, "chats")
+    os.makedirs(chats_dir)
+    store = ChatStore(chats_dir, write_delay=0, fsync='never')
+    filler = ("The quick brown fox jumps over the lazy dog. " * (MESSAGE_LENGTH // 45 + 1))[:MESSAGE_LENGTH]
+    chats = {}
+    for size in history_sizes:
+        template = f"h{size}-0"
+        os.makedirs(store._char_dir(CHARACTER_ID), exist_ok=True)
+        open(store.log_path(CHARACTER_ID, template), 'wb').close()
+        store.append_messages(CHARACTER_ID, template, [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}: {filler}"} for i in range(size)
+        ])
+        chats[size] = [template]
+        for n in range(1, clients):
+            chat_id = f"h{size}-{n}"
+            shutil.copyfile(store.log_path(CHARACTER_ID, template), store.log_path(CHARACTER_ID, chat_id))
+            chats[size].append(chat_id)
+    return chats
+
+
+def wait_for(url, process, timeout=STARTUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode} while starting")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_server(mode, port, data_dir, backend_url, log):
+    if mode == 'asgi':
+        code = f"import asgi, uvicorn; uvicorn.run(asgi.app, host='127.0.0.1', port={port}, log_level='warning')"
+    else:
+        code = f"import main; main.app.run(host='127.0.0.1', port={port}, threaded=True)"
+    env = dict(os.environ, LOCALAICHAT_DATA_DIR=data_dir, LOCALAICHAT_BACKENDS=backend_url)
+    return subprocess.Popen([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+class RssSampler:
+    """Tracks the peak resident set size of a process while running."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def current(self):
+        """Returns the RSS in bytes, or None where it can't be read."""
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        try:
+            import psutil
+            return psutil.Process(self.pid).memory_info().rss
+        except Exception:  # psutil missing, or the process is gone
+            return None
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            rss = self.current()
+            if rss:
+                self.peak = max(self.peak, rss)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak or None
+
+
+# --- Requests ---
+
+def chat_body(chat_id):
+    return {"character_id": CHARACTER_ID, "chat_id": chat_id, "message": "Tell me something new.",
+            "mode": "chat", "user_persona": "", "llm_settings": {}}
+
+
+def run_stream(session, base, chat_id):
+    """Returns (end to end, time to first token, [inter-token gaps], content frames)."""
+    start = time.perf_counter()
+    first = last = None
+    gaps = []
+    frames = 0
+    with session.post(f"{base}/api/chat/stream", json=chat_body(chat_id), stream=True, timeout=600) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            event = json.loads(line[6:])
+            if event.get('type') == 'error':
+                raise RuntimeError(event.get('content'))
+            if event.get('type') != 'content':
+                continue
+            now = time.perf_counter()
+            if first is None:
+                first = now
+            else:
+                gaps.append(now - last)
+            last = now
+            frames += 1
+    end = time.perf_counter()
+    return end - start, (first - start) if first else None, gaps, frames
+
+
+def run_chat(session, base, chat_id):
+    start = time.perf_counter()
+    response = session.post(f"{base}/api/chat", json=chat_body(chat_id), timeout=600)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def run_history(session, base, chat_id, full):
+    start = time.perf_counter()
+    url = f"{base}/api/chats/{CHARACTER_ID}/{chat_id}" + ("" if full else f"?limit={HISTORY_PAGE}")
+    response = session.get(url, timeout=600)
+    response.raise_for_status()
+    response.content
+    return time.perf_counter() - start
+
+
+# --- Scenarios ---
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(values, scale=1000.0):
+    """p50/p99/mean/max of a list of seconds, in milliseconds."""
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 50) * scale, 3),
+        "p99": round(percentile(values, 99) * scale, 3),
+        "mean": round(sum(values) / len(values) * scale, 3),
+        "max": round(max(values) * scale, 3),
+    }
+
+
+def run_scenario(base, scenario, history_size, chat_ids, concurrency, requests_per_client, sampler):
+    e2e, ttft, gaps, frames = [], [], [], []
+    errors = []
+    lock = threading.Lock()
+
+    def client(chat_id):
+        session = requests.Session()
+        for _ in range(requests_per_client):
+            try:
+                if scenario == 'stream':
+                    total, first, item_gaps, item_frames = run_stream(session, base, chat_id)
+                    with lock:
+                        e2e.append(total)
+                        gaps.extend(item_gaps)
+                        frames.append(item_frames)
+                        if first is not None:
+                            ttft.append(first)
+                elif scenario == 'chat':
+                    total = run_chat(session, base, chat_id)
+                    with lock:
+                        e2e.append(total)
+                else:
+                    total = run_history(session, base, chat_id, scenario == 'full')
+                    with lock:
+                        e2e.append(total)
+            except (requests.RequestException, RuntimeError, ValueError) as e:
+                with lock:
+                    errors.append(str(e))
+
+    baseline_rss = sampler.current()
+    threads = [threading.Thread(target=client, args=(chat_ids[i],)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    after_rss = sampler.current()
+
+    result = {
+        "scenario": scenario,
+        "history_size": history_size,
+        "concurrency": concurrency,
+        "requests": len(e2e),
+        "errors": len(errors),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(e2e) / duration, 3) if duration else None,
+        "e2e_ms": summarize(e2e),
+        "rss_before_mb": round(baseline_rss / 2 ** 20, 1) if baseline_rss else None,
+        "rss_after_mb": round(after_rss / 2 ** 20, 1) if after_rss else None,
+    }
+    if scenario == 'stream':
+        result["ttft_ms"] = summarize(ttft)
+        result["itl_ms"] = summarize(gaps)
+        result["frames_per_s"] = round(sum(frames) / duration, 1) if duration else None
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def scenario_key(result):
+    return f"{result['scenario']}/h{result['history_size']}/c{result['concurrency']}"
+
+
+def run(args):
+    history_sizes = sorted(args.history)
+    clients = max(args.concurrency)
+    work_dir = tempfile.mkdtemp(prefix="localaichat-bench-")
+    data_dir = os.path.join(work_dir, "data")
+    processes = []
+    log = open(os.path.join(work_dir, "server.log"), 'wb')
+    try:
+        print(f"Seeding {clients} chat(s) for each of {history_sizes} messages in {data_dir}", file=sys.stderr)
+        chats = seed_data(data_dir, history_sizes, clients)
+
+        backend_url = args.backend
+        if backend_url is None:
+            mock_port = free_port()
+            mock = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_backend.py"),
+                                     "--port", str(mock_port), "--latency", str(args.mock_latency),
+                                     "--rate", str(args.mock_rate), "--tokens", str(args.mock_tokens)],
+                                    stdout=subprocess.DEVNULL)
+            processes.append(mock)
+            wait_for(f"http://127.0.0.1:{mock_port}/v1/models", mock)
+            backend_url = f"http://127.0.0.1:{mock_port}/v1/chat/completions"
+
+        port = free_port()
+        server = start_server(args.mode, port, data_dir, backend_url, log)
+        processes.append(server)
+        base = f"http://127.0.0.1:{port}"
+        wait_for(f"{base}/api/backends", server)
+        sampler = RssSampler(server.pid).start()
+        idle_rss = sampler.current()
+
+        # Warm up: build each chat's offset index and metadata before anything is timed
+        session = requests.Session()
+        session.get(f"{base}/api/characters/{CHARACTER_ID}/chats?limit=1").raise_for_status()
+        for chat_ids in chats.values():
+            for chat_id in chat_ids:
+                session.get(f"{base}/api/chats/{CHARACTER_ID}/{chat_id}?limit=1").raise_for_status()
+
+        results = []
+        for scenario in args.scenarios:
+            for size in history_sizes:
+                if scenario == 'full' and size > args.full_max:
+                    continue
+                for concurrency in args.concurrency:
+                    result = run_scenario(base, scenario, size, chats[size], concurrency, args.requests, sampler)
+                    results.append(result)
+                    e2e = result['e2e_ms'] or {}
+                    print(f"{scenario_key(result):<24} {result['requests']:>4} ok {result['errors']:>3} err  "
+                          f"p50 {e2e.get('p50')} ms  p99 {e2e.get('p99')} ms  {result['throughput_rps']} req/s",
+                          file=sys.stderr)
+        peak_rss = sampler.stop()
+        return {
+            "meta": {
+                "timestamp": time.time(),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "mode": args.mode,
+                "backend": "mock" if args.backend is None else args.backend,
+                "mock": None if args.backend else {"latency": args.mock_latency, "rate": args.mock_rate, "tokens": args.mock_tokens},
+                "requests_per_client": args.requests,
+            },
+            "server_rss_mb": {
+                "idle": round(idle_rss / 2 ** 20, 1) if idle_rss else None,
+                "peak": round(peak_rss / 2 ** 20, 1) if peak_rss else None,
+            },
+            "results": results,
+        }
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        log.close()
+        if args.keep:
+            print(f"Kept the benchmark data and server log in {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# --- Comparing Runs ---
+
+def compare(before_path, after_path):
+    """Prints how the p50/p99 and throughput of each scenario changed between two runs."""
+    with open(before_path, encoding='utf-8') as f:
+        before = {scenario_key(r): r for r in json.load(f)['results']}
+    with open(after_path, encoding='utf-8') as f:
+        after_run = json.load(f)
+    print(f"{'scenario':<24} {'metric':<16} {'before':>10} {'after':>10} {'change':>8}")
+    for result in after_run['results']:
+        key = scenario_key(result)
+        old = before.get(key)
+        if old is None:
+            continue
+        metrics = [("e2e p50 ms", ('e2e_ms', 'p50')), ("e2e p99 ms", ('e2e_ms', 'p99'))]
+        if result['scenario'] == 'stream':
+            metrics += [("ttft p50 ms", ('ttft_ms', 'p50')), ("itl p50 ms", ('itl_ms', 'p50'))]
+        metrics.append(("req/s", ('throughput_rps', None)))
+        for label, (field, stat) in metrics:
+            a = old.get(field)
+            b = result.get(field)
+            if stat is not None:
+                a = a.get(stat) if a else None
+                b = b.get(stat) if b else None
+            if a is None or b is None:
+                continue
+            change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+            print(f"{key:<24} {label:<16} {a:>10} {b:>10} {change:>8}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        if len(sys.argv) != 4:
+            print("usage: python benchmark.py compare BEFORE.json AFTER.json")
+            sys.exit(2)
+        compare(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmark the chat server against a mock backend")
+    parser.add_argument('--mode', choices=('flask', 'asgi'), default='flask', help="how the server is run")
+    parser.add_argument('--history', type=int, nargs='+', default=DEFAULT_HISTORY_SIZES, help="messages per chat")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY, help="concurrent clients")
+    parser.add_argument('--scenarios', nargs='+', choices=DEFAULT_SCENARIOS, default=DEFAULT_SCENARIOS)
+    parser.add_argument('--requests', type=int, default=5, help="requests per client and scenario")
+    parser.add_argument('--full-max', type=int, default=10000, help="largest history fetched whole")
+    parser.add_argument('--backend', help="benchmark against this chat completions URL instead of the mock")
+    parser.add_argument('--mock-latency', type=float, default=0.2, help="mock seconds before the first token")
+    parser.add_argument('--mock-rate', type=float, default=100.0, help="mock tokens per second")
+    parser.add_argument('--mock-tokens', type=int, default=64, help="mock tokens per reply")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary data folder and server log")
+    args = parser.parse_args()
+
+    report = run(args)
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(data + "\n")
+        print(f"Wrote {args.output}", file=sys.stderr)
+    else:
+        print(data)
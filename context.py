@@ -0,0 +1,103 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# --- Context Budgeting ---
+# Token counts are estimated rather than tokenized: the exact tokenizer lives in the
+# backend, and a cheap, slightly pessimistic estimate is enough to keep a prompt inside
+# the model's context window. Counts are computed once per message when it is written
+# and cached in the chat's offset index (see storage.py).
+
+MESSAGE_OVERHEAD_TOKENS = 4  # Role markers and separators the chat template adds per message
+
+
+def estimate_tokens(text):
+    """Estimates tokens as ~4 ASCII characters per token and ~1 token per non-ASCII character."""
+    if not text:
+        return 0
+    extra_bytes = len(text.encode('utf-8')) - len(text)
+    return (len(text) + 3) // 4 + extra_bytes // 2
+
+
+def message_tokens(message):
+    content = message.get('content')
+    return estimate_tokens(content if isinstance(content, str) else str(content or '')) + MESSAGE_OVERHEAD_TOKENS
+
+
+def select_context(token_counts, pinned, budget, block=1):
+    """Picks which history messages fit in a token budget.
+
+    Pinned messages are kept first (newest first), then the newest run of unpinned
+    messages that still fits. When older messages have to go, the start of that run is
+    rounded up to a multiple of `block`, so it stays put for several turns and the
+    backend can keep reusing its cached prompt prefix. Returns the chosen indices in
+    chronological order.
+    """
+    chosen = set()
+    used = 0
+    for index in range(len(token_counts) - 1, -1, -1):
+        if pinned[index] and used + token_counts[index] <= budget:
+            chosen.add(index)
+            used += token_counts[index]
+    start = len(token_counts)
+    for index in range(len(token_counts) - 1, -1, -1):
+        if pinned[index]:
+            continue
+        if used + token_counts[index] > budget:
+            # Stop at the first message that doesn't fit so the kept history has no gaps
+            break
+        chosen.add(index)
+        used += token_counts[index]
+        start = index
+    if block > 1 and any(not pinned[i] for i in range(start)):
+        block_start = -(-start // block) * block
+        if block_start < len(token_counts):
+            chosen = {i for i in chosen if pinned[i] or i >= block_start}
+    return sorted(chosen)
+
+
+# --- Prompt Prefix Tracking ---
+# Remembers a fingerprint of the last prompt sent for each chat, so /api/debug/prefix can
+# show how much of it the next request shared (the part a backend's KV cache can reuse).
+
+class PrefixTracker:
+    def __init__(self, max_chats=256):
+        self.max_chats = max_chats
+        self._last = OrderedDict()  # (character_id, chat_id) -> ([(digest, size), ...], stats)
+        self._lock = threading.Lock()
+
+    def record(self, key, messages):
+        fingerprint = []
+        for message in messages:
+            encoded = json.dumps(message, ensure_ascii=False).encode('utf-8')
+            fingerprint.append((hashlib.sha1(encoded).digest(), len(encoded)))
+
+        with self._lock:
+            previous, stats = self._last.pop(key, (None, None))
+            matched = 0
+            if previous is not None:
+                for old, new in zip(previous, fingerprint):
+                    if old != new:
+                        break
+                    matched += 1
+            total_bytes = sum(size for _, size in fingerprint)
+            matched_bytes = sum(size for _, size in fingerprint[:matched])
+            stats = {
+                "requests": (stats["requests"] if stats else 0) + 1,
+                "matched_messages": matched,
+                "total_messages": len(fingerprint),
+                "matched_bytes": matched_bytes,
+                "total_bytes": total_bytes,
+                "matched_ratio": round(matched_bytes / total_bytes, 4) if previous is not None and total_bytes else 0.0,
+                "first_mismatch_index": matched if previous is not None and matched < len(fingerprint) else None,
+            }
+            self._last[key] = (fingerprint, stats)
+            while len(self._last) > self.max_chats:
+                self._last.popitem(last=False)
+        return stats
+
+    def stats(self, key):
+        with self._lock:
+            entry = self._last.get(key)
+            return dict(entry[1]) if entry else None
@@ -0,0 +1,245 @@
+import time
+import uuid
+import asyncio
+import threading
+from collections import deque
+
+# --- Active Generations ---
+# Every streamed reply runs as a generation, identified by an id announced to the client
+# in the first SSE event. The generation runs independently of the HTTP response: it
+# publishes its events into a bounded ring buffer, and responses subscribe to that
+# buffer. A client whose connection drops can reconnect with Last-Event-ID and get the
+# events it missed replayed, without the backend generating anything twice.
+#
+# A generation with several candidates (parallel alternative replies) publishes its
+# content deltas tagged with a `candidate` index. Subscribers get each run of them as
+# one frame, {"type": "content", "candidates": {index: text}}, so one event id still
+# covers everything before it.
+#
+# POST /api/chat/stream/<id>/cancel runs the callbacks the producer registered, which
+# abort the upstream request. A generation nobody is subscribed to any more is
+# cancelled the same way once resume_grace seconds pass without a reconnect.
+
+
+class Generation:
+    def __init__(self, character_id, chat_id, buffer_size, resume_grace):
+        self.id = uuid.uuid4().hex
+        self.character_id = character_id
+        self.chat_id = chat_id
+        self.started = time.time()
+        self.finished = False
+        self.cancelled = threading.Event()
+        self.resume_grace = resume_grace
+        self.subscribers = 0
+        self.last_seq = 0
+        self._events = deque(maxlen=buffer_size)  # (seq, payload, content bytes before it)
+        self._content = {}  # Candidate index (None without candidates) -> every content delta, for snapshots
+        self._content_bytes = 0
+        self._content_seq = 0  # seq of the newest content event
+        self._callbacks = []
+        self._wakers = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    # --- Producer side ---
+
+    def publish(self, payload):
+        with self._lock:
+            self.last_seq += 1
+            self._events.append((self.last_seq, payload, self._content_bytes))
+            if payload.get('type') == 'content':
+                self._content.setdefault(payload.get('candidate'), []).append(payload['content'])
+                self._content_bytes += len(payload['content'].encode('utf-8'))
+                self._content_seq = self.last_seq
+            self._notify()
+
+    def close(self):
+        """Marks the generation finished; subscribers end once they have read everything."""
+        with self._lock:
+            self.finished = True
+            self._notify()
+
+    def _notify(self):
+        self._changed.notify_all()
+        wakers, self._wakers = self._wakers, []
+        for wake in wakers:
+            wake()
+
+    # --- Subscriber side ---
+
+    def wait(self, after_seq, timeout):
+        """Blocks until there are events after after_seq or the generation finished.
+
+        Returns False on timeout.
+        """
+        with self._lock:
+            return self._changed.wait_for(lambda: self.last_seq > after_seq or self.finished, timeout)
+
+    async def wait_async(self, after_seq, timeout):
+        """Like wait(), without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        with self._lock:
+            if self.last_seq > after_seq or self.finished:
+                return True
+            self._wakers.append(wake)
+        try:
+            done, _ = await asyncio.wait({future}, timeout=timeout)
+        finally:
+            with self._lock:
+                if wake in self._wakers:
+                    self._wakers.remove(wake)
+        return bool(done)
+
+    def pending_bytes(self, after_seq):
+        """How much content has been published after after_seq."""
+        with self._lock:
+            if after_seq >= self.last_seq:
+                return 0
+            first_seq = self._events[0][0]
+            if after_seq + 1 < first_seq:
+                return self._content_bytes
+            return self._content_bytes - self._events[after_seq + 1 - first_seq][2]
+
+    def read(self, after_seq):
+        """Returns (frames, last_seq) for the events after after_seq.
+
+        frames are (seq, payload) pairs, with each run of content deltas merged into one
+        frame. If some of the missed events have already left the ring buffer, a
+        `snapshot` frame with the whole reply (or every candidate) so far stands in for them.
+        """
+        with self._lock:
+            first_seq = self._events[0][0] if self._events else self.last_seq + 1
+            frames = []
+            if after_seq < first_seq - 1 and after_seq < self._content_seq:
+                if None in self._content:
+                    snapshot = {'type': 'snapshot', 'content': "".join(self._content[None])}
+                else:
+                    snapshot = {'type': 'snapshot', 'candidates': {i: "".join(c) for i, c in self._content.items()}}
+                frames.append((self._content_seq, snapshot))
+                after_seq = self._content_seq
+            for seq, payload, _ in self._events:
+                if seq <= after_seq:
+                    continue
+                if payload.get('type') != 'content':
+                    frames.append((seq, payload))
+                    continue
+                previous = frames[-1][1] if frames and frames[-1][1].get('type') == 'content' else None
+                if 'candidate' in payload:
+                    candidates = dict(previous['candidates']) if previous else {}
+                    candidates[payload['candidate']] = candidates.get(payload['candidate'], "") + payload['content']
+                    frame = {'type': 'content', 'candidates': candidates}
+                else:
+                    frame = {'type': 'content', 'content': (previous['content'] if previous else "") + payload['content']}
+                if previous:
+                    frames[-1] = (seq, frame)
+                else:
+                    frames.append((seq, frame))
+            return frames, max(after_seq, self.last_seq)
+
+    def attach(self):
+        with self._lock:
+            self.subscribers += 1
+
+    def detach(self):
+        with self._lock:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.finished
+        if abandoned:
+            if self.resume_grace > 0:
+                timer = threading.Timer(self.resume_grace, self._cancel_if_abandoned)
+                timer.daemon = True
+                timer.start()
+            else:
+                self.cancel()
+
+    def _cancel_if_abandoned(self):
+        with self._lock:
+            abandoned = self.subscribers == 0 and not self.finished
+        if abandoned:
+            print(f"Generation {self.id} lost its client; cancelling")
+            self.cancel()
+
+    # --- Cancellation ---
+
+    def on_cancel(self, callback):
+        """Registers a callback for cancel(); runs it right away if already cancelled."""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error cancelling generation {self.id}: {e}")
+
+    def status(self):
+        return {
+            "generation_id": self.id,
+            "character_id": self.character_id,
+            "chat_id": self.chat_id,
+            "started": self.started,
+            "finished": self.finished,
+            "cancelled": self.cancelled.is_set(),
+            "subscribers": self.subscribers,
+            "events": self.last_seq,
+        }
+
+
+class GenerationRegistry:
+    def __init__(self, buffer_size, resume_grace, retain):
+        self.buffer_size = buffer_size
+        self.resume_grace = resume_grace
+        self.retain = retain  # Seconds a finished generation stays available for replay
+        self._generations = {}
+        self._finished = deque()  # (finish time, generation id), oldest first
+        self._lock = threading.Lock()
+
+    def start(self, character_id, chat_id):
+        generation = Generation(character_id, chat_id, self.buffer_size, self.resume_grace)
+        with self._lock:
+            self._expire()
+            self._generations[generation.id] = generation
+        return generation
+
+    def get(self, generation_id):
+        with self._lock:
+            self._expire()
+            return self._generations.get(generation_id)
+
+    def finish(self, generation):
+        generation.close()
+        with self._lock:
+            self._finished.append((time.monotonic(), generation.id))
+
+    def active(self):
+        with self._lock:
+            return [g.status() for g in self._generations.values() if not g.finished]
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.retain
+        while self._finished and self._finished[0][0] < cutoff:
+            self._generations.pop(self._finished.popleft()[1], None)
+
+
+def parse_last_event_id(value, generation_id):
+    """Returns the seq a client resumes after, from an `<generation id>:<seq>` event id."""
+    if not value or ":" not in value:
+        return 0
+    event_generation, _, seq = value.rpartition(":")
+    if event_generation != generation_id or not seq.isdigit():
+        return 0
+    return int(seq)
@@ -0,0 +1,436 @@
+import json
+import time
+import socket
+import asyncio
+import threading
+import requests
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+# --- LLM Backend Client ---
+# One shared requests.Session keeps connections to the backend alive between turns, and
+# an incremental SSE parser turns the raw streamed body into chat-completion deltas.
+
+
+def create_session(pool_size, backend_count=1):
+    """Creates a keep-alive session able to hold pool_size open connections to each of
+    backend_count backends."""
+    session = requests.Session()
+    # One connection pool per backend host, so none is evicted while the others are in use
+    adapter = HTTPAdapter(pool_connections=max(1, backend_count), pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class SSEParser:
+    """Incremental text/event-stream parser fed with arbitrary byte chunks.
+
+    Returns the data of each complete event as bytes, left for the caller to decode so
+    one malformed event can be skipped on its own; multi-line `data:` fields are joined
+    with newlines as the SSE spec requires. Other fields and comments are ignored.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._data = []
+
+    def feed(self, chunk):
+        events = []
+        lines = (self._buffer + chunk).split(b"\n")
+        # The last piece is an incomplete line (or b"" if the chunk ended on a newline)
+        self._buffer = lines.pop()
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                if self._data:
+                    events.append(b"\n".join(self._data))
+                    self._data = []
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                self._data.append(value[1:] if value.startswith(b" ") else value)
+        return events
+
+    def close(self):
+        """Returns the last event if the stream ended without a trailing blank line."""
+        if self._buffer.startswith(b"data:"):
+            value = self._buffer[5:].rstrip(b"\r")
+            self._data.append(value[1:] if value.startswith(b" ") else value)
+        self._buffer = b""
+        events = [b"\n".join(self._data)] if self._data else []
+        self._data = []
+        return events
+
+
+# --- Backend Pool ---
+# Several OpenAI-compatible backends can serve chats. A chat sticks to the backend that
+# served it last (keeping that backend's KV cache warm) for as long as it is healthy;
+# otherwise the healthy backend with the fewest in-flight requests is chosen. A
+# background thread probes each backend's /models endpoint.
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+class Backend:
+    def __init__(self, url):
+        self.url = url
+        self.models_url = url.rsplit("/chat/completions", 1)[0] + "/models"
+        self.healthy = True  # Optimistic until the first probe says otherwise
+        self.outstanding = 0
+        self.chats = 0  # Chats currently stuck to this backend
+        self.last_error = None
+        self.last_checked = None
+
+    def status(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "chats": self.chats,
+            "last_error": self.last_error,
+            "last_checked": self.last_checked,
+        }
+
+
+class BackendPool:
+    def __init__(self, urls, max_sticky_chats=10000):
+        if not urls:
+            raise ValueError("At least one backend URL is required")
+        self.backends = [Backend(url) for url in urls]
+        self.max_sticky_chats = max_sticky_chats
+        self._sticky = OrderedDict()  # chat key -> Backend
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def acquire(self, key, exclude=()):
+        """Picks a backend for a chat and counts a request against it. Returns None if all are excluded."""
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            backend = self._sticky.get(key)
+            if backend is None or backend not in candidates or not backend.healthy:
+                # Fall back to unhealthy backends only when nothing healthy is left to try
+                healthy = [b for b in candidates if b.healthy] or candidates
+                previous = self._sticky.get(key)
+                if previous is not None:
+                    previous.chats -= 1
+                # Ties (e.g. an idle pool) go to the backend holding the fewest chats
+                backend = min(healthy, key=lambda b: (b.outstanding, b.chats))
+                backend.chats += 1
+                self._sticky[key] = backend
+            self._sticky.move_to_end(key)
+            while len(self._sticky) > self.max_sticky_chats:
+                self._sticky.popitem(last=False)[1].chats -= 1
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    def mark_down(self, backend, error):
+        with self._lock:
+            backend.healthy = False
+            backend.last_error = str(error)
+        print(f"Backend {backend.url} marked down: {error}")
+
+    def status(self):
+        with self._lock:
+            return [b.status() for b in self.backends]
+
+    def post(self, session, key, payload, stream, timeout):
+        """POSTs a chat payload, failing over to other backends while none has answered.
+
+        Returns (backend, response); the caller must release(backend) once it is done
+        with the response.
+        """
+        tried = []
+        last_error = None
+        while True:
+            backend = self.acquire(key, exclude=tried)
+            if backend is None:
+                raise NoBackendAvailable(f"No LLM backend available: {last_error}")
+            tried.append(backend)
+            try:
+                response = session.post(backend.url, json=payload, stream=stream, timeout=timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.release(backend)
+                self.mark_down(backend, e)
+                last_error = e
+                continue
+            if response.status_code in (502, 503, 504) and len(tried) < len(self.backends):
+                # Overloaded or restarting; another backend may take it
+                response.close()
+                self.release(backend)
+                last_error = f"API Error: {response.status_code}"
+                continue
+            return backend, response
+
+    def check_health(self, session, timeout=5):
+        for backend in self.backends:
+            try:
+                response = session.get(backend.models_url, timeout=timeout)
+                healthy, error = response.status_code == 200, f"Health check returned {response.status_code}"
+                response.close()
+            except requests.exceptions.RequestException as e:
+                healthy, error = False, str(e)
+            with self._lock:
+                if healthy and not backend.healthy:
+                    print(f"Backend {backend.url} is back up")
+                backend.healthy = healthy
+                backend.last_error = None if healthy else error
+                backend.last_checked = time.time()
+
+    def start_health_checks(self, interval):
+        if self._checker is not None:
+            return
+        session = create_session(1, len(self.backends))  # Backends are probed one at a time
+
+        def run():
+            while True:
+                self.check_health(session)
+                time.sleep(interval)
+
+        self._checker = threading.Thread(target=run, name="llm-health-checks", daemon=True)
+        self._checker.start()
+
+
+class ContentDeltaDecoder:
+    """Turns SSE events of a streamed chat completion into content deltas.
+
+    With indexed=True (a request with `n` > 1) every choice's deltas are returned, as
+    (choice index, content) pairs.
+    """
+
+    def __init__(self, indexed=False):
+        self.parser = SSEParser()
+        self.indexed = indexed
+        self.done = False
+
+    def _decode(self, events):
+        for event in events:
+            if self.done:
+                continue
+            if event == b"[DONE]":
+                self.done = True
+                continue
+            try:
+                choices = json.loads(event.decode('utf-8'))['choices']
+                if not self.indexed:
+                    content = choices[0]['delta'].get('content')
+                    if content:
+                        yield content
+                    continue
+                deltas = [(choice.get('index', 0), choice['delta'].get('content')) for choice in choices]
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                print(f"Error processing streaming data: {e}")
+                continue
+            for index, content in deltas:
+                if content:
+                    yield index, content
+
+    def feed(self, chunk):
+        return self._decode(self.parser.feed(chunk))
+
+    def close(self):
+        return self._decode(self.parser.close())
+
+
+def iter_content_deltas(response, indexed=False):
+    """Yields the content deltas of a streamed chat-completions response
+    ((choice index, content) pairs if indexed).
+
+    Reads the body to the end even after [DONE], so the connection goes back to the
+    session's pool instead of being dropped.
+    """
+    decoder = ContentDeltaDecoder(indexed)
+    for chunk in response.iter_content(chunk_size=None):
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+def abort_response(response):
+    """Aborts a streamed response from another thread.
+
+    Closing the response is not enough: a reader blocked on the socket would only notice
+    once the next bytes arrive. Shutting the socket down wakes it immediately, and the
+    backend sees the disconnect and stops generating.
+    """
+    connection = getattr(response.raw, '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# --- Async Backend Client ---
+# A minimal HTTP/1.1 client on asyncio streams, used by the async server (asgi.py) so an
+# open generation waits on a socket instead of holding a thread. Idle keep-alive
+# connections are pooled per backend host.
+
+class BackendHTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(f"API Error: {status}")
+        self.status = status
+
+
+class AsyncBackendClient:
+    def __init__(self, pool_size, connect_timeout, read_timeout):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = {}  # (host, port, use_ssl) -> [(reader, writer), ...]
+
+    async def _connect(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        host, port, use_ssl = key
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=use_ssl or None), self.connect_timeout)
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.pool_size:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _read_head(self, reader):
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.read_timeout)
+        lines = head.decode('latin-1').split("\r\n")
+        status = int(lines[0].split(" ", 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    async def _iter_body(self, reader, headers):
+        """Yields body chunks as they arrive. Returns normally only if the body ended cleanly."""
+        read = lambda coro: asyncio.wait_for(coro, self.read_timeout)
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await read(reader.readline())).split(b";")[0].strip(), 16)
+                if size == 0:
+                    # Skip trailers up to the final empty line
+                    while (await read(reader.readline())) not in (b"\r\n", b""):
+                        pass
+                    return
+                chunk = await read(reader.readexactly(size))
+                await read(reader.readexactly(2))
+                yield chunk
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining > 0:
+                chunk = await read(reader.read(min(remaining, 65536)))
+                if not chunk:
+                    raise ConnectionError("Backend closed the connection mid-response")
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await read(reader.read(65536))
+                if not chunk:
+                    return
+                yield chunk
+
+    async def stream_post(self, url, payload):
+        """POSTs JSON and yields the response body in chunks as they arrive.
+
+        Raises BackendHTTPError for a non-200 status.
+        """
+        parts = urlsplit(url)
+        use_ssl = parts.scheme == "https"
+        key = (parts.hostname, parts.port or (443 if use_ssl else 80), use_ssl)
+        body = json.dumps(payload).encode('utf-8')
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            "Content-Type: application/json\r\n"
+            "Accept: text/event-stream\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode('latin-1') + body
+
+        for attempt in range(2):
+            reader, writer, reused = await self._connect(key)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers = await self._read_head(reader)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                # A pooled connection may have been closed by the backend while idle
+                if not reused or attempt:
+                    raise ConnectionError(f"Backend connection failed: {e}") from e
+            except BaseException:
+                writer.close()
+                raise
+
+        reusable = headers.get('connection', '').lower() != 'close'
+        finished = False
+        try:
+            if status != 200:
+                raise BackendHTTPError(status)
+            async for chunk in self._iter_body(reader, headers):
+                yield chunk
+            finished = True
+        finally:
+            if finished and reusable and ('content-length' in headers or 'transfer-encoding' in headers):
+                self._release(key, reader, writer)
+            else:
+                writer.close()
+
+    async def stream_content_deltas(self, url, payload, indexed=False):
+        """Yields the content deltas of a streamed chat completion ((choice index,
+        content) pairs if indexed)."""
+        decoder = ContentDeltaDecoder(indexed)
+        async for chunk in self.stream_post(url, payload):
+            for content in decoder.feed(chunk):
+                yield content
+        for content in decoder.close():
+            yield content
+
+    async def stream_from_pool(self, pool, key, payload, indexed=False):
+        """Like stream_content_deltas, but picks a backend from the pool and fails over
+        to another one as long as no content has been received yet."""
+        tried = []
+        last_error = None
+        while True:
+            backend = pool.acquire(key, exclude=tried)
+            if backend is None:
+                raise NoBackendAvailable(f"No LLM backend available: {last_error}")
+            tried.append(backend)
+            started = False
+            try:
+                async for content in self.stream_content_deltas(backend.url, payload, indexed):
+                    started = True
+                    yield content
+                return
+            except BackendHTTPError as e:
+                if started or e.status not in (502, 503, 504) or len(tried) == len(pool.backends):
+                    raise
+                last_error = e
+            except (OSError, asyncio.TimeoutError) as e:
+                if started:
+                    raise
+                pool.mark_down(backend, e)
+                last_error = e
+            finally:
+                pool.release(backend)
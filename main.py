@@ -3,10 +3,22 @@ import json
 import requests
 import re
 import time
-import uuid
 import shutil
-from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
+import zlib
+import threading
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response
 from flask_cors import CORS
+from storage import ChatStore, CharacterRegistry, CHAT_SORT_KEYS
+from llm_client import create_session, iter_content_deltas, abort_response, BackendPool, NoBackendAvailable
+from context import message_tokens, select_context, PrefixTracker
+from scheduler import GenerationScheduler, SchedulerFull, PRIORITY_NEW, PRIORITY_REGENERATE
+from generations import GenerationRegistry, parse_last_event_id
+from search import SearchIndex, SearchError
+from summarizer import ChatSummarizer
+from uploads import UploadStore, UploadError
+from static_assets import StaticAssets, choose_encoding
+from archive import export_archive, import_archive, ArchiveError, EXPORT_FORMATS, CHUNK_SIZE
+from metrics import MetricsRegistry, RequestTimings, DISK_BUCKETS, RATE_BUCKETS
 
 # --- Basic Setup ---
 app = Flask(__name__, static_folder='.', static_url_path='')
@@ -14,12 +26,60 @@ CORS(app)
 
 # --- Configuration ---
 LM_STUDIO_API_URL = "http://localhost:1234/v1/chat/completions"
+LLM_BACKENDS = [LM_STUDIO_API_URL]  # OpenAI-compatible chat completion URLs; chats are spread across them
+if os.environ.get("LOCALAICHAT_BACKENDS"):  # Comma-separated override, e.g. for benchmark.py
+    LLM_BACKENDS = os.environ["LOCALAICHAT_BACKENDS"].split(",")
+LLM_HEALTH_CHECK_INTERVAL = 15  # Seconds between health probes of each backend
+LLM_POOL_SIZE = 16  # Keep-alive connections held open to each LLM backend
+LLM_CONNECT_TIMEOUT = 10  # Seconds to wait for the backend to accept a connection
+LLM_READ_TIMEOUT = 300  # Seconds to wait for the next bytes of a reply
+LLM_MAX_CONCURRENT = 4  # Generations sent to the backends at once; the rest wait in a queue
+LLM_MAX_QUEUED = 32  # Waiting generations; more than this are refused with 429
+LLM_MAX_QUEUED_PER_CHAT = 4  # Waiting generations per client and chat
+LLM_QUEUE_TIMEOUT = 120  # Seconds a generation may wait in the queue before giving up
+LLM_RETRY_AFTER = 5  # Retry-After seconds sent with a 429 when the queue is full
+LLM_MAX_CANDIDATES = 4  # Most alternative replies (n_candidates) one streamed request may ask for
+LLM_CANDIDATES_USE_N = False  # Ask for candidates with one `n` request instead of one request each (if the backend supports `n`)
+SSE_COALESCE_WINDOW = 0.05  # Seconds of content deltas merged into one SSE frame (0 sends them as they come)
+SSE_COALESCE_BYTES = 2048  # A frame goes out early once this much content is waiting
+SSE_KEEPALIVE_INTERVAL = 15  # Seconds between keep-alive comments on an idle stream
+STREAM_EVENT_BUFFER = 1024  # Events kept per generation for replay to reconnecting clients
+STREAM_RESUME_GRACE = 10  # Seconds a generation keeps running without a client before it is cancelled
+STREAM_RETAIN = 120  # Seconds a finished generation can still be replayed
+MAX_CONTEXT_TOKENS = 8192  # Context window of the loaded model; older messages are dropped to fit
+RESPONSE_TOKEN_RESERVE = 1024  # Part of the context window kept free for the reply
+CONTEXT_TRIM_BLOCK = 16  # Old messages are dropped this many at a time so the prompt prefix stays cacheable
+LLM_CACHE_PROMPT = True  # Ask llama.cpp-style backends to reuse their KV cache for a matching prefix
+LLM_SLOT_COUNT = 0  # Number of llama.cpp server slots (--parallel); >0 pins each chat to one slot
+SUMMARY_ENABLED = False  # Fold the older messages of long chats into a rolling summary while the backend is idle
+SUMMARY_TRIGGER_MESSAGES = 60  # Chats shorter than this are never summarized
+SUMMARY_KEEP_RECENT = 30  # The newest messages always go to the backend verbatim
+SUMMARY_MAX_SEGMENT = 40  # Messages folded into the summary per backend request
+SUMMARY_IDLE_SECONDS = 30  # A chat must have been idle this long before it is summarized
+SUMMARY_MAX_TOKENS = 512  # Length limit for a summary
+CHAT_WRITE_DELAY = 0.05  # Seconds chat writes are held so a burst goes to disk as one write (0 writes immediately)
+CHAT_FSYNC = 'interval'  # 'always' fsyncs every chat write, 'interval' every CHAT_FSYNC_INTERVAL seconds, 'never' leaves it to the OS
+CHAT_FSYNC_INTERVAL = 5
+HISTORY_PAGE_SIZE = 50  # Messages per page when the history is requested with ?limit/?before
+CHAT_LIST_PAGE_SIZE = 50  # Chats per page when the chat list is requested with ?limit/?offset
+SEARCH_PAGE_SIZE = 20  # Hits per page from /api/search
+SEARCH_MAX_PAGE_SIZE = 200
+UPLOAD_MAX_BYTES = 10 * 1024 * 1024  # Largest image /api/upload-image accepts
+UPLOAD_THUMBNAIL_SIZES = (96, 256)  # Pixel sizes made for each upload and served with ?size= (needs Pillow)
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600  # Uploads are named by content hash, so browsers can keep them for good
+STATIC_ASSETS = ["data/tailwind.min.css", "data/marked.min.js", "data/purify.min.js"]  # Served fingerprinted and precompressed
+STATIC_CACHE_MAX_AGE = 365 * 24 * 3600
+IMPORT_MAX_BYTES = 1024 * 1024 * 1024  # Largest archive /api/import accepts
+IMPORT_MAX_UNPACKED_BYTES = 4 * 1024 * 1024 * 1024  # Most chat log data one import may unpack to
+SERVER_TIMING = True  # Send a Server-Timing header with the per-stage breakdown of chat requests
 
 # --- Data Storage Setup ---
-DATA_DIR = "data"
+DATA_DIR = os.environ.get("LOCALAICHAT_DATA_DIR", "data")
 CHARACTERS_DIR = os.path.join(DATA_DIR, "characters")
 CHATS_DIR = os.path.join(DATA_DIR, "chats")
 UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+SEARCH_DB = os.path.join(DATA_DIR, "search.db")
+STATIC_CACHE_DIR = os.path.join(DATA_DIR, ".static")
 
 # Ensure directories exist
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -27,30 +87,119 @@ os.makedirs(CHARACTERS_DIR, exist_ok=True)
 os.makedirs(CHATS_DIR, exist_ok=True)
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
+static_assets = StaticAssets('.', 'index.html', STATIC_ASSETS, STATIC_CACHE_DIR)
+static_assets.build()
+upload_store = UploadStore(UPLOADS_DIR, UPLOAD_MAX_BYTES, UPLOAD_THUMBNAIL_SIZES)
+search_index = SearchIndex(SEARCH_DB)
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram("localaichat_chat_stage_seconds", "Time chat requests spent in each stage", labels=("stage",))
+ttft_seconds = metrics.histogram("localaichat_time_to_first_token_seconds", "Time from a streamed chat request to its first token")
+tokens_per_second = metrics.histogram("localaichat_tokens_per_second", "Streaming rate of each reply (content deltas, about one per token)", RATE_BUCKETS)
+queue_wait_seconds = metrics.histogram("localaichat_queue_wait_seconds", "Time chat requests waited for a generation slot")
+disk_io_seconds = metrics.histogram("localaichat_disk_io_seconds", "Time spent reading and writing chat logs", DISK_BUCKETS, labels=("op",))
+chat_requests = metrics.counter("localaichat_chat_requests_total", "Chat requests by endpoint and outcome", labels=("endpoint", "outcome"))
+chat_store = ChatStore(CHATS_DIR, CHAT_WRITE_DELAY, CHAT_FSYNC, CHAT_FSYNC_INTERVAL, search_index, disk_io_seconds)
+chat_store.start_background_writer()
+chat_store.start_background_compaction()
+chat_store.start_search_sync()
+character_registry = CharacterRegistry(CHARACTERS_DIR)
+character_registry.list()  # Warm the cache at startup
+llm_session = create_session(LLM_POOL_SIZE, len(LLM_BACKENDS))
+backend_pool = BackendPool(LLM_BACKENDS)
+backend_pool.start_health_checks(LLM_HEALTH_CHECK_INTERVAL)
+prefix_tracker = PrefixTracker()
+generation_scheduler = GenerationScheduler(LLM_MAX_CONCURRENT, LLM_MAX_QUEUED, LLM_MAX_QUEUED_PER_CHAT)
+generation_registry = GenerationRegistry(STREAM_EVENT_BUFFER, STREAM_RESUME_GRACE, STREAM_RETAIN)
+metrics.gauge("localaichat_generations_running", "Generation slots in use", lambda: generation_scheduler.status()['running'])
+metrics.gauge("localaichat_generations_queued", "Generation slots waited for", lambda: generation_scheduler.status()['queued'])
+metrics.gauge("localaichat_streams_active", "Streamed replies still generating", lambda: len(generation_registry.active()))
+
 # --- Helper Functions ---
 def sanitize_filename(name):
     """Removes special characters to create a valid filename."""
     return re.sub(r'[^a-zA-Z0-9_-]', '', name.replace(' ', '_')).lower()
 
+# --- Rolling Summaries ---
+
+def summarize_messages(character_id, chat_id, previous_summary, messages, ticket):
+    """Asks the backend for a summary of messages, continuing previous_summary.
+
+    The reply is streamed so a live request preempting the ticket can abort it midway.
+    """
+    character = character_registry.get(character_id) or {}
+    name = character.get('name', 'the character')
+    transcript = "\n\n".join(
+        f"{name if m.get('role') == 'assistant' else 'User'}: {m.get('content')}"
+        for m in messages if isinstance(m.get('content'), str))
+    prompt = "Summarize this conversation"
+    if previous_summary:
+        prompt = f"Here is a summary of the conversation so far:\n\n{previous_summary}\n\nUpdate it to also cover how the conversation continued"
+    prompt += (f":\n\n{transcript}\n\nWrite a concise summary in the past tense. Keep names, facts, decisions "
+               "and open threads that matter for continuing the conversation. Reply with the summary only.")
+    payload = {
+        "model": "local-model",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.3,
+        "max_tokens": SUMMARY_MAX_TOKENS,
+        "stream": True,
+    }
+    backend, response = backend_pool.post(llm_session, f"{character_id}/{chat_id}", payload,
+                                          stream=True, timeout=(LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT))
+    ticket.on_preempt(lambda: abort_response(response))
+    try:
+        with response:
+            response.raise_for_status()
+            summary = "".join(iter_content_deltas(response)).strip()
+    except (requests.exceptions.RequestException, OSError):
+        if ticket.preempted.is_set():
+            return None
+        raise
+    finally:
+        backend_pool.release(backend)
+    return None if ticket.preempted.is_set() else summary
+
+summarizer = ChatSummarizer(chat_store, generation_scheduler, summarize_messages, SUMMARY_TRIGGER_MESSAGES,
+                            SUMMARY_KEEP_RECENT, SUMMARY_MAX_SEGMENT, SUMMARY_IDLE_SECONDS)
+if SUMMARY_ENABLED:
+    summarizer.start()
+
 # --- API Routes ---
 
+def send_static_asset(asset, max_age):
+    """Sends the best precompressed copy of a built asset; If-None-Match gets a 304."""
+    encoding = choose_encoding(asset, request.accept_encodings)
+    response = send_file(asset['files'][encoding], mimetype=asset['mimetype'],
+                         etag=f"{asset['hash']}-{encoding}", max_age=max_age)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/')
 def serve_index():
-    return send_from_directory('.', 'index.html')
+    response = send_static_asset(static_assets.index(), 0)
+    response.cache_control.no_cache = True  # Revalidate every load, so new asset URLs are picked up
+    return response
+
+@app.route('/assets/<name>')
+def serve_static_asset(name):
+    asset = static_assets.asset(name)
+    if asset is None:
+        return jsonify({"error": "File not found"}), 404
+    response = send_static_asset(asset, STATIC_CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
 
 # --- Character Management ---
 
 @app.route('/api/characters', methods=['GET'])
 def get_characters():
-    characters = []
-    for filename in sorted(os.listdir(CHARACTERS_DIR)):
-        if filename.endswith(".json"):
-            try:
-                with open(os.path.join(CHARACTERS_DIR, filename), 'r', encoding='utf-8') as f:
-                    characters.append(json.load(f))
-            except (IOError, json.JSONDecodeError) as e:
-                print(f"Error reading character file {filename}: {e}")
-    return jsonify(characters)
+    characters, etag = character_registry.list()
+    response = jsonify(characters)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Browsers revalidate with If-None-Match on every poll
+    # Answers 304 when the client's If-None-Match still matches
+    return response.make_conditional(request)
 
 @app.route('/api/characters', methods=['POST'])
 def create_character():
@@ -76,8 +225,7 @@ def create_character():
     }
 
     try:
-        with open(character_filepath, 'w', encoding='utf-8') as f:
-            json.dump(character_data, f, indent=4)
+        character_registry.save(character_data)
         os.makedirs(os.path.join(CHATS_DIR, character_id), exist_ok=True)
     except IOError as e:
         return jsonify({"error": f"Failed to save character data: {e}"}), 500
@@ -94,23 +242,18 @@ def update_character(character_id):
     if not name or not description:
         return jsonify({"error": "Name and description are required"}), 400
 
-    character_filepath = os.path.join(CHARACTERS_DIR, f"{character_id}.json")
-    
-    if not os.path.exists(character_filepath):
+    character_data = character_registry.get(character_id)
+    if character_data is None:
         return jsonify({"error": "Character not found"}), 404
 
     try:
-        with open(character_filepath, 'r', encoding='utf-8') as f:
-            character_data = json.load(f)
-        
         character_data['name'] = name
         character_data['description'] = description
         character_data['avatar_url'] = avatar_url
         
-        with open(character_filepath, 'w', encoding='utf-8') as f:
-            json.dump(character_data, f, indent=4)
+        character_registry.save(character_data)
             
-    except (IOError, json.JSONDecodeError) as e:
+    except IOError as e:
         return jsonify({"error": f"Failed to update character data: {e}"}), 500
 
     return jsonify(character_data), 200
@@ -118,13 +261,12 @@ def update_character(character_id):
 @app.route('/api/characters/<character_id>', methods=['DELETE'])
 def delete_character(character_id):
     try:
-        character_filepath = os.path.join(CHARACTERS_DIR, f"{character_id}.json")
-        if os.path.exists(character_filepath):
-            os.remove(character_filepath)
+        character_registry.remove(character_id)
         
         char_chat_dir = os.path.join(CHATS_DIR, character_id)
         if os.path.isdir(char_chat_dir):
             shutil.rmtree(char_chat_dir)
+        chat_store.delete_character(character_id)
         
         return jsonify({"success": True})
     except Exception as e:
@@ -134,28 +276,35 @@ def delete_character(character_id):
 
 @app.route('/api/characters/<character_id>/chats', methods=['GET'])
 def get_character_chats(character_id):
-    """Lists all chat sessions for a character, sorted by newest first."""
-    char_chat_dir = os.path.join(CHATS_DIR, character_id)
-    if not os.path.isdir(char_chat_dir):
-        return jsonify([])
-    
-    chat_files = [f for f in os.listdir(char_chat_dir) if f.endswith('.json')]
-    chat_files.sort(key=lambda x: int(os.path.splitext(x)[0]), reverse=True)
-    
-    return jsonify([os.path.splitext(f)[0] for f in chat_files])
+    """Lists all chat sessions for a character, sorted by newest first.
+
+    Plain requests get the bare chat ids. With ?sort=created|updated|message_count|size,
+    ?order=asc|desc, ?offset= or ?limit= a page of chat metadata (message count,
+    created/updated times, last-message preview, size) is returned along with the total.
+    """
+    args = request.args
+    if not any(key in args for key in ('sort', 'order', 'offset', 'limit')):
+        chats, _ = chat_store.list_chats(character_id)
+        return jsonify([chat['chat_id'] for chat in chats])
+
+    sort = args.get('sort', 'created')
+    order = args.get('order', 'desc')
+    if sort not in CHAT_SORT_KEYS or order not in ('asc', 'desc'):
+        return jsonify({"error": f"sort must be one of {', '.join(CHAT_SORT_KEYS)} and order asc or desc"}), 400
+    try:
+        offset = max(0, int(args.get('offset', 0)))
+        limit = max(0, int(args.get('limit', CHAT_LIST_PAGE_SIZE)))
+    except ValueError:
+        return jsonify({"error": "Pagination parameters must be integers"}), 400
+
+    chats, total = chat_store.list_chats(character_id, sort, order == 'desc', offset, limit)
+    return jsonify({"chats": chats, "offset": offset, "total": total})
 
 @app.route('/api/characters/<character_id>/chats', methods=['POST'])
 def create_new_chat(character_id):
-    """Creates a new, empty chat file for a character."""
-    char_chat_dir = os.path.join(CHATS_DIR, character_id)
-    os.makedirs(char_chat_dir, exist_ok=True)
-    
-    chat_id = str(int(time.time()))
-    chat_filepath = os.path.join(char_chat_dir, f"{chat_id}.json")
-
+    """Creates a new, empty chat log for a character."""
     try:
-        with open(chat_filepath, 'w', encoding='utf-8') as f:
-            json.dump([], f)
+        chat_id = chat_store.create_chat(character_id)
     except IOError as e:
         return jsonify({"error": f"Could not create new chat file: {e}"}), 500
         
@@ -163,22 +312,41 @@ def create_new_chat(character_id):
 
 @app.route('/api/chats/<character_id>/<chat_id>', methods=['GET'])
 def get_chat_history(character_id, chat_id):
-    """Gets the history for a specific chat session."""
-    chat_filepath = os.path.join(CHATS_DIR, character_id, f"{chat_id}.json")
-    if not os.path.exists(chat_filepath):
+    """Gets the history for a specific chat session.
+
+    With ?before=&limit= (the page ending before a message index) or ?from=&to= (an
+    index range) only that slice is read and returned along with its position.
+    """
+    if not chat_store.exists(character_id, chat_id):
         return jsonify({"error": "Chat history not found"}), 404
+
+    args = request.args
+    try:
+        if not any(key in args for key in ('before', 'limit', 'from', 'to')):
+            return jsonify(chat_store.read_history(character_id, chat_id))
+
+        total = chat_store.count(character_id, chat_id)
+        if 'from' in args or 'to' in args:
+            start = int(args.get('from', 0))
+            end = int(args.get('to', total))
+        else:
+            end = int(args.get('before', total))
+            start = end - int(args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Pagination parameters must be integers"}), 400
+
+    start = max(0, start)
+    end = min(max(start, end), total)
     try:
-        with open(chat_filepath, 'r', encoding='utf-8') as f:
-            return jsonify(json.load(f))
+        messages, total = chat_store.read_range(character_id, chat_id, start, end)
     except (IOError, json.JSONDecodeError) as e:
         return jsonify({"error": f"Failed to read chat history: {e}"}), 500
+    return jsonify({"messages": messages, "start": start, "end": start + len(messages), "total": total})
 
 @app.route('/api/characters/<character_id>/chats/<chat_id>', methods=['DELETE'])
 def delete_chat(character_id, chat_id):
     try:
-        chat_filepath = os.path.join(CHATS_DIR, character_id, f"{chat_id}.json")
-        if os.path.exists(chat_filepath):
-            os.remove(chat_filepath)
+        if chat_store.delete_chat(character_id, chat_id):
             return jsonify({"success": True})
         return jsonify({"error": "Chat not found"}), 404
     except Exception as e:
@@ -193,24 +361,21 @@ def delete_message(character_id, chat_id):
     if message_index is None:
         return jsonify({"error": "Message index is required"}), 400
 
-    chat_filepath = os.path.join(CHATS_DIR, character_id, f"{chat_id}.json")
-    if not os.path.exists(chat_filepath):
+    if not chat_store.exists(character_id, chat_id):
         return jsonify({"error": "Chat not found"}), 404
 
     try:
-        with open(chat_filepath, 'r', encoding='utf-8') as f:
-            history = json.load(f)
+        # Hold the chat's lock so the index can't shift between the check and the delete
+        with chat_store.chat_lock(character_id, chat_id):
+            total = chat_store.count(character_id, chat_id)
 
-        if 0 <= message_index < len(history):
-            # Simply delete the specific message without any additional logic
-            del history[message_index]
-        else:
-            return jsonify({"error": "Invalid message index"}), 400
-
-        with open(chat_filepath, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=4)
+            if 0 <= message_index < total:
+                # Simply delete the specific message without any additional logic
+                chat_store.delete_message(character_id, chat_id, message_index)
+            else:
+                return jsonify({"error": "Invalid message index"}), 400
         
-        return jsonify({"success": True, "new_history": history})
+        return jsonify({"success": True, "total": total - 1})
 
     except (IOError, json.JSONDecodeError) as e:
         return jsonify({"error": f"Failed to update chat history: {e}"}), 500
@@ -221,27 +386,38 @@ def update_message(character_id, chat_id):
     data = request.json
     message_index = data.get('index')
     content = data.get('content')
+    pinned = data.get('pinned') # Pinned messages are kept in the prompt when older ones are dropped
+    selected = data.get('selected') # Which of a reply's candidates is shown and sent to the backend
 
-    if message_index is None or content is None:
-        return jsonify({"error": "Message index and content are required"}), 400
+    if message_index is None or (content is None and pinned is None and selected is None):
+        return jsonify({"error": "Message index and content, pinned or selected are required"}), 400
 
-    chat_filepath = os.path.join(CHATS_DIR, character_id, f"{chat_id}.json")
-    if not os.path.exists(chat_filepath):
+    if not chat_store.exists(character_id, chat_id):
         return jsonify({"error": "Chat not found"}), 404
 
     try:
-        with open(chat_filepath, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-
-        if 0 <= message_index < len(history):
-            history[message_index]['content'] = content
-        else:
-            return jsonify({"error": "Invalid message index"}), 400
-
-        with open(chat_filepath, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=4)
+        # Read-modify-write under the chat's lock, so a reply saved meanwhile can't be lost
+        with chat_store.chat_lock(character_id, chat_id):
+            if 0 <= message_index < chat_store.count(character_id, chat_id):
+                message = chat_store.read_message(character_id, chat_id, message_index)
+                if selected is not None:
+                    candidates = message.get('candidates') or []
+                    if not isinstance(selected, int) or not 0 <= selected < len(candidates):
+                        return jsonify({"error": "Invalid candidate index"}), 400
+                    message['selected'] = selected
+                    message['content'] = candidates[selected]
+                if content is not None:
+                    message['content'] = content
+                    message.pop('truncated', None)  # An edited reply is no longer a cut-off one
+                    if message.get('candidates'):
+                        message['candidates'][message.get('selected', 0)] = content
+                if pinned is not None:
+                    message['pinned'] = bool(pinned)
+                chat_store.set_message(character_id, chat_id, message_index, message)
+            else:
+                return jsonify({"error": "Invalid message index"}), 400
         
-        return jsonify({"success": True, "new_history": history})
+        return jsonify({"success": True, "message": message})
 
     except (IOError, json.JSONDecodeError) as e:
         return jsonify({"error": f"Failed to update chat history: {e}"}), 500
@@ -255,80 +431,170 @@ def add_message(character_id, chat_id):
     if not role or not content:
         return jsonify({"error": "Role and content are required"}), 400
 
-    chat_filepath = os.path.join(CHATS_DIR, character_id, f"{chat_id}.json")
-    if not os.path.exists(chat_filepath):
+    if not chat_store.exists(character_id, chat_id):
         return jsonify({"error": "Chat not found"}), 404
 
     try:
-        with open(chat_filepath, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-
-        history.append({"role": role, "content": content})
-
-        with open(chat_filepath, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=4)
+        chat_store.append_messages(character_id, chat_id, [{"role": role, "content": content}])
+        summarizer.note_activity(character_id, chat_id)
         
-        return jsonify({"success": True, "new_history": history})
+        return jsonify({"success": True})
 
     except (IOError, json.JSONDecodeError) as e:
         return jsonify({"error": f"Failed to update chat history: {e}"}), 500
 
-# --- Streaming Chat Endpoint ---
-# --- Streaming Chat Endpoint ---
+# --- Search ---
 
-@app.route('/api/chat/stream', methods=['POST'])
-def handle_streaming_chat():
-    data = request.json
+@app.route('/api/search', methods=['GET'])
+def search_messages():
+    """Full-text search over all chats, best matches first.
+
+    ?q= is the query (every word must match; `word*` matches a prefix). Optional
+    ?character_id= and ?chat_id= narrow it down, ?limit= and ?offset= page through hits.
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Missing search query"}), 400
+    try:
+        limit = min(max(1, int(request.args.get('limit', SEARCH_PAGE_SIZE))), SEARCH_MAX_PAGE_SIZE)
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({"error": "Pagination parameters must be integers"}), 400
+
+    chat_store.flush_all()  # Include writes still queued
+    try:
+        hits, took_ms = search_index.search(query, limit, offset,
+                                            request.args.get('character_id'), request.args.get('chat_id'))
+    except SearchError as e:
+        return jsonify({"error": f"Search failed: {e}"}), 400
+    return jsonify({
+        "query": query,
+        "hits": hits,
+        "offset": offset,
+        "took_ms": round(took_ms, 2),
+        "indexing": search_index.syncing,
+    })
+
+# --- Chat Turn Helpers ---
+# Shared by the Flask endpoints below and the async server in asgi.py.
+
+def sse_event(payload, event_id=None):
+    if event_id is None:
+        return f"data: {json.dumps(payload)}\n\n"
+    return f"id: {event_id}\ndata: {json.dumps(payload)}\n\n"
+
+def build_system_prompt(character, user_persona, mode):
+    """Builds the system prompt. It must come out byte-identical for every turn of a chat
+    (same character, persona and mode) so the backend can reuse its cached prefix."""
+    system_prompt = (
+        f"This is a conversation between you, {character['name']}, and a user. "
+        f"Your persona: {character['description']}. "
+        f"The user's persona: {user_persona}. "
+    )
+    if mode == 'chat':
+        system_prompt += "Respond naturally and conversationally as your character. Stay in character at all times."
+    else:
+        system_prompt += "You are in instruct mode. Follow the user's instructions precisely while embodying your character's personality."
+    return system_prompt
+
+def prepare_chat_turn(data, stream=True):
+    """Validates a chat request, loads its history and builds the backend payload.
+
+    Returns (turn, None), or (None, (error_body, status)) if the request can't be served.
+    """
+    timings = RequestTimings()
     character_id = data.get('character_id')
     chat_id = data.get('chat_id')
     user_message = data.get('message')
     history_override = data.get('history_override') # Get history_override from frontend
+    regenerate_index = data.get('regenerate_index') # Or just the index to regenerate; history is read up to it
+    n_candidates = data.get('n_candidates', 1) # Alternative replies generated side by side
     mode = data.get('mode', 'chat')
     user_persona = data.get('user_persona', 'The user you are talking to.')
     llm_settings = data.get('llm_settings', {})
-    system_prompt = data.get('system_prompt', '') # Get system prompt from frontend if sent, otherwise build it
 
     if not all([character_id, chat_id, user_message]):
-        return jsonify({"error": "Character ID, Chat ID, and message are required"}), 400
-
-    try:
-        with open(os.path.join(CHARACTERS_DIR, f"{character_id}.json"), 'r', encoding='utf-8') as f:
-            character = json.load(f)
-    except FileNotFoundError:
-        return jsonify({"error": "Character data not found."}), 404
+        return None, ({"error": "Character ID, Chat ID, and message are required"}, 400)
+    if regenerate_index is not None and not isinstance(regenerate_index, int):
+        return None, ({"error": "regenerate_index must be an integer"}, 400)
+    if not isinstance(n_candidates, int) or not 1 <= n_candidates <= LLM_MAX_CANDIDATES:
+        return None, ({"error": f"n_candidates must be between 1 and {LLM_MAX_CANDIDATES}"}, 400)
+    if not isinstance(llm_settings, dict):
+        return None, ({"error": "llm_settings must be an object"}, 400)
+    if history_override is not None and (not isinstance(history_override, list)
+                                         or not all(isinstance(m, dict) for m in history_override)):
+        return None, ({"error": "history_override must be a list of messages"}, 400)
+    max_context_tokens = llm_settings.get('max_context_tokens', MAX_CONTEXT_TOKENS)
+    if not isinstance(max_context_tokens, int) or isinstance(max_context_tokens, bool) or max_context_tokens <= 0:
+        return None, ({"error": "max_context_tokens must be a positive integer"}, 400)
+
+    character = character_registry.get(character_id)
+    if character is None:
+        return None, ({"error": "Character data not found."}, 404)
+
+    # Always built here, never taken from the client, so it stays byte-identical across turns
+    system_prompt = build_system_prompt(character, user_persona, mode)
+
+    # The system prompt, the new message and room for the reply always fit; history gets the rest
+    token_budget = (max_context_tokens - RESPONSE_TOKEN_RESERVE
+                    - message_tokens({"content": system_prompt}) - message_tokens({"content": user_message}))
+    timings.mark('prompt')
+
+    # Older messages of a long chat may be covered by a rolling summary instead
+    summary = None
+    if SUMMARY_ENABLED and history_override is None and chat_store.exists(character_id, chat_id):
+        summary = chat_store.read_summary(character_id, chat_id)
+        if summary and regenerate_index is not None and summary['end'] > regenerate_index:
+            summary = None  # It covers the message being regenerated
+    summary_message = None
+    if summary:
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary['summary']}"}
+        token_budget -= message_tokens(summary_message)
+    summary_end = summary['end'] if summary else 0
 
     # Determine history source
-    if history_override is not None:
+    if regenerate_index is not None:
+        # Regenerate from the stored history, so the frontend doesn't need the whole chat loaded
+        try:
+            total = chat_store.count(character_id, chat_id)
+            if not 0 <= regenerate_index < total:
+                return None, ({"error": f"regenerate_index {regenerate_index} is out of range for a chat of {total} messages"}, 400)
+            history, dropped = chat_store.read_context(character_id, chat_id, regenerate_index, token_budget,
+                                                       CONTEXT_TRIM_BLOCK, summary_end)
+        except FileNotFoundError:
+            return None, ({"error": "Chat history not found."}, 404)
+        print(f"Regenerating: Using stored history. New message index will be {regenerate_index}")
+    elif history_override is not None:
         # Use the history provided by the frontend (for regeneration)
-        history = history_override
+        chosen = select_context([message_tokens(m) for m in history_override],
+                                [bool(m.get('pinned')) for m in history_override], token_budget, CONTEXT_TRIM_BLOCK)
+        history = [history_override[i] for i in chosen]
+        dropped = len(history_override) - len(chosen)
         regenerate_index = len(history_override) # The index where the new AI response will go
         print(f"Regenerating: Using history_override. New message index will be {regenerate_index}")
     else:
-        # Load history from file (normal chat)
-        chat_filepath = os.path.join(CHATS_DIR, character_id, f"{chat_id}.json")
+        # Load history from the chat log (normal chat)
         try:
-            with open(chat_filepath, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            regenerate_index = None # Not regenerating
-            print(f"Normal chat: Loaded history from {chat_filepath}")
+            history, dropped = chat_store.read_context(character_id, chat_id, None, token_budget,
+                                                       CONTEXT_TRIM_BLOCK, summary_end)
+            print(f"Normal chat: Loaded history for {character_id}/{chat_id}")
         except FileNotFoundError:
-            return jsonify({"error": "Chat history not found."}), 404
-
-    # Build the system prompt if not provided explicitly (e.g., for regeneration where it's context-dependent)
-    if not system_prompt:
-        system_prompt = (
-            f"This is a conversation between you, {character['name']}, and a user. "
-            f"Your persona: {character['description']}. "
-            f"The user's persona: {user_persona}. "
-        )
-        if mode == 'chat':
-            system_prompt += "Respond naturally and conversationally as your character. Stay in character at all times."
-        else:
-            system_prompt += "You are in instruct mode. Follow the user's instructions precisely while embodying your character's personality."
+            return None, ({"error": "Chat history not found."}, 404)
+    timings.mark('history')
+    if dropped:
+        print(f"Context: Left out {dropped} older message(s) to fit {max_context_tokens} tokens")
+    if summary_end:
+        print(f"Context: Messages before {summary_end} are covered by the chat summary")
 
     messages_for_api = [{"role": "system", "content": system_prompt}]
-    messages_for_api.extend(history)
-    messages_for_api.append({"role": "user", "content": user_message})
+    if summary_message:
+        messages_for_api.append(summary_message)
+    # Only role and content go to the backend; flags like "pinned" stay local
+    messages_for_api.extend({"role": m.get('role'), "content": m.get('content')} for m in history)
+    # When regenerating, the history already ends with the user message being answered
+    last = history[-1] if history else {}
+    if regenerate_index is None or last.get('role') != 'user' or last.get('content') != user_message:
+        messages_for_api.append({"role": "user", "content": user_message})
 
     api_payload = {
         "model": "local-model",
@@ -336,184 +602,440 @@ def handle_streaming_chat():
         "temperature": llm_settings.get('temperature', 0.7),
         "repeat_penalty": llm_settings.get('repetition_penalty', 1.1),
         "top_p": llm_settings.get('min_p', 0.95),
-        "stream": True
+        "stream": stream
+    }
+    if LLM_CACHE_PROMPT:
+        api_payload["cache_prompt"] = True
+    if LLM_SLOT_COUNT > 0:
+        # A stable per-chat slot keeps this chat's prompt cache warm between turns
+        api_payload["id_slot"] = zlib.crc32(f"{character_id}/{chat_id}".encode('utf-8')) % LLM_SLOT_COUNT
+    prefix_tracker.record((character_id, chat_id), messages_for_api)
+    timings.mark('prompt')
+
+    turn = {
+        "character_id": character_id,
+        "chat_id": chat_id,
+        "user_message": user_message,
+        "regenerate_index": regenerate_index,
+        "history_override": history_override is not None,
+        "backend_key": f"{character_id}/{chat_id}",
+        "payload": api_payload,
+        "n_candidates": n_candidates,
+        "timings": timings,
     }
+    return turn, None
+
+def candidate_request(turn, index):
+    """Returns (payload, backend key) for one candidate of a multi-candidate turn.
+
+    Candidate 0 goes where a single reply would. The others get routing keys of their
+    own, so a pool of several backends spreads them out, and aren't pinned to the
+    chat's slot.
+    """
+    if index == 0:
+        return turn['payload'], turn['backend_key']
+    payload = dict(turn['payload'])
+    payload.pop('id_slot', None)
+    return payload, f"{turn['backend_key']}#{index}"
+
+def schedule_turn(turn, client):
+    """Queues a turn for a generation slot. Raises SchedulerFull if the queue is full.
+
+    A turn with several candidates takes one slot per candidate.
+    """
+    priority = PRIORITY_NEW if turn['regenerate_index'] is None else PRIORITY_REGENERATE
+    return generation_scheduler.submit(f"{client}|{turn['backend_key']}", priority, turn['n_candidates'])
+
+def wait_for_slot(ticket, generation):
+    """Publishes `queued` events with the ticket's queue position until it may run.
+
+    Returns early if the generation is cancelled while waiting.
+    """
+    position = None
+    deadline = time.monotonic() + LLM_QUEUE_TIMEOUT
+    while not ticket.wait(0.5 if position is not None else 0):
+        if generation.cancelled.is_set():
+            return
+        if ticket.position != position:
+            position = ticket.position
+            generation.publish({'type': 'queued', 'position': position})
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for a free generation slot")
+
+def record_turn_metrics(turn, endpoint, outcome):
+    """Adds a finished chat request's stage timings to the metrics."""
+    timings = turn['timings']
+    for stage, seconds in timings.stages.items():
+        stage_seconds.observe(seconds, stage=stage)
+    if 'queue' in timings.stages:
+        queue_wait_seconds.observe(timings.stages['queue'])
+    if timings.first_token is not None:
+        ttft_seconds.observe(timings.first_token)
+    rate = timings.tokens_per_second()
+    if rate is not None:
+        tokens_per_second.observe(rate)
+    chat_requests.inc(endpoint=endpoint, outcome=outcome)
+
+def build_reply(full_content, truncated=False):
+    """The assistant message for a reply, or for a list of candidate replies.
+
+    With candidates, all of them are kept and `selected` points at the one shown (and
+    sent to the backend) as the message content: the first that isn't empty.
+    """
+    if isinstance(full_content, list):
+        selected = next((i for i, content in enumerate(full_content) if content), 0)
+        reply = {"role": "assistant", "content": full_content[selected],
+                 "candidates": full_content, "selected": selected}
+    else:
+        reply = {"role": "assistant", "content": full_content}
+    if truncated:
+        reply["truncated"] = True
+    return reply
+
+def save_reply(turn, full_content, truncated=False):
+    """Saves a finished reply: replaces the regenerated message or appends the new turn.
+
+    full_content is the reply, or a list of candidate replies. A reply cut short by a
+    cancel or disconnect is saved with a `truncated` flag.
+    """
+    character_id, chat_id = turn['character_id'], turn['chat_id']
+    regenerate_index = turn['regenerate_index']
+    reply = build_reply(full_content, truncated)
+
+    with chat_store.chat_lock(character_id, chat_id):
+        if regenerate_index is not None:
+            # We are regenerating, so check the CURRENT chat history before updating it
+            current_length = chat_store.count(character_id, chat_id)
+            print(f"Regenerating: Loaded current chat history, length: {current_length}")
+            print(f"Regenerating: Attempting to replace message at index {regenerate_index}")
+            # Replace the message at the specific index with the new content
+            # Ensure the index is valid within the current chat history
+            if 0 <= regenerate_index < current_length:
+                # Assuming the regenerated message should be an assistant message
+                chat_store.set_message(character_id, chat_id, regenerate_index, reply)
+                print(f"Regenerating: Successfully replaced message at index {regenerate_index}")
+            else:
+                print(f"Regenerating: Index {regenerate_index} is out of bounds for current chat history.")
+                # For now, just append if index is invalid
+                chat_store.append_messages(character_id, chat_id, [reply])
+            print(f"Regenerating: Saved updated history for {character_id}/{chat_id}")
+        else:
+            # Normal chat, append user and assistant messages to the history
+            chat_store.append_messages(character_id, chat_id, [
+                {"role": "user", "content": turn['user_message']},
+                reply,
+            ])
+            print(f"Normal chat: Saved updated history for {character_id}/{chat_id}")
+    summarizer.note_activity(character_id, chat_id)
+
+def save_partial_reply(turn, partial_content):
+    """Saves what was generated before a cancel or disconnect.
+
+    With nothing generated, a regenerated message is left alone and a new turn keeps
+    just the user's message.
+    """
+    generated = "".join(partial_content) if isinstance(partial_content, list) else partial_content
+    if generated:
+        save_reply(turn, partial_content, truncated=True)
+    elif turn['regenerate_index'] is None:
+        chat_store.append_messages(turn['character_id'], turn['chat_id'], [{"role": "user", "content": turn['user_message']}])
+    print(f"Cancelled generation for {turn['character_id']}/{turn['chat_id']} after {len(generated)} characters")
 
-    def generate():
-        try:
-            response = requests.post(
-                LM_STUDIO_API_URL,
-                json=api_payload,
-                stream=True,
-                timeout=300
-            )
+# --- Streaming Chat Endpoint ---
 
+def stream_request(generation, chunks, payload, key, candidate=None, timings=None):
+    """Streams one backend request into chunks, publishing its deltas.
+
+    candidate tags the deltas with a candidate index; 'n' reads a request for several
+    choices and tags each delta with its choice index. Each delta is counted in timings.
+    Returns an error message if the backend refused the request.
+    """
+    backend, response = backend_pool.post(
+        llm_session, key, payload,
+        stream=True, timeout=(LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT))
+    generation.on_cancel(lambda: abort_response(response))
+    try:
+        with response:
             if response.status_code != 200:
-                yield f"data: {json.dumps({'type': 'error', 'content': f'API Error: {response.status_code}'})}\n\n"
-                return
-
-            full_content = ""
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data: "):
-                            data_json = decoded_line[6:]
-
-                            if data_json == '[DONE]':
-                                break
-
-                            chunk_data = json.loads(data_json)
-                            content = chunk_data.get('choices', [{}])[0].get('delta', {}).get('content', '')
-
-                            if content:
-                                full_content += content
-                                yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
-
-                    except Exception as e:
-                        print(f"Error processing streaming data: {e}")
-
-            # --- POST-STREAMING LOGIC ---
-            chat_filepath = os.path.join(CHATS_DIR, character_id, f"{chat_id}.json")
-
-            if regenerate_index is not None:
-                # We are regenerating, so load the CURRENT file history to update it
-                try:
-                    with open(chat_filepath, 'r', encoding='utf-8') as f:
-                        current_file_history = json.load(f)
-                    print(f"Regenerating: Loaded current file history, length: {len(current_file_history)}")
-                    print(f"Regenerating: Attempting to replace message at index {regenerate_index}")
-                    # Replace the message at the specific index with the new content
-                    # Ensure the index is valid within the current file history
-                    if 0 <= regenerate_index < len(current_file_history):
-                        # Assuming the regenerated message should be an assistant message
-                        current_file_history[regenerate_index] = {"role": "assistant", "content": full_content}
-                        print(f"Regenerating: Successfully replaced message at index {regenerate_index}")
-                    else:
-                        print(f"Regenerating: Index {regenerate_index} is out of bounds for current file history.")
-                        # Potentially log an error or handle this case differently if needed
-                        # For now, just append if index is invalid
-                        current_file_history.append({"role": "assistant", "content": full_content})
-
-                    # Save the updated history back to the file
-                    with open(chat_filepath, 'w', encoding='utf-8') as f:
-                        json.dump(current_file_history, f, indent=4)
-                    print(f"Regenerating: Saved updated history to {chat_filepath}")
-
-                except FileNotFoundError:
-                    print(f"Regenerating: Chat file {chat_filepath} not found during save.")
-                    # This shouldn't happen if we got this far, but handle it gracefully
-                    return
-                except Exception as e:
-                    print(f"Regenerating: Error saving final message to file: {e}")
-                    # Yield an error to the frontend?
-                    # yield f"data: {json.dumps({'type': 'error', 'content': f'Error saving: {e}'})}\n\n"
-                    return # Stop execution on save error
+                return f'API Error: {response.status_code}'
 
+            if candidate == 'n':
+                deltas = iter_content_deltas(response, indexed=True)
+            else:
+                deltas = ((candidate, content) for content in iter_content_deltas(response))
+            for index, content in deltas:
+                if generation.cancelled.is_set():
+                    break
+                if timings is not None:
+                    timings.token()
+                if index is None:
+                    chunks[0].append(content)
+                    generation.publish({'type': 'content', 'content': content})
+                elif index < len(chunks):
+                    chunks[index].append(content)
+                    generation.publish({'type': 'content', 'candidate': index, 'content': content})
+    except (requests.exceptions.RequestException, OSError):
+        # An aborted response ends with a read error; anything else is real
+        if not generation.cancelled.is_set():
+            raise
+    finally:
+        backend_pool.release(backend)
+    return None
+
+def stream_candidates(turn, generation, chunks):
+    """Generates all candidates of a turn at once. Returns an error message if every one failed."""
+    count = turn['n_candidates']
+    if LLM_CANDIDATES_USE_N:
+        return stream_request(generation, chunks, dict(turn['payload'], n=count), turn['backend_key'], 'n', turn['timings'])
+
+    errors = [None] * count
+
+    def run(index):
+        payload, key = candidate_request(turn, index)
+        try:
+            errors[index] = stream_request(generation, chunks, payload, key, index, turn['timings'])
+        except Exception as e:
+            errors[index] = f'Streaming Error: {e}'
+        if errors[index]:
+            generation.publish({'type': 'candidate_error', 'candidate': index, 'content': errors[index]})
+
+    threads = [threading.Thread(target=run, args=(index,), daemon=True) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if all(errors):
+        return errors[0]
+    return None
+
+def run_generation(turn, ticket, generation):
+    """Runs a streamed turn on a worker thread, publishing its events to the generation."""
+    # Collect each reply as chunks and join once at the end
+    chunks = [[] for _ in range(turn['n_candidates'])]
+    timings = turn['timings']
+    outcome = 'error'
+    try:
+        start = {'type': 'start', 'generation_id': generation.id}
+        if turn['n_candidates'] > 1:
+            start['candidates'] = turn['n_candidates']
+        generation.publish(start)
+        wait_for_slot(ticket, generation)
+        timings.mark('queue')
+        if not generation.cancelled.is_set():
+            if turn['n_candidates'] > 1:
+                error = stream_candidates(turn, generation, chunks)
             else:
-                # Normal chat, append user and assistant messages to the loaded history
-                try:
-                    history.append({"role": "user", "content": user_message})
-                    history.append({"role": "assistant", "content": full_content})
-
-                    with open(chat_filepath, 'w', encoding='utf-8') as f:
-                        json.dump(history, f, indent=4)
-                    print(f"Normal chat: Saved updated history to {chat_filepath}")
-                except Exception as e:
-                    print(f"Normal chat: Error saving final message: {e}")
-                    # Yield an error to the frontend?
-                    # yield f"data: {json.dumps({'type': 'error', 'content': f'Error saving: {e}'})}\n\n"
-                    return # Stop execution on save error
-
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
+                error = stream_request(generation, chunks, turn['payload'], turn['backend_key'], timings=timings)
+            timings.mark('stream' if timings.first_token is not None else 'backend')
+            if error:
+                generation.publish({'type': 'error', 'content': error})
+                return
 
+        # --- POST-STREAMING LOGIC ---
+        truncated = generation.cancelled.is_set()
+        contents = ["".join(c) for c in chunks]
+        full_content = contents if turn['n_candidates'] > 1 else contents[0]
+        try:
+            if truncated:
+                save_partial_reply(turn, full_content)
+            else:
+                save_reply(turn, full_content)
         except Exception as e:
-            error_msg = str(e)
-            print(f"Streaming Error: {error_msg}")
-            yield f"data: {json.dumps({'type': 'error', 'content': f'Streaming Error: {error_msg}'})}\n\n"
+            print(f"Error saving final message for {turn['character_id']}/{turn['chat_id']}: {e}")
+            generation.publish({'type': 'error', 'content': f'Failed to save the reply: {e}'})
+            return
+        timings.mark('save')
+        outcome = 'cancelled' if truncated else 'ok'
+
+        # The breakdown goes out last before `done`, which ends the stream for clients
+        generation.publish({'type': 'stats', **timings.summary()})
+        done = {'type': 'done', 'truncated': truncated}
+        if turn['n_candidates'] > 1:
+            reply = build_reply(full_content)
+            done['candidates'] = reply['candidates']
+            done['selected'] = reply['selected']
+        generation.publish(done)
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    except Exception as e:
+        error_msg = str(e)
+        print(f"Streaming Error: {error_msg}")
+        generation.publish({'type': 'error', 'content': f'Streaming Error: {error_msg}'})
+    finally:
+        generation_registry.finish(generation)
+        generation_scheduler.release(ticket)
+        record_turn_metrics(turn, 'stream', outcome)
+
+def stream_generation(generation, after_seq=0):
+    """Yields a generation's events as SSE frames, starting after after_seq.
+
+    Content deltas arriving within SSE_COALESCE_WINDOW of each other go out as one frame,
+    unless SSE_COALESCE_BYTES of content is already waiting.
+    """
+    while True:
+        if not generation.wait(after_seq, SSE_KEEPALIVE_INTERVAL):
+            yield ": keep-alive\n\n"
+            continue
+        deadline = time.monotonic() + SSE_COALESCE_WINDOW
+        while not generation.finished and generation.pending_bytes(after_seq) < SSE_COALESCE_BYTES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not generation.wait(generation.last_seq, remaining):
+                break
+        frames, after_seq = generation.read(after_seq)
+        for seq, payload in frames:
+            yield sse_event(payload, f"{generation.id}:{seq}")
+        if generation.finished and after_seq == generation.last_seq:
+            return
+
+def generation_response(generation, after_seq=0):
+    generation.attach()
+    response = Response(stream_generation(generation, after_seq), mimetype='text/event-stream')
+    response.headers['X-Generation-Id'] = generation.id
+    response.headers['Cache-Control'] = 'no-cache'
+    # Runs when the client goes away too; with nobody left the generation is cancelled after a grace period
+    response.call_on_close(generation.detach)
+    return response
+
+@app.route('/api/chat/stream', methods=['POST'])
+def handle_streaming_chat():
+    turn, error = prepare_chat_turn(request.json, stream=True)
+    if error:
+        chat_requests.inc(endpoint='stream', outcome='rejected')
+        return jsonify(error[0]), error[1]
+    try:
+        ticket = schedule_turn(turn, request.remote_addr)
+    except SchedulerFull as e:
+        chat_requests.inc(endpoint='stream', outcome='rejected')
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(LLM_RETRY_AFTER)}
+
+    generation = generation_registry.start(turn['character_id'], turn['chat_id'])
+    # Only the stages before the reply are known this early; the `stats` event has them all
+    server_timing = turn['timings'].server_timing()
+    threading.Thread(target=run_generation, args=(turn, ticket, generation), daemon=True).start()
+    response = generation_response(generation)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+@app.route('/api/chat/stream/<generation_id>', methods=['GET'])
+def resume_streaming_chat(generation_id):
+    """Reattaches to a generation, replaying the events after the Last-Event-ID header."""
+    generation = generation_registry.get(generation_id)
+    if generation is None:
+        return jsonify({"error": "Generation not found or expired"}), 404
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    return generation_response(generation, parse_last_event_id(last_event_id, generation_id))
+
+@app.route('/api/chat/stream/<generation_id>/cancel', methods=['POST'])
+def cancel_streaming_chat(generation_id):
+    """Stops a running generation; the stream ends with the partial reply saved as truncated."""
+    generation = generation_registry.get(generation_id)
+    if generation is None or generation.finished:
+        return jsonify({"error": "Generation not found or already finished"}), 404
+    generation.cancel()
+    return jsonify({"success": True})
 
 
 # --- Regular Chat Endpoint (non-streaming) ---
 
 @app.route('/api/chat', methods=['POST'])
 def handle_chat():
-    data = request.json
-    character_id = data.get('character_id')
-    chat_id = data.get('chat_id')
-    user_message = data.get('message')
-    history_override = data.get('history_override')
-    mode = data.get('mode', 'chat')
-    user_persona = data.get('user_persona', 'The user you are talking to.')
-    llm_settings = data.get('llm_settings', {})
-    
-    if not all([character_id, chat_id, user_message]):
-        return jsonify({"error": "Character ID, Chat ID, and message are required"}), 400
-
+    turn, error = prepare_chat_turn(request.json, stream=False)
+    if error:
+        chat_requests.inc(endpoint='chat', outcome='rejected')
+        return jsonify(error[0]), error[1]
+    if turn['n_candidates'] > 1:
+        chat_requests.inc(endpoint='chat', outcome='rejected')
+        return jsonify({"error": "n_candidates needs the streaming endpoint, /api/chat/stream"}), 400
     try:
-        with open(os.path.join(CHARACTERS_DIR, f"{character_id}.json"), 'r', encoding='utf-8') as f:
-            character = json.load(f)
-    except FileNotFoundError:
-        return jsonify({"error": "Character data not found."}), 404
-
-    chat_filepath = os.path.join(CHATS_DIR, character_id, f"{chat_id}.json")
-    if history_override is not None:
-        history = history_override
-    else:
-        try:
-            with open(chat_filepath, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-        except FileNotFoundError:
-            return jsonify({"error": "Chat history not found."}), 404
-
-    system_prompt = (
-        f"This is a conversation between you, {character['name']}, and a user. "
-        f"Your persona: {character['description']}. "
-        f"The user's persona: {user_persona}. "
-    )
-    if mode == 'chat':
-        system_prompt += "Respond naturally and conversationally as your character. Stay in character at all times."
-    else:
-        system_prompt += "You are in instruct mode. Follow the user's instructions precisely while embodying your character's personality."
-
-    messages_for_api = [{"role": "system", "content": system_prompt}]
-    messages_for_api.extend(history)
-    messages_for_api.append({"role": "user", "content": user_message})
-
-    api_payload = {
-        "model": "local-model",
-        "messages": messages_for_api,
-        "temperature": llm_settings.get('temperature', 0.7),
-        "repeat_penalty": llm_settings.get('repetition_penalty', 1.1),
-        "top_p": llm_settings.get('min_p', 0.95),
-        "stream": False
-    }
+        ticket = schedule_turn(turn, request.remote_addr)
+    except SchedulerFull as e:
+        chat_requests.inc(endpoint='chat', outcome='rejected')
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(LLM_RETRY_AFTER)}
 
+    timings = turn['timings']
     try:
-        response = requests.post(LM_STUDIO_API_URL, json=api_payload, timeout=300)
-        response.raise_for_status()
-        ai_message = response.json()['choices'][0]['message']['content']
-    except requests.exceptions.RequestException as e:
+        if not ticket.wait(LLM_QUEUE_TIMEOUT):
+            record_turn_metrics(turn, 'chat', 'error')
+            return jsonify({"error": "Timed out waiting for a free generation slot"}), 503
+        timings.mark('queue')
+        backend, response = backend_pool.post(
+            llm_session, turn['backend_key'], turn['payload'],
+            stream=False, timeout=(LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT))
+        try:
+            response.raise_for_status()
+            ai_message = response.json()['choices'][0]['message']['content']
+        finally:
+            backend_pool.release(backend)
+        timings.mark('backend')
+    except (requests.exceptions.RequestException, NoBackendAvailable) as e:
+        record_turn_metrics(turn, 'chat', 'error')
         return jsonify({"error": f"Could not connect to LM Studio API: {e}"}), 500
     except (KeyError, IndexError) as e:
+        record_turn_metrics(turn, 'chat', 'error')
         return jsonify({"error": f"Unexpected API response format: {e}"}), 500
+    finally:
+        generation_scheduler.release(ticket)
 
-    if history_override is None:
-        history.append({"role": "user", "content": user_message})
-        history.append({"role": "assistant", "content": ai_message})
+    # A history_override only asks for a reply; it is not saved
+    if not turn['history_override']:
         try:
-            with open(chat_filepath, 'w', encoding='utf-8') as f:
-                json.dump(history, f, indent=4)
+            save_reply(turn, ai_message)
         except IOError as e:
-            print(f"Error saving chat history for {character_id}/{chat_id}: {e}")
-
-    return jsonify({"reply": ai_message})
+            print(f"Error saving chat history for {turn['character_id']}/{turn['chat_id']}: {e}")
+        timings.mark('save')
+    record_turn_metrics(turn, 'chat', 'ok')
+
+    response = jsonify({"reply": ai_message})
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+# --- Metrics ---
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Chat request stage timings, time to first token, token rate, queue wait and chat
+    log I/O, in the Prometheus text format."""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- Debugging ---
+
+@app.route('/api/backends', methods=['GET'])
+def get_backends():
+    """Lists the configured LLM backends with their health and in-flight request counts."""
+    return jsonify(backend_pool.status())
+
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler_status():
+    """Reports how many generations are running and waiting."""
+    return jsonify(generation_scheduler.status())
+
+@app.route('/api/chats/<character_id>/<chat_id>/summary', methods=['GET'])
+def get_chat_summary(character_id, chat_id):
+    """Shows the rolling summary used in place of a chat's older messages."""
+    if not chat_store.exists(character_id, chat_id):
+        return jsonify({"error": "Chat not found"}), 404
+    summary = chat_store.read_summary(character_id, chat_id)
+    if summary is None:
+        return jsonify({"error": "This chat has no summary"}), 404
+    return jsonify(summary)
+
+@app.route('/api/debug/prefix/<character_id>/<chat_id>', methods=['GET'])
+def get_prefix_stats(character_id, chat_id):
+    """Reports how much of the last prompt for a chat matched the one sent before it."""
+    stats = prefix_tracker.stats((character_id, chat_id))
+    if stats is None:
+        return jsonify({"error": "No prompts recorded for this chat yet"}), 404
+    return jsonify(stats)
 
 # --- Image Upload ---
 
 @app.route('/api/upload-image', methods=['POST'])
 def upload_image():
+    # Refuse oversized bodies before the form is parsed (a little over the limit, for the multipart framing)
+    if request.content_length is not None and request.content_length > UPLOAD_MAX_BYTES + 64 * 1024:
+        return jsonify({"error": f"Images can be at most {UPLOAD_MAX_BYTES // (1024 * 1024)} MB"}), 413
+
     if 'image' not in request.files:
         return jsonify({"error": "No image file provided"}), 400
     
@@ -521,21 +1043,89 @@ def upload_image():
     if file.filename == '':
         return jsonify({"error": "No image selected"}), 400
     
-    if file:
-        _, ext = os.path.splitext(file.filename)
-        filename = f"{uuid.uuid4()}{ext}"
-        file_path = os.path.join(UPLOADS_DIR, filename)
-        file.save(file_path)
-        return jsonify({"url": f"/data/uploads/{filename}"})
-    
-    return jsonify({"error": "Failed to upload image"}), 500
+    try:
+        filename = upload_store.save(file.stream)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except OSError as e:
+        print(f"Error saving upload: {e}")
+        return jsonify({"error": "Failed to upload image"}), 500
+    return jsonify({"url": f"/data/uploads/{filename}"})
 
 @app.route('/data/uploads/<path:filename>')
 def serve_uploaded_file(filename):
+    size = request.args.get('size', type=int)
+    if size is not None and size <= 0:
+        return jsonify({"error": "size must be a positive number of pixels"}), 400
+    directory, served_name = upload_store.resolve(filename, size)
+    digest = upload_store.etag(filename)
+    etag, max_age = True, None  # Older uploads can be replaced in place, so they are revalidated
+    if digest:
+        etag = os.path.splitext(served_name)[0]  # <hash>, or <hash>-<size> for a thumbnail
+        max_age = UPLOAD_CACHE_MAX_AGE
     try:
-        return send_from_directory(UPLOADS_DIR, filename)
+        response = send_from_directory(directory, served_name, etag=etag, max_age=max_age)
     except FileNotFoundError:
         return jsonify({"error": "File not found"}), 404
+    if digest:
+        response.cache_control.immutable = True
+    return response
+
+# --- Export / Import ---
+
+@app.route('/api/export', methods=['GET'])
+def export_data():
+    """Streams a zip (or ?format=tar, a tar.gz) of all characters, chats and avatar uploads.
+
+    With ?since=<unix time>, only what changed after then; pass the manifest's
+    exported_at as `since` for the next incremental export.
+    """
+    fmt = request.args.get('format', 'zip')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            return jsonify({"error": "since must be a unix timestamp"}), 400
+    mimetype, filename, chunks = export_archive(fmt, chat_store, character_registry, upload_store, since)
+    response = Response(chunks, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/api/import', methods=['POST'])
+def import_data():
+    """Imports an archive from /api/export, sent as the request body or an `archive` form file."""
+    if request.content_length is not None and request.content_length > IMPORT_MAX_BYTES:
+        return jsonify({"error": f"Archives can be at most {IMPORT_MAX_BYTES // (1024 * 1024)} MB"}), 413
+    stream = request.files['archive'].stream if 'archive' in request.files else request.stream
+
+    # Spool to disk first: zip archives can only be read from a seekable file
+    archive_path = os.path.join(DATA_DIR, f".import-{os.getpid()}-{threading.get_ident()}")
+    try:
+        size = 0
+        with open(archive_path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                size += len(chunk)
+                if size > IMPORT_MAX_BYTES:
+                    return jsonify({"error": f"Archives can be at most {IMPORT_MAX_BYTES // (1024 * 1024)} MB"}), 413
+                f.write(chunk)
+        if size == 0:
+            return jsonify({"error": "No archive provided"}), 400
+        imported = import_archive(archive_path, chat_store, character_registry, upload_store,
+                                  archive_path + ".staging", IMPORT_MAX_UNPACKED_BYTES)
+    except ArchiveError as e:
+        return jsonify({"error": f"Invalid archive: {e}"}), 400
+    except (IOError, OSError) as e:
+        print(f"Error importing archive: {e}")
+        return jsonify({"error": f"Failed to import archive: {e}"}), 500
+    finally:
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+    print(f"Imported {imported['characters']} character(s), {imported['chats']} chat(s) and {imported['uploads']} upload(s)")
+    return jsonify(imported)
 
 # --- Main Execution ---
 if __name__ == '__main__':
@@ -543,4 +1133,7 @@ if __name__ == '__main__':
     print("Access the web UI at: http://127.0.0.1:5500")
     print("Make sure LM Studio is running on port 1234")
     print("---------------------------------")
+    migrated = chat_store.migrate_all()
+    if migrated:
+        print(f"Migrated {migrated} legacy chat file(s) to the chat log format")
     app.run(host='0.0.0.0', port=5500, debug=False)
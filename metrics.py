@@ -0,0 +1,201 @@
+import time
+import threading
+
+# --- Metrics ---
+# Counters, gauges and histograms kept in memory and rendered in the Prometheus text
+# format for GET /metrics. Each metric may have label names; every combination of
+# label values seen gets its own series. Gauges are read from a callback at scrape
+# time, so they never go stale.
+#
+# RequestTimings breaks one chat request down by stage. The pipeline calls mark(stage)
+# as each stage ends, and the time since the previous mark is added to that stage, so
+# the stages always add up to the request's total. The breakdown goes out as a
+# Server-Timing header and in the `stats` event of a streamed reply.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DISK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}  # Label values -> series state
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for values, state in series:
+            lines.extend(self._render_series(values, state))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _render_series(self, values, total):
+        return [f"{self.name}{_label_text(self.labels, values)} {_format_value(total)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._series.get(key)
+            if state is None:
+                state = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def _render_series(self, values, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state['counts']):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_label_text(self.labels, values, [('le', _format_value(float(bound)))])} {cumulative}")
+        lines.append(f"{self.name}_bucket{_label_text(self.labels, values, [('le', '+Inf')])} {state['count']}")
+        lines.append(f"{self.name}_sum{_label_text(self.labels, values)} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{_label_text(self.labels, values)} {state['count']}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        super().__init__(name, help)
+        self.read = read  # Called at scrape time for the current value
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            print(f"Error reading metric {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_format_value(value)}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        return self._add(Histogram(name, help, buckets, labels))
+
+    def gauge(self, name, help, read):
+        return self._add(Gauge(name, help, read))
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}  # Stage -> seconds, in the order the stages first ended
+        self.first_token = None  # Seconds from the start to the first streamed token
+        self.tokens = 0  # Content deltas streamed; backends send about one per token
+        self._last = self.started
+        self._lock = threading.Lock()  # Candidates stream on several threads at once
+
+    def mark(self, stage):
+        """Ends a stage: the time since the previous mark is added to it."""
+        with self._lock:
+            now = time.perf_counter()
+            self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+            self._last = now
+
+    def token(self):
+        """Counts a streamed token; the first one ends the `backend` stage."""
+        with self._lock:
+            self.tokens += 1
+            if self.first_token is not None:
+                return
+            self.first_token = time.perf_counter() - self.started
+        self.mark('backend')
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def stream_duration(self):
+        return self.stages.get('stream', 0.0)
+
+    def tokens_per_second(self):
+        duration = self.stream_duration()
+        return self.tokens / duration if self.tokens > 1 and duration > 0 else None
+
+    def server_timing(self):
+        """The breakdown as a Server-Timing header value, in milliseconds."""
+        parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.total() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def summary(self):
+        """The breakdown for a `stats` event: milliseconds per stage, time to first token and token rate."""
+        stats = {
+            "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()},
+            "total_ms": round(self.total() * 1000, 1),
+            "tokens": self.tokens,
+        }
+        if self.first_token is not None:
+            stats["ttft_ms"] = round(self.first_token * 1000, 1)
+        rate = self.tokens_per_second()
+        if rate is not None:
+            stats["tokens_per_s"] = round(rate, 1)
+        return stats
@@ -0,0 +1,134 @@
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Mock Backend ---
+# A stand-in for LM Studio / llama.cpp that speaks just enough of the OpenAI chat
+# completions API for the server: GET /v1/models for health checks and POST
+# /v1/chat/completions, streamed or not, with `n` choices. Replies are made-up words
+# sent after a fixed latency at a fixed token rate, so benchmark runs measure this
+# server rather than a model. Setting fail_status makes it answer every request with
+# that status, like a backend that is down or overloaded.
+#
+#   python mock_backend.py --port 1234 --latency 0.2 --rate 50 --tokens 64
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+
+def _reply_tokens(count, choice):
+    return [("" if i == 0 else " ") + WORDS[(i + choice) % len(WORDS)] for i in range(count)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.2  # Seconds before the first token
+    rate = 50.0  # Tokens per second after that (0 sends them all at once)
+    tokens = 64  # Tokens per reply, unless the request's max_tokens is lower
+    fail_status = None  # Answer everything with this status instead (e.g. 503)
+    requests = 0  # Completion requests received
+    last_request = None  # Body of the latest completion request
+    _count_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.fail_status:
+            self._send_json({"error": "Unavailable"}, self.fail_status)
+        elif self.path.rstrip('/').endswith('/models'):
+            self._send_json({"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+        else:
+            self._send_json({"error": "Not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._send_json({"error": "Invalid JSON"}, 400)
+            return
+        with MockHandler._count_lock:
+            type(self).requests += 1
+            type(self).last_request = request
+        if self.fail_status:
+            self._send_json({"error": "Unavailable"}, self.fail_status)
+            return
+        count = min(self.tokens, request.get('max_tokens') or self.tokens)
+        choices = max(1, int(request.get('n') or 1))
+        time.sleep(self.latency)
+        if request.get('stream'):
+            self._stream(count, choices)
+        else:
+            time.sleep(count / self.rate if self.rate > 0 else 0)
+            self._send_json({
+                "object": "chat.completion",
+                "choices": [{"index": c, "message": {"role": "assistant", "content": "".join(_reply_tokens(count, c))},
+                             "finish_reason": "stop"} for c in range(choices)],
+            })
+
+    def _stream(self, count, choices):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write(data):
+            self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+            self.wfile.flush()
+
+        replies = [_reply_tokens(count, c) for c in range(choices)]
+        start = time.monotonic()
+        try:
+            for i in range(count):
+                if self.rate > 0:
+                    # Pace against the start time so sleep overshoot doesn't add up
+                    delay = start + i / self.rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                for c in range(choices):
+                    chunk = {"object": "chat.completion.chunk", "choices": [{"index": c, "delta": {"content": replies[c][i]}}]}
+                    write(b"data: " + json.dumps(chunk).encode('utf-8') + b"\n\n")
+            write(b"data: [DONE]\n\n")
+            write(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The server cancelled the generation
+
+
+def serve(port, latency=0.2, rate=50.0, tokens=64, host='127.0.0.1'):
+    """Returns a mock backend server listening on port (0 picks a free one); call
+    serve_forever() on it. Its settings and request count are on server.handler."""
+    handler = type('MockHandler', (MockHandler,), {'latency': latency, 'rate': rate, 'tokens': tokens,
+                                                   'requests': 0, 'last_request': None})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.handler = handler
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions backend")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument('--rate', type=float, default=50.0, help="tokens per second (0: all at once)")
+    parser.add_argument('--tokens', type=int, default=64, help="tokens per reply")
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.rate, args.tokens, args.host)
+    print(f"Mock backend on http://{args.host}:{args.port}/v1/chat/completions "
+          f"({args.latency}s latency, {args.rate} tokens/s, {args.tokens} tokens)")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,202 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+# --- Generation Scheduler ---
+# Admission control in front of the LLM backends. At most max_concurrent generations run
+# at once; the rest wait in a bounded queue, and anything beyond that is turned away
+# right away (the caller answers 429) instead of hanging until the backend times out.
+#
+# Waiting requests are served by priority first (a new message goes ahead of a
+# regeneration), then round-robin across keys (one key per client and chat), so one
+# chat's burst of regenerate clicks can't starve everyone else.
+#
+# A ticket can take several slots at once (a turn generating several candidates in
+# parallel); it waits until that many are free.
+#
+# Background work (chat summaries) only gets a slot while nothing else is running or
+# waiting, and is preempted as soon as a live request has to queue behind it.
+
+PRIORITY_NEW = 0
+PRIORITY_REGENERATE = 1
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, key, priority, weight=1):
+        self.key = key
+        self.priority = priority
+        self.weight = weight  # Slots the ticket takes while running
+        self.position = 0  # 1-based place in the queue; 0 once running
+        self.granted = threading.Event()
+        self.released = False
+        self.background = False
+        self.preempted = threading.Event()
+        self._wakers = []
+        self._wakers_lock = threading.Lock()
+        self._preempt_callbacks = []
+        self._preempt_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """Blocks until the ticket may run. Returns False on timeout."""
+        return self.granted.wait(timeout)
+
+    async def wait_async(self, timeout=None):
+        """Like wait(), without blocking the event loop."""
+        if self.granted.is_set():
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        with self._wakers_lock:
+            self._wakers.append(wake)
+        try:
+            if self.granted.is_set():  # Granted while the waker was being registered
+                return True
+            done, _ = await asyncio.wait({future}, timeout=timeout)
+            return bool(done)
+        finally:
+            # A ticket is waited on again after every timeout; don't let old wakers pile up
+            with self._wakers_lock:
+                if wake in self._wakers:
+                    self._wakers.remove(wake)
+
+    def on_preempt(self, callback):
+        """Registers a callback that stops background work; runs it right away if the
+        ticket was already preempted."""
+        with self._preempt_lock:
+            if not self.preempted.is_set():
+                self._preempt_callbacks.append(callback)
+                return
+        callback()
+
+    def _preempt(self):
+        with self._preempt_lock:
+            self.preempted.set()
+            callbacks, self._preempt_callbacks = self._preempt_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error preempting {self.key}: {e}")
+
+    def _grant(self):
+        self.position = 0
+        self.granted.set()
+        with self._wakers_lock:
+            wakers, self._wakers = self._wakers, []
+        for wake in wakers:
+            wake()
+
+
+class GenerationScheduler:
+    def __init__(self, max_concurrent, max_queued, max_queued_per_key):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_per_key = max_queued_per_key
+        self._queues = [OrderedDict(), OrderedDict()]  # Per priority: key -> deque of tickets
+        self._running = 0
+        self._queued = 0
+        self._background = set()  # Running background tickets
+        self._lock = threading.Lock()
+
+    def submit(self, key, priority=PRIORITY_NEW, weight=1):
+        """Returns a Ticket that is either running already or queued.
+
+        weight is the number of slots it needs (at most max_concurrent). Raises
+        SchedulerFull if the queue (or this key's share of it) is full.
+        """
+        ticket = Ticket(key, priority, max(1, min(weight, self.max_concurrent)))
+        with self._lock:
+            if self._running + ticket.weight <= self.max_concurrent and not self._queued:
+                self._running += ticket.weight
+                ticket._grant()
+                return ticket
+            if self._queued >= self.max_queued:
+                raise SchedulerFull("The server is busy, please try again shortly")
+            queued_for_key = sum(len(queue.get(key, ())) for queue in self._queues)
+            if queued_for_key >= self.max_queued_per_key:
+                raise SchedulerFull("Too many queued generations for this chat")
+            self._queues[priority].setdefault(key, deque()).append(ticket)
+            self._queued += 1
+            self._update_positions()
+            preempted = [t for t in self._background if not t.preempted.is_set()]
+        for background in preempted:
+            background._preempt()  # Its release lets this ticket run
+        return ticket
+
+    def submit_if_idle(self, key):
+        """Returns a running Ticket if nothing else is running or waiting, otherwise None.
+
+        For background work that should only use the backend while it is idle.
+        """
+        with self._lock:
+            if self._running or self._queued or not self.max_concurrent:
+                return None
+            ticket = Ticket(key, PRIORITY_REGENERATE)
+            ticket.background = True
+            self._background.add(ticket)
+            self._running += 1
+            ticket._grant()
+            return ticket
+
+    def release(self, ticket):
+        """Frees a running ticket's slot, or takes a waiting ticket out of the queue."""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._background.discard(ticket)
+            if ticket.granted.is_set():
+                self._running -= ticket.weight
+            else:
+                tickets = self._queues[ticket.priority][ticket.key]
+                tickets.remove(ticket)
+                if not tickets:
+                    del self._queues[ticket.priority][ticket.key]
+                self._queued -= 1
+            self._dispatch()
+
+    def status(self):
+        with self._lock:
+            return {
+                "running": self._running,
+                "queued": self._queued,
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+            }
+
+    def _dispatch(self):
+        while self._queued:
+            queue = next(queue for queue in self._queues if queue)
+            key, tickets = next(iter(queue.items()))
+            if self._running + tickets[0].weight > self.max_concurrent:
+                break  # The next ticket waits for enough free slots
+            ticket = tickets.popleft()
+            if tickets:
+                queue.move_to_end(key)
+            else:
+                del queue[key]
+            self._queued -= 1
+            self._running += ticket.weight
+            ticket._grant()
+        self._update_positions()
+
+    def _update_positions(self):
+        # Replays the dispatch order: by priority, then one ticket per key per round
+        position = 0
+        for queue in self._queues:
+            rounds = list(queue.values())
+            depth = 0
+            while rounds:
+                for tickets in rounds:
+                    position += 1
+                    tickets[depth].position = position
+                depth += 1
+                rounds = [tickets for tickets in rounds if len(tickets) > depth]
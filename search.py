@@ -0,0 +1,216 @@
+import re
+import time
+import sqlite3
+import threading
+
+# --- Full-Text Search ---
+# A SQLite FTS5 index over every message of every chat, kept at data/search.db. The
+# chat store feeds it from its flush path: each batch of log records it writes is
+# applied to the index in one transaction, along with the log size it brings the chat
+# up to. At startup the stored sizes are compared with the logs and any chat that
+# doesn't match (written while the index was missing, or before a crash) is reindexed
+# in the background.
+#
+# Rows are keyed by (character, chat, position). Deleting a message shifts the
+# positions after it down by one, just like replaying a `del` record does.
+
+SNIPPET_TOKENS = 12
+MIN_PREFIX_LENGTH = 3  # Shorter prefixes match too many terms to rank quickly; they match exactly instead
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    character_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    message_count INTEGER NOT NULL,
+    log_size INTEGER NOT NULL,
+    PRIMARY KEY (character_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    character_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_by_chat ON messages (character_id, chat_id, position);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, tokenize='unicode61 remove_diacritics 2');
+"""
+
+_TERM = re.compile(r'\w+\*?', re.UNICODE)
+
+
+class SearchError(Exception):
+    pass
+
+
+class _MissingRow(Exception):
+    """A record edits a message the index doesn't have: the index is out of sync with the log."""
+
+
+def build_query(text):
+    """Turns free text into an FTS5 query: every word must match, `word*` matches a prefix.
+
+    Quoting every word keeps FTS5 operators and syntax out of user input.
+    """
+    terms = []
+    for term in _TERM.findall(text):
+        prefix = term.endswith('*') and len(term) > MIN_PREFIX_LENGTH
+        term = term.rstrip('*')
+        if term:
+            terms.append(f'"{term}"' + ('*' if prefix else ''))
+    return " ".join(terms)
+
+
+def _text(message):
+    content = message.get('content') if message else None
+    return content if isinstance(content, str) else ""
+
+
+class SearchIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()  # Serializes writes, which all go through self._db
+        self._local = threading.local()  # Per-thread read connections, so searches don't wait on writes
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")  # The index is rebuilt from the logs if it falls behind
+        self._db.executescript(_SCHEMA)
+        self.syncing = False  # True while the startup sync is reindexing chats
+
+    def _reader(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.db_path)
+        return db
+
+    # --- Updates ---
+
+    def apply(self, character_id, chat_id, items, old_size, log_size):
+        """Applies a batch of chat log records (record, message) that took the log from
+        old_size to log_size.
+
+        Returns False, changing nothing, if the index didn't match the log at old_size
+        or is missing a message the batch edits; the chat then needs reindex_chat().
+        """
+        try:
+            with self._lock, self._db:
+                row = self._db.execute("SELECT message_count, log_size FROM chats WHERE character_id = ? AND chat_id = ?",
+                                       (character_id, chat_id)).fetchone()
+                count, indexed_size = row if row else (0, 0)
+                if indexed_size != old_size:
+                    return False
+                for record, message in items:
+                    op = record['op']
+                    if op == 'add':
+                        self._insert(character_id, chat_id, count, message)
+                        count += 1
+                    elif not 0 <= record['index'] < count:
+                        continue  # Replay ignores it too
+                    elif op == 'set':
+                        row_id = self._row_id(character_id, chat_id, record['index'])
+                        self._db.execute("UPDATE messages SET role = ? WHERE id = ?", (message.get('role'), row_id))
+                        self._db.execute("UPDATE messages_fts SET content = ? WHERE rowid = ?", (_text(message), row_id))
+                    elif op == 'del':
+                        row_id = self._row_id(character_id, chat_id, record['index'])
+                        self._db.execute("DELETE FROM messages WHERE id = ?", (row_id,))
+                        self._db.execute("DELETE FROM messages_fts WHERE rowid = ?", (row_id,))
+                        self._db.execute(
+                            "UPDATE messages SET position = position - 1 WHERE character_id = ? AND chat_id = ? AND position > ?",
+                            (character_id, chat_id, record['index']))
+                        count -= 1
+                self._set_chat(character_id, chat_id, count, log_size)
+        except _MissingRow:
+            return False  # Rolled back
+        return True
+
+    def reindex_chat(self, character_id, chat_id, history, log_size):
+        """Replaces everything indexed for a chat with its current history."""
+        with self._lock, self._db:
+            self._delete_chat(character_id, chat_id)
+            for position, message in enumerate(history):
+                self._insert(character_id, chat_id, position, message)
+            self._set_chat(character_id, chat_id, len(history), log_size)
+
+    def set_log_size(self, character_id, chat_id, old_size, log_size):
+        """Records a new log size for a chat whose content didn't change (e.g. after compaction)."""
+        with self._lock, self._db:
+            self._db.execute("UPDATE chats SET log_size = ? WHERE character_id = ? AND chat_id = ? AND log_size = ?",
+                             (log_size, character_id, chat_id, old_size))
+
+    def remove_chat(self, character_id, chat_id):
+        with self._lock, self._db:
+            self._delete_chat(character_id, chat_id)
+
+    def remove_character(self, character_id):
+        with self._lock, self._db:
+            for (chat_id,) in self._db.execute("SELECT chat_id FROM chats WHERE character_id = ?", (character_id,)).fetchall():
+                self._delete_chat(character_id, chat_id)
+
+    def _insert(self, character_id, chat_id, position, message):
+        cursor = self._db.execute(
+            "INSERT INTO messages (character_id, chat_id, position, role) VALUES (?, ?, ?, ?)",
+            (character_id, chat_id, position, message.get('role')))
+        self._db.execute("INSERT INTO messages_fts (rowid, content) VALUES (?, ?)", (cursor.lastrowid, _text(message)))
+
+    def _delete_chat(self, character_id, chat_id):
+        self._db.execute(
+            "DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM messages WHERE character_id = ? AND chat_id = ?)",
+            (character_id, chat_id))
+        self._db.execute("DELETE FROM messages WHERE character_id = ? AND chat_id = ?", (character_id, chat_id))
+        self._db.execute("DELETE FROM chats WHERE character_id = ? AND chat_id = ?", (character_id, chat_id))
+
+    def _row_id(self, character_id, chat_id, position):
+        """Returns the row of an indexed message. Raises _MissingRow if it isn't indexed."""
+        row = self._db.execute(
+            "SELECT id FROM messages WHERE character_id = ? AND chat_id = ? AND position = ?",
+            (character_id, chat_id, position)).fetchone()
+        if row is None:
+            raise _MissingRow(f"{character_id}/{chat_id} #{position}")
+        return row[0]
+
+    def _set_chat(self, character_id, chat_id, count, log_size):
+        self._db.execute("INSERT OR REPLACE INTO chats (character_id, chat_id, message_count, log_size) VALUES (?, ?, ?, ?)",
+                         (character_id, chat_id, count, log_size))
+
+    # --- Sync ---
+
+    def indexed_chats(self):
+        """Returns {(character_id, chat_id): log_size} for every indexed chat."""
+        rows = self._reader().execute("SELECT character_id, chat_id, log_size FROM chats").fetchall()
+        return {(character_id, chat_id): log_size for character_id, chat_id, log_size in rows}
+
+    # --- Queries ---
+
+    def search(self, text, limit=20, offset=0, character_id=None, chat_id=None):
+        """Returns (hits, took_ms) ranked best first.
+
+        Each hit has the character, chat and message index of a matching message, its
+        role, a snippet with the matches in [brackets] and its bm25 score.
+        """
+        query = build_query(text)
+        if not query:
+            return [], 0.0
+        sql = ("SELECT m.character_id, m.chat_id, m.position, m.role, "
+               f"snippet(messages_fts, 0, '[', ']', '…', {SNIPPET_TOKENS}), bm25(messages_fts) "
+               "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+               "WHERE messages_fts MATCH ?")
+        params = [query]
+        if character_id:
+            sql += " AND m.character_id = ?"
+            params.append(character_id)
+        if chat_id:
+            sql += " AND m.chat_id = ?"
+            params.append(chat_id)
+        sql += " ORDER BY bm25(messages_fts) LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        start = time.perf_counter()
+        try:
+            rows = self._reader().execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            raise SearchError(str(e))
+        took_ms = (time.perf_counter() - start) * 1000
+        hits = [
+            {"character_id": c, "chat_id": chat, "index": position, "role": role, "snippet": snippet, "score": -score}
+            for c, chat, position, role, snippet, score in rows
+        ]
+        return hits, took_ms
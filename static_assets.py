@@ -0,0 +1,156 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+
+try:
+    import brotli
+except ImportError:  # Optional; without it only gzip copies are made
+    brotli = None
+
+# --- Static Assets ---
+# The web UI and the scripts and styles it loads are served from a build made at startup:
+# each asset gets a content-hashed name (/assets/tailwind.min.<hash>.css) and gzip and,
+# if the brotli module is installed, brotli copies, all kept in data/.static. index.html
+# is rewritten to point at the hashed names. Since an asset's URL changes whenever its
+# content does, assets are cached by browsers for good; index.html itself is revalidated
+# on every load, which costs a 304 when nothing changed.
+#
+# Compressed copies are named by content hash too, so a restart only recompresses files
+# that changed. Brotli at its best setting is slow for the Tailwind build, so brotli copies
+# are made on a background thread; until one is ready the gzip copy is sent. The sources
+# are checked for changes (a stat per file) before each index request, and rebuilt if
+# needed.
+
+HASH_LENGTH = 12
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+ENCODINGS = ("br", "gzip")  # Preferred first
+
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def _fingerprint(path, digest):
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return f"{stem}.{digest}{ext}"
+
+
+def _write(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def choose_encoding(asset, accept_encodings):
+    """Returns the best encoding of an asset the client accepts ('identity' if none)."""
+    for encoding in ENCODINGS:
+        if encoding in asset['files'] and accept_encodings[encoding]:
+            return encoding
+    return 'identity'
+
+
+class StaticAssets:
+    def __init__(self, root, index_path, asset_paths, cache_dir, url_prefix="/assets/"):
+        self.root = root
+        self.index_path = index_path
+        self.asset_paths = list(asset_paths)
+        self.cache_dir = cache_dir
+        self.url_prefix = url_prefix
+        self._index = None
+        self._assets = {}  # Fingerprinted name -> asset
+        self._mtimes = None  # Source path -> mtime the current build was made from
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def build(self):
+        """(Re)builds every asset and the rewritten index page."""
+        with self._lock:
+            mtimes = self._source_mtimes()
+            made = 0
+            assets = {}
+            urls = {}
+            for path in self.asset_paths:
+                with open(os.path.join(self.root, path), 'rb') as f:
+                    data = f.read()
+                name = _fingerprint(path, _hash(data))
+                assets[name], written = self._store(name, data)
+                made += written
+                urls[path] = self.url_prefix + name
+            with open(os.path.join(self.root, self.index_path), 'rb') as f:
+                page = f.read().decode('utf-8')
+            for path, url in urls.items():
+                page = page.replace(f'"{path}"', f'"{url}"')
+            data = page.encode('utf-8')
+            index, written = self._store(_fingerprint(self.index_path, _hash(data)), data)
+            made += written
+            self._remove_stale([index] + list(assets.values()))
+            self._index, self._assets, self._mtimes = index, assets, mtimes
+            if made:
+                print(f"Static assets: built {made} file(s) in {self.cache_dir}")
+            pending = [asset for asset in [index] + list(assets.values()) if 'br' not in asset['files']]
+            if brotli is not None and pending:
+                threading.Thread(target=self._compress_brotli, args=(pending,), name="brotli-assets", daemon=True).start()
+
+    def index(self):
+        """Returns the index page, rebuilding first if any source changed."""
+        if self._source_mtimes() != self._mtimes:
+            self.build()
+        return self._index
+
+    def asset(self, name):
+        """Returns the asset with a fingerprinted name, or None."""
+        return self._assets.get(name)
+
+    def _source_mtimes(self):
+        mtimes = {}
+        for path in [self.index_path] + self.asset_paths:
+            try:
+                mtimes[path] = os.stat(os.path.join(self.root, path)).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _store(self, name, data):
+        """Writes the identity and gzip copies of an asset unless they exist already.
+
+        Returns (asset, number of files written). A brotli copy made earlier is picked up.
+        """
+        identity_path = os.path.join(self.cache_dir, name)
+        asset = {
+            'name': name,
+            'hash': os.path.splitext(name)[0].rsplit('.', 1)[-1],
+            'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'files': {'identity': identity_path, 'gzip': identity_path + ".gz"},
+        }
+        written = 0
+        for encoding, file_path in asset['files'].items():
+            if not os.path.exists(file_path):
+                _write(file_path, gzip.compress(data, GZIP_LEVEL, mtime=0) if encoding == 'gzip' else data)
+                written += 1
+        if brotli is not None and os.path.exists(identity_path + ".br"):
+            asset['files']['br'] = identity_path + ".br"
+        return asset, written
+
+    def _compress_brotli(self, assets):
+        for asset in assets:
+            path = asset['files']['identity'] + ".br"
+            try:
+                with open(asset['files']['identity'], 'rb') as f:
+                    _write(path, brotli.compress(f.read(), quality=BROTLI_QUALITY))
+            except OSError as e:
+                print(f"Error compressing {asset['name']} with brotli: {e}")
+                continue
+            asset['files']['br'] = path  # Offered from now on
+
+    def _remove_stale(self, current):
+        keep = {os.path.basename(asset['files']['identity']) + ext for asset in current for ext in ("", ".gz", ".br")}
+        for name in os.listdir(self.cache_dir):
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
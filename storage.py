@@ -0,0 +1,1005 @@
+import os
+import json
+import time
+import struct
+import atexit
+import sqlite3
+import hashlib
+import threading
+
+from context import message_tokens, select_context
+
+# --- Chat Log Storage ---
+# Every chat is an append-only log at data/chats/<character>/<chat>.jsonl with one
+# record per line:
+#   {"op": "add", "msg": {...}}               append a message
+#   {"op": "set", "index": i, "msg": {...}}   replace the message at index i
+#   {"op": "del", "index": i}                 delete (tombstone) the message at index i
+# Replaying the records in order yields the chat history. Superseded records are
+# dropped by a background compaction pass that rewrites the log in place.
+#
+# Next to each log sits <chat>.idx, a binary offset index: a header holding the log
+# size it describes, then one (offset, length, tokens, flags) entry per live message
+# pointing at the record that holds its current content. Ranged reads only touch those
+# records, and the cached token counts let prompt assembly pick messages without
+# reading them. An index whose header doesn't match the log (e.g. after a crash) is
+# rebuilt on access.
+#
+# Writes are write-behind: a request only queues its records, and a background writer
+# appends everything queued for a chat in one write shortly after. Any read of a chat
+# first flushes what is queued for it, so readers always see their own writes. A batch
+# that fails to write (disk full, I/O error) stays queued and is retried rather than
+# dropped. Each chat has its own lock; files that are rewritten whole (compaction,
+# migration, the index) are written to a temp file and renamed into place.
+#
+# Each character folder also holds a chat metadata index (chats.index) with the message
+# count, created/updated times, last-message preview and log size of every chat, so a
+# listing is one small read instead of opening every log. It is kept in memory once
+# loaded, updated on every write and saved by the background writer. On load, entries
+# whose size no longer matches their log (e.g. after a crash) are rebuilt from the log.
+#
+# Given a search index (search.py), every flushed batch of records is also applied to
+# it, so full-text search stays current without rescanning chats.
+#
+# Given a disk_io histogram (metrics.py), reads, writes, fsyncs and index rebuilds of
+# the logs are timed into it, labelled by op.
+#
+# A long chat may have a rolling summary in <chat>.summary (see summarizer.py) covering
+# its first `end` messages. Editing or deleting one of those messages drops it.
+
+LOG_EXT = ".jsonl"
+LEGACY_EXT = ".json"
+INDEX_EXT = ".idx"
+SUMMARY_EXT = ".summary"
+CHAT_INDEX_NAME = "chats.index"
+
+INDEX_MAGIC = b"CIX2"
+FLAG_PINNED = 1
+
+_INDEX_HEADER = struct.Struct('<4sQ')
+_INDEX_ENTRY = struct.Struct('<QIIB')
+
+# Compact once at least this many records are dead and they make up this share of the log
+COMPACTION_MIN_GARBAGE = 64
+COMPACTION_GARBAGE_RATIO = 0.5
+COMPACTION_INTERVAL = 60  # seconds
+WRITE_RETRY_INTERVAL = 5  # seconds between attempts to write records a failed write left queued
+
+PREVIEW_LENGTH = 120
+CHAT_SORT_KEYS = ('created', 'updated', 'message_count', 'size')
+
+# When data is forced to disk: 'always' after every write, 'interval' every few seconds,
+# 'never' leaves it to the OS.
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+def atomic_write(path, data, fsync=True):
+    """Replaces a file with data so a crash leaves either the old or the new version."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _index_entry(offset, length, message):
+    flags = FLAG_PINNED if message.get('pinned') else 0
+    return (offset, length, message_tokens(message), flags)
+
+
+def _preview(message):
+    content = message.get('content')
+    if not isinstance(content, str):
+        return ""
+    return " ".join(content.split())[:PREVIEW_LENGTH]
+
+
+def _created_from_id(chat_id, fallback):
+    # Chat ids start with their creation time in seconds
+    head = chat_id.split('-')[0]
+    return int(head) if head.isdigit() else fallback
+
+
+def _encode_record(record):
+    return (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n").encode('utf-8')
+
+
+def _replay(f, path=""):
+    """Applies log records in order and returns (history, index_entries, total_record_count)."""
+    history = []
+    entries = []
+    total = 0
+    offset = 0
+    for line in f:
+        length = len(line)
+        start, offset = offset, offset + length
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # A torn write at the end of the log after a crash; the rest is intact.
+            print(f"Skipping unreadable record in chat log {path}")
+            continue
+        total += 1
+        op = record.get('op')
+        if op == 'add':
+            history.append(record['msg'])
+            entries.append(_index_entry(start, length, record['msg']))
+        elif op == 'set':
+            if 0 <= record['index'] < len(history):
+                history[record['index']] = record['msg']
+                entries[record['index']] = _index_entry(start, length, record['msg'])
+        elif op == 'del':
+            if 0 <= record['index'] < len(history):
+                del history[record['index']]
+                del entries[record['index']]
+    return history, entries, total
+
+
+def _write_index(idx_path, log_size, entries):
+    # The index can always be rebuilt from the log, so it is never fsynced
+    data = _INDEX_HEADER.pack(INDEX_MAGIC, log_size) + b"".join(_INDEX_ENTRY.pack(*entry) for entry in entries)
+    atomic_write(idx_path, data, fsync=False)
+
+
+class ChatStore:
+    def __init__(self, chats_dir, write_delay=0.05, fsync='interval', fsync_interval=5, search_index=None, disk_io=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}")
+        self.chats_dir = chats_dir
+        self.write_delay = write_delay  # Seconds writes are held so a burst becomes one write; 0 writes through
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.search_index = search_index
+        self.disk_io = disk_io
+        self._lock = threading.Lock()  # Guards the dicts below, never held during I/O
+        self._chat_locks = {}  # (character_id, chat_id) -> RLock
+        self._pending = {}  # (character_id, chat_id) -> [(record, message or None), ...] not yet on disk
+        self._unsynced = set()  # Log paths written since the last fsync ('interval' policy)
+        self._garbage = {}  # (character_id, chat_id) -> dead records written since startup
+        self._edits = {}  # (character_id, chat_id) -> number of set/del records flushed since startup
+        self._meta = {}  # character_id -> {chat_id: metadata}, loaded on first listing
+        self._meta_dirty = set()  # character_ids whose chat index needs saving
+        self._meta_lock = threading.RLock()  # Never acquired before a chat lock
+        self._wakeup = threading.Event()
+        self._writer = None
+        self._compactor = None
+
+    def chat_lock(self, character_id, chat_id):
+        """The lock serializing access to one chat. Hold it around a read-modify-write."""
+        key = (character_id, chat_id)
+        with self._lock:
+            lock = self._chat_locks.get(key)
+            if lock is None:
+                lock = self._chat_locks[key] = threading.RLock()
+            return lock
+
+    def _observe_io(self, op, started):
+        if self.disk_io is not None:
+            self.disk_io.observe(time.perf_counter() - started, op=op)
+
+    # --- Paths ---
+
+    def _char_dir(self, character_id):
+        return os.path.join(self.chats_dir, character_id)
+
+    def log_path(self, character_id, chat_id):
+        return os.path.join(self.chats_dir, character_id, f"{chat_id}{LOG_EXT}")
+
+    def _legacy_path(self, character_id, chat_id):
+        return os.path.join(self.chats_dir, character_id, f"{chat_id}{LEGACY_EXT}")
+
+    def _index_path(self, character_id, chat_id):
+        return os.path.join(self.chats_dir, character_id, f"{chat_id}{INDEX_EXT}")
+
+    def _summary_path(self, character_id, chat_id):
+        return os.path.join(self.chats_dir, character_id, f"{chat_id}{SUMMARY_EXT}")
+
+    def _meta_path(self, character_id):
+        return os.path.join(self.chats_dir, character_id, CHAT_INDEX_NAME)
+
+    def _resolve(self, character_id, chat_id):
+        """Returns the log path for a chat, migrating a legacy .json file on first access."""
+        path = self.log_path(character_id, chat_id)
+        if not os.path.exists(path) and os.path.exists(self._legacy_path(character_id, chat_id)):
+            self.migrate_legacy_chat(character_id, chat_id)
+        return path
+
+    # --- Chats ---
+
+    def exists(self, character_id, chat_id):
+        return os.path.exists(self._resolve(character_id, chat_id))
+
+    def list_chat_ids(self, character_id):
+        char_chat_dir = self._char_dir(character_id)
+        if not os.path.isdir(char_chat_dir):
+            return []
+        chat_ids = set()
+        for filename in os.listdir(char_chat_dir):
+            chat_id, ext = os.path.splitext(filename)
+            if ext in (LOG_EXT, LEGACY_EXT):
+                chat_ids.add(chat_id)
+        return list(chat_ids)
+
+    def create_chat(self, character_id):
+        """Creates an empty chat and returns its id.
+
+        Ids are the creation time in seconds, with a -2, -3, ... suffix when that id is
+        taken; the log is created exclusively, so concurrent creates can't collide.
+        """
+        os.makedirs(self._char_dir(character_id), exist_ok=True)
+        base = str(int(time.time()))
+        chat_id, n = base, 1
+        while True:
+            if not os.path.exists(self._legacy_path(character_id, chat_id)):
+                try:
+                    with open(self.log_path(character_id, chat_id), 'xb'):
+                        pass
+                    break
+                except FileExistsError:
+                    pass
+            n += 1
+            chat_id = f"{base}-{n}"
+        now = time.time()
+        self._put_meta(character_id, chat_id, created=now, updated=now, message_count=0, preview="", size=0)
+        return chat_id
+
+    def delete_chat(self, character_id, chat_id):
+        """Removes a chat; returns False if it did not exist."""
+        found = False
+        key = (character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            with self._lock:
+                self._pending.pop(key, None)
+                self._garbage.pop(key, None)
+            for path in (self.log_path(character_id, chat_id), self._legacy_path(character_id, chat_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+                    found = True
+            for path in (self._index_path(character_id, chat_id), self._summary_path(character_id, chat_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+        if found:
+            self._put_meta(character_id, chat_id)
+            self._search('remove_chat', character_id, chat_id)
+        return found
+
+    def delete_character(self, character_id):
+        with self._lock:
+            self._pending = {key: p for key, p in self._pending.items() if key[0] != character_id}
+            self._garbage = {key: n for key, n in self._garbage.items() if key[0] != character_id}
+        with self._meta_lock:
+            self._meta.pop(character_id, None)
+            self._meta_dirty.discard(character_id)
+        self._search('remove_character', character_id)
+
+    # --- Chat Metadata Index ---
+
+    def list_chats(self, character_id, sort='created', descending=True, offset=0, limit=None):
+        """Returns (page of chat metadata, total chats) for a character, from its chat index."""
+        with self._lock:
+            keys = [key for key in self._pending if key[0] == character_id]
+        for _, chat_id in keys:
+            with self.chat_lock(character_id, chat_id):
+                self._flush(character_id, chat_id)
+        if character_id not in self._meta:
+            for chat_id in self.list_chat_ids(character_id):
+                self._resolve(character_id, chat_id)  # Migrate legacy chats before indexing them
+        with self._meta_lock:
+            chats = [dict(entry, chat_id=chat_id) for chat_id, entry in self._load_meta(character_id).items()]
+        self._schedule_meta_save()
+        chats.sort(key=lambda c: (c[sort], c['chat_id']), reverse=descending)
+        end = offset + limit if limit is not None else None
+        return chats[offset:end], len(chats)
+
+    def _load_meta(self, character_id):
+        """Returns a character's chat metadata, loading and checking it on first use. Needs the meta lock."""
+        meta = self._meta.get(character_id)
+        if meta is not None:
+            return meta
+        if not os.path.isdir(self._char_dir(character_id)):
+            return {}
+        saved = {}
+        try:
+            with open(self._meta_path(character_id), 'r', encoding='utf-8') as f:
+                saved = json.load(f)['chats']
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            print(f"Rebuilding unreadable chat index for {character_id}: {e}")
+        meta = {}
+        for chat_id in self.list_chat_ids(character_id):
+            try:
+                size = os.path.getsize(self.log_path(character_id, chat_id))
+            except FileNotFoundError:
+                continue  # A legacy chat that failed to migrate
+            entry = saved.get(chat_id)
+            if not isinstance(entry, dict) or entry.get('size') != size or set(entry) != set(CHAT_SORT_KEYS + ('preview',)):
+                entry = self._scan_chat(character_id, chat_id, entry if isinstance(entry, dict) else {})
+            meta[chat_id] = entry
+        self._meta[character_id] = meta
+        if meta != saved:
+            self._meta_dirty.add(character_id)
+        return meta
+
+    def _scan_chat(self, character_id, chat_id, entry):
+        """Builds a chat's metadata from its log."""
+        path = self.log_path(character_id, chat_id)
+        with open(path, 'rb') as f:
+            history, _, _ = _replay(f, path)
+            size = f.tell()
+        mtime = os.path.getmtime(path)
+        return {
+            "created": entry.get('created') or _created_from_id(chat_id, mtime),
+            "updated": mtime,
+            "message_count": len(history),
+            "preview": _preview(history[-1]) if history else "",
+            "size": size,
+        }
+
+    def _put_meta(self, character_id, chat_id, **fields):
+        """Updates a chat's metadata; no fields removes it. A no-op until the character is loaded."""
+        with self._meta_lock:
+            meta = self._meta.get(character_id)
+            if meta is None:
+                return  # Checked against the logs when it is loaded
+            if not fields:
+                meta.pop(chat_id, None)
+            else:
+                now = time.time()
+                entry = meta.setdefault(chat_id, {
+                    "created": _created_from_id(chat_id, now), "updated": now,
+                    "message_count": 0, "preview": "", "size": 0,
+                })
+                entry.update(fields)
+            self._meta_dirty.add(character_id)
+        self._schedule_meta_save()
+
+    def _schedule_meta_save(self):
+        if not self._meta_dirty:
+            return
+        if self._writer is not None:
+            self._wakeup.set()
+        else:
+            self.save_meta()
+
+    def save_meta(self):
+        """Writes the chat index of every character whose chats changed."""
+        with self._meta_lock:
+            dirty, self._meta_dirty = self._meta_dirty, set()
+            snapshots = {
+                character_id: json.dumps({"chats": self._meta[character_id]}, ensure_ascii=False).encode('utf-8')
+                for character_id in dirty if character_id in self._meta
+            }
+        for character_id, data in snapshots.items():
+            try:
+                # Rebuilt from the logs if lost, so not fsynced
+                atomic_write(self._meta_path(character_id), data, fsync=False)
+            except (IOError, OSError) as e:
+                print(f"Error writing chat index for {character_id}: {e}")
+
+    # --- Offset Index ---
+
+    def _ensure_index(self, character_id, chat_id):
+        """Returns the index path for a chat, rebuilding the index if it doesn't match the log."""
+        path = self.log_path(character_id, chat_id)
+        idx_path = self._index_path(character_id, chat_id)
+        log_size = os.path.getsize(path)
+        try:
+            with open(idx_path, 'rb') as f:
+                header = f.read(_INDEX_HEADER.size)
+            if len(header) == _INDEX_HEADER.size and _INDEX_HEADER.unpack(header) == (INDEX_MAGIC, log_size):
+                return idx_path
+        except FileNotFoundError:
+            pass
+        self._rebuild_index(character_id, chat_id)
+        return idx_path
+
+    def _rebuild_index(self, character_id, chat_id):
+        started = time.perf_counter()
+        path = self.log_path(character_id, chat_id)
+        with open(path, 'rb') as f:
+            _, entries, _ = _replay(f, path)
+            log_size = f.tell()
+        _write_index(self._index_path(character_id, chat_id), log_size, entries)
+        self._observe_io('index_rebuild', started)
+
+    def _read_entries(self, idx_path, start, end):
+        with open(idx_path, 'rb') as f:
+            f.seek(_INDEX_HEADER.size + start * _INDEX_ENTRY.size)
+            data = f.read((end - start) * _INDEX_ENTRY.size)
+        return list(_INDEX_ENTRY.iter_unpack(data))
+
+    def _count(self, idx_path):
+        return (os.path.getsize(idx_path) - _INDEX_HEADER.size) // _INDEX_ENTRY.size
+
+    # --- Messages ---
+
+    def read_history(self, character_id, chat_id):
+        path = self._resolve(character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            self._flush(character_id, chat_id)
+            started = time.perf_counter()
+            with open(path, 'rb') as f:
+                history, _, _ = _replay(f, path)
+        self._observe_io('read', started)
+        return history
+
+    def count(self, character_id, chat_id):
+        """Returns the number of live messages in a chat without reading the log."""
+        self._resolve(character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            self._flush(character_id, chat_id)
+            return self._count(self._ensure_index(character_id, chat_id))
+
+    def read_range(self, character_id, chat_id, start, end):
+        """Returns (messages[start:end], total) reading only the records for that range."""
+        path = self._resolve(character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            self._flush(character_id, chat_id)
+            idx_path = self._ensure_index(character_id, chat_id)
+            started = time.perf_counter()
+            total = self._count(idx_path)
+            start, end, _ = slice(start, end).indices(total)
+            if start >= end:
+                return [], total
+            entries = self._read_entries(idx_path, start, end)
+            messages = []
+            with open(path, 'rb') as f:
+                for offset, length, _, _ in entries:
+                    f.seek(offset)
+                    messages.append(json.loads(f.read(length))['msg'])
+        self._observe_io('read', started)
+        return messages, total
+
+    def read_context(self, character_id, chat_id, end, token_budget, block=1, start=0):
+        """Returns (messages, dropped): the messages before `end` that fit in token_budget.
+
+        Messages before `start` (already covered by a summary) are only candidates if
+        pinned. Selection uses the token counts cached in the index, so only kept
+        messages are read.
+        """
+        path = self._resolve(character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            self._flush(character_id, chat_id)
+            idx_path = self._ensure_index(character_id, chat_id)
+            started = time.perf_counter()
+            end = min(end, self._count(idx_path)) if end is not None else self._count(idx_path)
+            entries = self._read_entries(idx_path, 0, max(end, 0))
+            candidates = [i for i, e in enumerate(entries) if i >= start or e[3] & FLAG_PINNED]
+            chosen = select_context([entries[i][2] for i in candidates], [entries[i][3] & FLAG_PINNED for i in candidates],
+                                    token_budget, block)
+            messages = []
+            with open(path, 'rb') as f:
+                for index in chosen:
+                    offset, length, _, _ = entries[candidates[index]]
+                    f.seek(offset)
+                    messages.append(json.loads(f.read(length))['msg'])
+        self._observe_io('read', started)
+        return messages, len(candidates) - len(chosen)
+
+    def read_message(self, character_id, chat_id, index):
+        if index < 0:
+            raise IndexError(index)
+        messages, _ = self.read_range(character_id, chat_id, index, index + 1)
+        if not messages:
+            raise IndexError(index)
+        return messages[0]
+
+    def append_messages(self, character_id, chat_id, messages):
+        self._queue(character_id, chat_id, [({"op": "add", "msg": m}, m) for m in messages])
+
+    def set_message(self, character_id, chat_id, index, message):
+        self._queue(character_id, chat_id, [({"op": "set", "index": index, "msg": message}, message)])
+        self._count_garbage(character_id, chat_id)
+
+    def delete_message(self, character_id, chat_id, index):
+        self._queue(character_id, chat_id, [({"op": "del", "index": index}, None)])
+        self._count_garbage(character_id, chat_id)
+
+    def _count_garbage(self, character_id, chat_id):
+        key = (character_id, chat_id)
+        with self._lock:
+            self._garbage[key] = self._garbage.get(key, 0) + 1
+
+    # --- Write-Behind ---
+
+    def _queue(self, character_id, chat_id, items):
+        if not os.path.exists(self._resolve(character_id, chat_id)):
+            raise FileNotFoundError(self.log_path(character_id, chat_id))
+        with self._lock:
+            self._pending.setdefault((character_id, chat_id), []).extend(items)
+        if self.write_delay > 0 and self._writer is not None:
+            self._wakeup.set()
+        else:
+            with self.chat_lock(character_id, chat_id):
+                self._flush(character_id, chat_id)
+
+    def _flush(self, character_id, chat_id):
+        """Writes a chat's queued records with one append and one index update. Needs the chat lock.
+
+        If the append fails (e.g. the disk is full) the records are put back at the front
+        of the queue, to be written by a later flush, and the error is raised.
+        """
+        key = (character_id, chat_id)
+        with self._lock:
+            items = self._pending.pop(key, None)
+        if not items:
+            return
+        path = self.log_path(character_id, chat_id)
+        if not os.path.exists(path):
+            print(f"Dropping {len(items)} queued record(s) for deleted chat {character_id}/{chat_id}")
+            return
+        end = None
+        try:
+            idx_path = self._ensure_index(character_id, chat_id)
+            encoded = [_encode_record(record) for record, _ in items]
+            started = time.perf_counter()
+            with open(path, 'r+b') as f:
+                end = f.seek(0, os.SEEK_END)
+                prefix = b""
+                if end > 0:
+                    f.seek(end - 1)
+                    if f.read(1) != b"\n":
+                        # Terminate a torn record so it can't swallow the ones we're writing
+                        prefix = b"\n"
+                f.write(prefix + b"".join(encoded))
+                f.flush()
+                log_size = f.tell()
+                if self.fsync == 'always':
+                    synced = time.perf_counter()
+                    os.fsync(f.fileno())
+                    self._observe_io('fsync', synced)
+        except OSError as e:
+            # Cut off whatever part of the batch got written, so the retry doesn't duplicate it
+            if end is not None:
+                try:
+                    os.truncate(path, end)
+                except OSError as truncate_error:
+                    print(f"Error truncating chat log {path} after a failed write: {truncate_error}")
+            with self._lock:
+                self._pending[key] = items + self._pending.get(key, [])
+            print(f"Error writing {len(items)} record(s) to chat {character_id}/{chat_id}; keeping them queued: {e}")
+            raise
+        if self.fsync == 'interval':
+            with self._lock:
+                self._unsynced.add(path)
+
+        offset = end + len(prefix)
+        count = self._count(idx_path)
+        with open(idx_path, 'r+b') as f:
+            for (record, message), data in zip(items, encoded):
+                op = record['op']
+                if op == 'add':
+                    f.seek(0, os.SEEK_END)
+                    f.write(_INDEX_ENTRY.pack(*_index_entry(offset, len(data), message)))
+                    count += 1
+                elif not 0 <= record['index'] < count:
+                    pass  # Replay ignores it too
+                elif op == 'set':
+                    f.seek(_INDEX_HEADER.size + record['index'] * _INDEX_ENTRY.size)
+                    f.write(_INDEX_ENTRY.pack(*_index_entry(offset, len(data), message)))
+                elif op == 'del':
+                    f.seek(_INDEX_HEADER.size + (record['index'] + 1) * _INDEX_ENTRY.size)
+                    tail = f.read()
+                    f.seek(_INDEX_HEADER.size + record['index'] * _INDEX_ENTRY.size)
+                    f.write(tail)
+                    f.truncate()
+                    count -= 1
+                offset += len(data)
+            f.seek(0)
+            f.write(_INDEX_HEADER.pack(INDEX_MAGIC, log_size))
+        self._observe_io('write', started)
+
+        edited = [record['index'] for record, _ in items if record['op'] != 'add']
+        if edited:
+            self._drop_stale_summary(character_id, chat_id, min(edited))
+
+        if self._search('apply', character_id, chat_id, items, end, log_size) is False:
+            self._reindex(character_id, chat_id)  # The index had fallen behind this chat
+
+        if character_id in self._meta:
+            preview = ""
+            if count:
+                (offset, length, _, _), = self._read_entries(idx_path, count - 1, count)
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    preview = _preview(json.loads(f.read(length))['msg'])
+            self._put_meta(character_id, chat_id, updated=time.time(), message_count=count, preview=preview, size=log_size)
+
+    def flush_all(self):
+        """Writes everything that is queued, for all chats.
+
+        Returns False if some of it couldn't be written and is still queued.
+        """
+        with self._lock:
+            keys = list(self._pending)
+        written = True
+        for character_id, chat_id in keys:
+            try:
+                with self.chat_lock(character_id, chat_id):
+                    self._flush(character_id, chat_id)
+            except (IOError, OSError) as e:
+                print(f"Error writing chat {character_id}/{chat_id}: {e}")
+                written = False
+        self.save_meta()
+        return written
+
+    def _sync_logs(self):
+        with self._lock:
+            paths, self._unsynced = self._unsynced, set()
+        for path in paths:
+            started = time.perf_counter()
+            try:
+                with open(path, 'rb') as f:
+                    os.fsync(f.fileno())
+            except FileNotFoundError:
+                continue
+            self._observe_io('fsync', started)
+
+    def start_background_writer(self):
+        if self._writer is not None or (self.write_delay <= 0 and self.fsync != 'interval'):
+            return
+
+        def run():
+            last_sync = time.monotonic()
+            retry = False  # Records that failed to write are retried every WRITE_RETRY_INTERVAL
+            while True:
+                timeout = self.fsync_interval if self.fsync == 'interval' else None
+                if retry:
+                    timeout = min(timeout or WRITE_RETRY_INTERVAL, WRITE_RETRY_INTERVAL)
+                if self._wakeup.wait(timeout) or retry:
+                    self._wakeup.clear()
+                    time.sleep(self.write_delay)  # Let the rest of a burst arrive
+                    retry = not self.flush_all()
+                if self.fsync == 'interval' and time.monotonic() - last_sync >= self.fsync_interval:
+                    self._sync_logs()
+                    last_sync = time.monotonic()
+
+        self._writer = threading.Thread(target=run, name="chat-log-writer", daemon=True)
+        self._writer.start()
+        # Whatever is still queued when the process exits normally gets written
+        atexit.register(self.flush_all)
+        if self.fsync == 'interval':
+            atexit.register(self._sync_logs)
+
+    # --- Summaries ---
+
+    def read_summary(self, character_id, chat_id):
+        """Returns the chat's summary {"end", "summary", "created"}, or None."""
+        with self.chat_lock(character_id, chat_id):
+            self._flush(character_id, chat_id)  # A queued edit may invalidate it
+            try:
+                with open(self._summary_path(character_id, chat_id), 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                return None
+            except (IOError, ValueError) as e:
+                print(f"Ignoring unreadable summary for chat {character_id}/{chat_id}: {e}")
+                return None
+
+    def edit_count(self, character_id, chat_id):
+        """Changes whenever a message of the chat is edited or deleted."""
+        with self.chat_lock(character_id, chat_id):
+            self._flush(character_id, chat_id)
+            return self._edits.get((character_id, chat_id), 0)
+
+    def write_summary(self, character_id, chat_id, end, summary, edit_count):
+        """Stores a summary of the first `end` messages, unless one of the messages was
+        edited or deleted since edit_count was taken. Returns True if it was stored."""
+        with self.chat_lock(character_id, chat_id):
+            self._flush(character_id, chat_id)
+            if self._edits.get((character_id, chat_id), 0) != edit_count or not os.path.exists(self.log_path(character_id, chat_id)):
+                return False
+            data = json.dumps({"end": end, "summary": summary, "created": time.time()}, ensure_ascii=False)
+            atomic_write(self._summary_path(character_id, chat_id), data.encode('utf-8'), fsync=False)
+            return True
+
+    def _drop_stale_summary(self, character_id, chat_id, first_edited):
+        # Called from _flush with the chat lock held
+        key = (character_id, chat_id)
+        with self._lock:
+            self._edits[key] = self._edits.get(key, 0) + 1
+        summary_path = self._summary_path(character_id, chat_id)
+        if not os.path.exists(summary_path):
+            return
+        try:
+            with open(summary_path, 'r', encoding='utf-8') as f:
+                stale = json.load(f)['end'] > first_edited
+        except (IOError, ValueError, KeyError):
+            stale = True
+        if stale:
+            os.remove(summary_path)
+            print(f"Dropped summary of chat {character_id}/{chat_id}: message {first_edited} changed")
+
+    # --- Search Index ---
+
+    def _search(self, method, *args):
+        """Calls a search index method, if there is an index. A failure never fails the chat
+        write; the next sync reindexes whatever was missed."""
+        if self.search_index is None:
+            return None
+        try:
+            return getattr(self.search_index, method)(*args)
+        except sqlite3.Error as e:
+            print(f"Search index error in {method}: {e}")
+            return None
+
+    def _reindex(self, character_id, chat_id):
+        """Rebuilds a chat's search entries from its log. Needs the chat lock."""
+        path = self.log_path(character_id, chat_id)
+        with open(path, 'rb') as f:
+            history, _, _ = _replay(f, path)
+            log_size = f.tell()
+        self._search('reindex_chat', character_id, chat_id, history, log_size)
+
+    def sync_search_index(self):
+        """Reindexes every chat whose log changed since the search index last saw it, and
+        drops chats that no longer exist. Returns the number of chats reindexed."""
+        indexed = self._search('indexed_chats') or {}
+        on_disk = set()
+        reindexed = 0
+        for character_id in sorted(os.listdir(self.chats_dir)):
+            if not os.path.isdir(self._char_dir(character_id)):
+                continue
+            for chat_id in self.list_chat_ids(character_id):
+                try:
+                    path = self._resolve(character_id, chat_id)
+                    with self.chat_lock(character_id, chat_id):
+                        self._flush(character_id, chat_id)
+                        if not os.path.exists(path):
+                            continue
+                        on_disk.add((character_id, chat_id))
+                        if indexed.get((character_id, chat_id)) != os.path.getsize(path):
+                            self._reindex(character_id, chat_id)
+                            reindexed += 1
+                except (IOError, OSError, json.JSONDecodeError) as e:
+                    print(f"Error indexing chat {character_id}/{chat_id}: {e}")
+        for character_id, chat_id in set(indexed) - on_disk:
+            self._search('remove_chat', character_id, chat_id)
+        return reindexed
+
+    def start_search_sync(self):
+        """Runs sync_search_index() in the background."""
+        if self.search_index is None:
+            return
+
+        def run():
+            self.search_index.syncing = True
+            try:
+                start = time.monotonic()
+                reindexed = self.sync_search_index()
+                if reindexed:
+                    print(f"Search index: reindexed {reindexed} chat(s) in {time.monotonic() - start:.1f}s")
+            finally:
+                self.search_index.syncing = False
+
+        threading.Thread(target=run, name="search-index-sync", daemon=True).start()
+
+    # --- Export / Import ---
+
+    def open_chat_snapshot(self, character_id, chat_id):
+        """Returns (open log file, size, mtime) for a consistent copy of a chat, or None.
+
+        Read at most `size` bytes: later appends only add to the end, and a compaction
+        swaps in a new file, leaving the open one intact. No lock is held while reading.
+        """
+        path = self._resolve(character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            self._flush(character_id, chat_id)
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                return None
+            st = os.fstat(f.fileno())
+            return f, st.st_size, st.st_mtime
+
+    def import_chat(self, character_id, chat_id, log_path, summary=None):
+        """Moves an imported chat log into place, replacing the chat if it exists.
+
+        log_path must be on the same file system; summary is the chat's summary data or None.
+        """
+        os.makedirs(self._char_dir(character_id), exist_ok=True)
+        key = (character_id, chat_id)
+        path = self.log_path(character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            with self._lock:
+                self._pending.pop(key, None)
+                self._garbage.pop(key, None)
+                self._edits[key] = self._edits.get(key, 0) + 1  # Any summary being written is stale
+            if self.fsync != 'never':
+                with open(log_path, 'rb') as f:
+                    os.fsync(f.fileno())
+            os.replace(log_path, path)
+            for stale_path in (self._legacy_path(character_id, chat_id), self._index_path(character_id, chat_id),
+                               self._summary_path(character_id, chat_id)):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            if summary is not None:
+                atomic_write(self._summary_path(character_id, chat_id),
+                             json.dumps(summary, ensure_ascii=False).encode('utf-8'), fsync=False)
+            with open(path, 'rb') as f:
+                history, _, _ = _replay(f, path)
+                size = f.tell()
+            self._put_meta(character_id, chat_id, updated=os.path.getmtime(path), message_count=len(history),
+                           preview=_preview(history[-1]) if history else "", size=size)
+            self._search('reindex_chat', character_id, chat_id, history, size)
+
+    # --- Compaction ---
+
+    def compact(self, character_id, chat_id, force=False):
+        """Rewrites a chat log with only its live messages. Returns True if it was rewritten."""
+        path = self.log_path(character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            if not os.path.exists(path):
+                return False
+            self._flush(character_id, chat_id)
+            with open(path, 'rb') as f:
+                history, _, total = _replay(f, path)
+            garbage = total - len(history)
+            if not force and (garbage < COMPACTION_MIN_GARBAGE or garbage < total * COMPACTION_GARBAGE_RATIO):
+                return False
+            old_size = os.path.getsize(path)
+            data = b"".join(_encode_record({"op": "add", "msg": m}) for m in history)
+            atomic_write(path, data, fsync=self.fsync != 'never')
+            self._rebuild_index(character_id, chat_id)
+            self._put_meta(character_id, chat_id, size=len(data))
+            self._search('set_log_size', character_id, chat_id, old_size, len(data))
+        print(f"Compacted chat log {path}: dropped {garbage} dead records")
+        return True
+
+    def compact_pending(self):
+        """Compacts chats that have collected enough dead records since they were last checked."""
+        with self._lock:
+            pending = [key for key, n in self._garbage.items() if n >= COMPACTION_MIN_GARBAGE]
+            for key in pending:
+                self._garbage[key] = 0
+        for character_id, chat_id in pending:
+            try:
+                self.compact(character_id, chat_id)
+            except (IOError, OSError) as e:
+                print(f"Error compacting chat {character_id}/{chat_id}: {e}")
+
+    def start_background_compaction(self, interval=COMPACTION_INTERVAL):
+        if self._compactor is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.compact_pending()
+
+        self._compactor = threading.Thread(target=run, name="chat-log-compactor", daemon=True)
+        self._compactor.start()
+
+    # --- Legacy Migration ---
+
+    def migrate_legacy_chat(self, character_id, chat_id):
+        """Converts a legacy <chat>.json history file into a chat log.
+
+        Returns False if there was nothing to convert, e.g. another thread got there first.
+        """
+        legacy_path = self._legacy_path(character_id, chat_id)
+        path = self.log_path(character_id, chat_id)
+        with self.chat_lock(character_id, chat_id):
+            if os.path.exists(path) or not os.path.exists(legacy_path):
+                return False
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                history = json.load(f)
+            data = b"".join(_encode_record({"op": "add", "msg": m}) for m in history)
+            atomic_write(path, data, fsync=self.fsync != 'never')
+            os.remove(legacy_path)
+            self._put_meta(character_id, chat_id, message_count=len(history),
+                           preview=_preview(history[-1]) if history else "", size=len(data))
+            self._search('reindex_chat', character_id, chat_id, history, len(data))
+        print(f"Migrated legacy chat {legacy_path} to {path}")
+        return True
+
+    def migrate_all(self):
+        migrated = 0
+        for character_id in os.listdir(self.chats_dir):
+            char_chat_dir = self._char_dir(character_id)
+            if not os.path.isdir(char_chat_dir):
+                continue
+            for filename in os.listdir(char_chat_dir):
+                chat_id, ext = os.path.splitext(filename)
+                if ext != LEGACY_EXT:
+                    continue
+                try:
+                    if self.migrate_legacy_chat(character_id, chat_id):
+                        migrated += 1
+                except (IOError, json.JSONDecodeError) as e:
+                    print(f"Error migrating legacy chat {character_id}/{filename}: {e}")
+        return migrated
+
+
+# --- Character Registry ---
+# Characters are loaded once and served from memory. Every lookup stats the file (no
+# read/parse) and reloads it only if its mtime or size changed, so edits made on disk
+# by hand are still picked up.
+
+class CharacterRegistry:
+    def __init__(self, characters_dir):
+        self.characters_dir = characters_dir
+        self._lock = threading.RLock()
+        self._entries = {}  # character_id -> (mtime_ns, size, character)
+        self._dir_mtime = None
+        self._etag = None
+
+    def _path(self, character_id):
+        return os.path.join(self.characters_dir, f"{character_id}.json")
+
+    def _revalidate(self, character_id):
+        """Brings one cache entry in line with its file. Returns True if the entry changed."""
+        entry = self._entries.get(character_id)
+        try:
+            st = os.stat(self._path(character_id))
+        except FileNotFoundError:
+            return self._entries.pop(character_id, None) is not None
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+            return False
+        try:
+            with open(self._path(character_id), 'r', encoding='utf-8') as f:
+                character = json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            print(f"Error reading character file {character_id}.json: {e}")
+            return self._entries.pop(character_id, None) is not None
+        self._entries[character_id] = (st.st_mtime_ns, st.st_size, character)
+        return True
+
+    def _refresh(self):
+        changed = False
+        dir_mtime = os.stat(self.characters_dir).st_mtime_ns
+        if dir_mtime != self._dir_mtime:
+            # Files were added or removed; pick up the new set of ids
+            self._dir_mtime = dir_mtime
+            on_disk = {f[:-5] for f in os.listdir(self.characters_dir) if f.endswith(".json")}
+            for character_id in set(self._entries) - on_disk:
+                del self._entries[character_id]
+                changed = True
+            for character_id in on_disk - set(self._entries):
+                changed = self._revalidate(character_id) or changed
+        for character_id in list(self._entries):
+            changed = self._revalidate(character_id) or changed
+        if changed or self._etag is None:
+            stamp = sorted((cid, entry[0], entry[1]) for cid, entry in self._entries.items())
+            self._etag = hashlib.sha1(json.dumps(stamp).encode('utf-8')).hexdigest()
+
+    def list(self):
+        """Returns (characters sorted by file name, etag of the current set)."""
+        with self._lock:
+            self._refresh()
+            return [self._entries[cid][2] for cid in sorted(self._entries)], self._etag
+
+    def get(self, character_id):
+        """Returns a copy of a character, or None if it doesn't exist."""
+        with self._lock:
+            self._revalidate(character_id)
+            entry = self._entries.get(character_id)
+            return dict(entry[2]) if entry else None
+
+    def exists(self, character_id):
+        return self.get(character_id) is not None
+
+    def modified(self, character_id):
+        """Returns the mtime of a character's file, or None if it doesn't exist."""
+        try:
+            return os.path.getmtime(self._path(character_id))
+        except FileNotFoundError:
+            return None
+
+    def save(self, character):
+        with self._lock:
+            atomic_write(self._path(character['id']), json.dumps(character, indent=4).encode('utf-8'))
+            self._revalidate(character['id'])
+            self._etag = None
+
+    def remove(self, character_id):
+        with self._lock:
+            if os.path.exists(self._path(character_id)):
+                os.remove(self._path(character_id))
+            self._entries.pop(character_id, None)
+            self._etag = None
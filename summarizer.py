@@ -0,0 +1,109 @@
+import time
+import threading
+
+# --- Rolling Summaries ---
+# Once a chat grows past trigger_messages, its older messages are folded into a running
+# summary, stored next to the chat log (see ChatStore.read_summary). Prompt assembly then
+# sends the summary plus the recent messages instead of the whole history, so prompt
+# evaluation stops growing with the chat.
+#
+# The work happens on a background thread and only while the backend is idle: a chat
+# is considered once nobody has written to it for idle_seconds, and a summary request
+# only starts when the scheduler has nothing running or waiting; it is aborted, and
+# retried later, as soon as a live request has to wait for it. Each step summarizes
+# at most max_segment more messages, continuing from the previous summary, and always
+# leaves the last keep_recent messages alone. A summary whose messages were edited
+# while it was being written is thrown away.
+
+
+class ChatSummarizer:
+    def __init__(self, chat_store, scheduler, summarize, trigger_messages=60, keep_recent=30,
+                 max_segment=40, idle_seconds=30, poll_interval=5):
+        self.chat_store = chat_store
+        self.scheduler = scheduler
+        # (character_id, chat_id, previous summary or None, messages, ticket) -> summary text;
+        # it should stop early when the scheduler ticket is preempted
+        self.summarize = summarize
+        self.trigger_messages = trigger_messages
+        self.keep_recent = keep_recent
+        self.max_segment = max_segment
+        self.idle_seconds = idle_seconds
+        self.poll_interval = poll_interval
+        self._activity = {}  # (character_id, chat_id) -> monotonic time of the last write
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def note_activity(self, character_id, chat_id):
+        """Marks a chat as written to; it is looked at once it has been idle for a while."""
+        with self._lock:
+            self._activity[(character_id, chat_id)] = time.monotonic()
+
+    def run_once(self):
+        """Summarizes one step of every chat that has been idle long enough. Returns the
+        number of summaries written."""
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [key for key, last in self._activity.items() if last <= cutoff]
+        written = 0
+        for character_id, chat_id in idle:
+            ticket = self.scheduler.submit_if_idle(f"summary/{character_id}/{chat_id}")
+            if ticket is None:
+                break  # Live requests come first; try again next round
+            try:
+                more = self.summarize_step(character_id, chat_id, ticket)
+            except Exception as e:
+                more = None
+                if not ticket.preempted.is_set():
+                    print(f"Error summarizing chat {character_id}/{chat_id}: {e}")
+            finally:
+                self.scheduler.release(ticket)
+            if ticket.preempted.is_set():
+                break  # Keep the chat for the next round
+            if more is not None:
+                written += 1
+            if not more:
+                with self._lock:
+                    if self._activity.get((character_id, chat_id), 0) <= cutoff:
+                        del self._activity[(character_id, chat_id)]
+        return written
+
+    def summarize_step(self, character_id, chat_id, ticket):
+        """Extends a chat's summary by up to max_segment messages.
+
+        Returns None if there was nothing to do (or the summary went stale), otherwise
+        whether more messages are still waiting to be summarized.
+        """
+        store = self.chat_store
+        with store.chat_lock(character_id, chat_id):
+            if not store.exists(character_id, chat_id):
+                return None
+            count = store.count(character_id, chat_id)
+            if count < self.trigger_messages:
+                return None
+            edit_count = store.edit_count(character_id, chat_id)
+            previous = store.read_summary(character_id, chat_id)
+            start = previous['end'] if previous else 0
+            target = count - self.keep_recent
+            if target <= start:
+                return None
+            end = min(target, start + self.max_segment)
+            messages, _ = store.read_range(character_id, chat_id, start, end)
+
+        # No lock is held while the backend works; write_summary checks nothing changed
+        summary = self.summarize(character_id, chat_id, previous['summary'] if previous else None, messages, ticket)
+        if not summary or ticket.preempted.is_set() or not store.write_summary(character_id, chat_id, end, summary, edit_count):
+            return None
+        print(f"Summarized chat {character_id}/{chat_id} up to message {end}")
+        return end < target
+
+    def start(self):
+        if self._worker is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.poll_interval)
+                self.run_once()
+
+        self._worker = threading.Thread(target=run, name="chat-summarizer", daemon=True)
+        self._worker.start()
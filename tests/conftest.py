@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mock_backend
+
+
+@pytest.fixture
+def start_backend():
+    """Starts mock backends on free ports; returns (server, chat completions URL) per call."""
+    servers = []
+
+    def start(latency=0.0, rate=0.0, tokens=8):
+        server = mock_backend.serve(0, latency=latency, rate=rate, tokens=tokens)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """main, imported with a data folder of its own and one mock backend.
+
+    main reads its data folder and backends at import, so it is imported once per run.
+    """
+    server = mock_backend.serve(0, latency=0.0, rate=0.0, tokens=8)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    data_dir = tmp_path_factory.mktemp("data")
+    os.makedirs(data_dir / "characters")
+    with open(data_dir / "characters" / "alice.json", 'w', encoding='utf-8') as f:
+        json.dump({"id": "alice", "name": "Alice", "description": "A test character.", "avatar_url": ""}, f)
+    os.environ["LOCALAICHAT_DATA_DIR"] = str(data_dir)
+    os.environ["LOCALAICHAT_BACKENDS"] = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    cwd = os.getcwd()
+    os.chdir(ROOT)  # The static asset build reads index.html relative to the working directory
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    main.mock_server = server
+    yield main
+    server.shutdown()
+    server.server_close()
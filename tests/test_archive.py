@@ -0,0 +1,54 @@
+import os
+import json
+import hashlib
+import zipfile
+
+import pytest
+
+from archive import import_archive, ArchiveError, ARCHIVE_FORMAT, ARCHIVE_VERSION, MANIFEST_NAME
+
+
+def write_archive(path, members):
+    """A zip of the manifest followed by (name, bytes) members, in that order."""
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr(MANIFEST_NAME, json.dumps({"format": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION}))
+        for name, data in members:
+            z.writestr(name, data)
+
+
+def chat_log(*contents):
+    return "".join(json.dumps({"op": "add", "msg": {"role": "user", "content": c}}) + "\n" for c in contents).encode()
+
+
+def run_import(app, path, tmp_path):
+    return import_archive(str(path), app.chat_store, app.character_registry, app.upload_store,
+                          str(tmp_path / "staging"), 1024 * 1024)
+
+
+def test_summaries_before_their_logs(app, tmp_path):
+    archive = tmp_path / "export.zip"
+    write_archive(archive, [
+        ("chats/alice/111.summary", json.dumps({"end": 1, "summary": "First chat"})),
+        ("chats/alice/222.summary", json.dumps({"end": 1, "summary": "Second chat"})),
+        ("chats/alice/111.jsonl", chat_log("one", "two")),
+        ("chats/alice/222.jsonl", chat_log("three", "four", "five")),
+    ])
+    assert run_import(app, archive, tmp_path)['chats'] == 2
+
+    store = app.chat_store
+    assert [m['content'] for m in store.read_range("alice", "111", 0, 10)[0]] == ["one", "two"]
+    assert [m['content'] for m in store.read_range("alice", "222", 0, 10)[0]] == ["three", "four", "five"]
+    assert store.read_summary("alice", "111")['summary'] == "First chat"
+    assert store.read_summary("alice", "222")['summary'] == "Second chat"
+
+
+def test_upload_with_wrong_hash_is_not_stored(app, tmp_path):
+    image = b"\x89PNG\r\n\x1a\n" + b"not really a picture"
+    wrong_name = hashlib.sha256(b"something else").hexdigest() + ".png"
+    archive = tmp_path / "export.zip"
+    write_archive(archive, [(f"uploads/{wrong_name}", image)])
+
+    before = set(os.listdir(app.upload_store.directory))
+    with pytest.raises(ArchiveError, match="content hash"):
+        run_import(app, archive, tmp_path)
+    assert set(os.listdir(app.upload_store.directory)) == before
@@ -0,0 +1,137 @@
+import time
+
+import pytest
+
+from llm_client import BackendPool, NoBackendAvailable, create_session
+
+PAYLOAD = {"model": "local-model", "messages": [{"role": "user", "content": "Hi"}], "stream": False}
+TIMEOUT = (2, 5)
+
+
+@pytest.fixture
+def session():
+    return create_session(4)
+
+
+def post(pool, session, key):
+    """Sends one chat request through the pool; returns the backend that answered it."""
+    backend, response = pool.post(session, key, PAYLOAD, stream=False, timeout=TIMEOUT)
+    try:
+        assert response.status_code == 200
+        assert response.json()['choices'][0]['message']['content']
+    finally:
+        response.close()
+        pool.release(backend)
+    return backend
+
+
+def stop(server, session):
+    """Takes a backend down. Its open keep-alive connections die with it, so the session's
+    idle ones are dropped as well."""
+    server.shutdown()
+    server.server_close()
+    session.close()
+
+
+def test_chat_sticks_to_its_backend(start_backend, session):
+    (a, url_a), (b, url_b) = start_backend(), start_backend()
+    pool = BackendPool([url_a, url_b])
+
+    first = post(pool, session, "alice/1")
+    for _ in range(4):
+        assert post(pool, session, "alice/1") is first
+
+    # An idle pool hands the next chat to the backend holding fewer chats
+    second = post(pool, session, "bob/1")
+    assert second is not first
+    assert sorted([a.handler.requests, b.handler.requests]) == [1, 5]
+    assert all(backend['outstanding'] == 0 for backend in pool.status())
+
+
+def test_failover_when_backend_is_down(start_backend, session):
+    (a, url_a), (b, url_b) = start_backend(), start_backend()
+    pool = BackendPool([url_a, url_b])
+    assert post(pool, session, "alice/1").url == url_a
+
+    stop(a, session)
+    assert post(pool, session, "alice/1").url == url_b
+    status = {backend['url']: backend for backend in pool.status()}
+    assert not status[url_a]['healthy']
+    assert status[url_a]['last_error']
+
+    # The chat now stays on the backend that took over
+    assert post(pool, session, "alice/1").url == url_b
+    assert b.handler.requests == 2
+
+
+def test_failover_on_overloaded_backend(start_backend, session):
+    (a, url_a), (b, url_b) = start_backend(), start_backend()
+    pool = BackendPool([url_a, url_b])
+    assert post(pool, session, "alice/1").url == url_a
+
+    a.handler.fail_status = 503
+    assert post(pool, session, "alice/1").url == url_b
+    assert a.handler.requests == 2
+
+
+def test_no_backend_available(start_backend, session):
+    a, url_a = start_backend()
+    pool = BackendPool([url_a])
+    stop(a, session)
+    with pytest.raises(NoBackendAvailable):
+        pool.post(session, "alice/1", PAYLOAD, stream=False, timeout=TIMEOUT)
+
+
+def test_health_check_marks_backend_down_and_up(start_backend, session):
+    (a, url_a), (b, url_b) = start_backend(), start_backend()
+    pool = BackendPool([url_a, url_b])
+
+    a.handler.fail_status = 503
+    pool.check_health(session)
+    status = {backend['url']: backend for backend in pool.status()}
+    assert not status[url_a]['healthy'] and status[url_b]['healthy']
+    assert "503" in status[url_a]['last_error']
+
+    # New chats avoid the unhealthy backend
+    assert post(pool, session, "alice/1").url == url_b
+    assert post(pool, session, "bob/1").url == url_b
+
+    a.handler.fail_status = None
+    pool.check_health(session)
+    status = {backend['url']: backend for backend in pool.status()}
+    assert status[url_a]['healthy'] and status[url_a]['last_error'] is None
+    assert post(pool, session, "carol/1").url == url_a
+
+
+def test_background_health_checks_reprobe(start_backend):
+    a, url_a = start_backend()
+    pool = BackendPool([url_a])
+    a.handler.fail_status = 503
+    pool.start_health_checks(0.05)
+
+    def healthy():
+        return pool.status()[0]['healthy']
+
+    deadline = time.monotonic() + 5
+    while healthy() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert not healthy()
+
+    a.handler.fail_status = None
+    deadline = time.monotonic() + 5
+    while not healthy() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert healthy()
+
+
+def test_session_keeps_a_connection_pool_per_backend(start_backend):
+    servers = [start_backend() for _ in range(6)]
+    session = create_session(2, len(servers))
+    for _ in range(2):
+        for _, url in servers:
+            session.get(url.rsplit("/chat/completions", 1)[0] + "/models", timeout=TIMEOUT).close()
+    # Every backend's pool survived the round through the others, so its connection was reused
+    pools = session.get_adapter(servers[0][1]).poolmanager.pools
+    assert len(pools) == len(servers)
+    assert all(pools[key].num_connections == 1 for key in pools.keys())
+    session.close()
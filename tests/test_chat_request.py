@@ -0,0 +1,38 @@
+import pytest
+
+
+def request(**fields):
+    return {"character_id": "alice", "chat_id": "1", "message": "Hi", **fields}
+
+
+@pytest.mark.parametrize("history_override", [
+    "not a list",
+    {"role": "user", "content": "Hi"},
+    ["Hi"],
+    [{"role": "user", "content": "Hi"}, None],
+])
+def test_malformed_history_override_is_rejected(app, history_override):
+    turn, error = app.prepare_chat_turn(request(history_override=history_override))
+    assert turn is None
+    assert error[1] == 400
+
+
+@pytest.mark.parametrize("max_context_tokens", [0, -5, "4096", True, 1.5])
+def test_malformed_context_size_is_rejected(app, max_context_tokens):
+    turn, error = app.prepare_chat_turn(request(llm_settings={"max_context_tokens": max_context_tokens}))
+    assert turn is None
+    assert error[1] == 400
+
+
+def test_history_override_is_sent(app):
+    history = [{"role": "user", "content": "Earlier"}, {"role": "assistant", "content": "Reply", "pinned": True}]
+    turn, error = app.prepare_chat_turn(request(history_override=history))
+    assert error is None
+    assert turn['regenerate_index'] == 2
+    assert [m['content'] for m in turn['payload']['messages'][1:]] == ["Earlier", "Reply", "Hi"]
+
+
+def test_malformed_history_override_gets_400_over_http(app):
+    response = app.app.test_client().post('/api/chat', json=request(history_override=[1, 2]))
+    assert response.status_code == 400
+    assert "history_override" in response.get_json()['error']
@@ -0,0 +1,34 @@
+import json
+
+from llm_client import ContentDeltaDecoder, SSEParser
+
+
+def event(content, index=0):
+    return b"data: " + json.dumps({"choices": [{"index": index, "delta": {"content": content}}]}).encode() + b"\n\n"
+
+
+def test_events_split_across_chunks():
+    stream = event("Hel") + b": keep-alive\n\n" + event("lo") + b"data: [DONE]\n\n"
+    decoder = ContentDeltaDecoder()
+    deltas = []
+    for i in range(0, len(stream), 7):
+        deltas.extend(decoder.feed(stream[i:i + 7]))
+    deltas.extend(decoder.close())
+    assert "".join(deltas) == "Hello"
+
+
+def test_malformed_event_is_skipped():
+    decoder = ContentDeltaDecoder()
+    deltas = list(decoder.feed(event("Hel") + b"data: {\"choices\": \xff\xfe}\n\n" + b"data: not json\n\n" + event("lo")))
+    assert deltas == ["Hel", "lo"]
+
+
+def test_last_event_without_blank_line():
+    parser = SSEParser()
+    assert parser.feed(b"data: first\n\ndata: sec") == [b"first"]
+    assert parser.close() == [b"sec"]
+
+
+def test_indexed_deltas():
+    decoder = ContentDeltaDecoder(indexed=True)
+    assert list(decoder.feed(event("a", 1) + event("b", 0))) == [(1, "a"), (0, "b")]
@@ -0,0 +1,19 @@
+import json
+
+from storage import ChatStore
+
+
+def test_migrate_all_counts_only_converted_chats(tmp_path):
+    chats_dir = tmp_path / "chats"
+    (chats_dir / "alice").mkdir(parents=True)
+    history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+    for chat_id in ("1", "2"):
+        (chats_dir / "alice" / f"{chat_id}.json").write_text(json.dumps(history), encoding='utf-8')
+    # Chat 2 already has a log, as if another thread converted it first
+    (chats_dir / "alice" / "2.jsonl").write_bytes(b"")
+    store = ChatStore(str(chats_dir), write_delay=0, fsync='never')
+
+    assert store.migrate_all() == 1
+    assert not (chats_dir / "alice" / "1.json").exists()
+    assert store.read_range("alice", "1", 0, 10)[0] == history
+    assert store.migrate_all() == 0
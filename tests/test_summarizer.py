@@ -0,0 +1,82 @@
+import pytest
+
+from summarizer import ChatSummarizer
+
+
+def make_chat(main, count=12):
+    """A chat of `count` alternating user and assistant messages; returns its id."""
+    chat_id = main.chat_store.create_chat("alice")
+    main.chat_store.append_messages("alice", chat_id, [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"Message number {i}"} for i in range(count)])
+    return chat_id
+
+
+def summarize(main, chat_id):
+    summarizer = ChatSummarizer(main.chat_store, main.generation_scheduler, main.summarize_messages,
+                                trigger_messages=10, keep_recent=4, max_segment=100, idle_seconds=0)
+    summarizer.note_activity("alice", chat_id)
+    return summarizer.run_once()
+
+
+def test_summary_is_written(app):
+    chat_id = make_chat(app)
+    assert summarize(app, chat_id) == 1
+
+    summary = app.chat_store.read_summary("alice", chat_id)
+    assert summary['end'] == 8
+    assert summary['summary']
+    # The backend was asked about the older messages only
+    prompt = app.mock_server.handler.last_request['messages'][-1]['content']
+    assert "Message number 7" in prompt
+    assert "Message number 8" not in prompt
+
+    # Nothing new to fold in
+    assert summarize(app, chat_id) == 0
+
+
+def test_short_chat_is_not_summarized(app):
+    chat_id = make_chat(app, count=6)
+    assert summarize(app, chat_id) == 0
+    assert app.chat_store.read_summary("alice", chat_id) is None
+
+
+@pytest.mark.parametrize("edit", ["set", "delete"])
+def test_editing_a_summarized_message_drops_the_summary(app, edit):
+    chat_id = make_chat(app)
+    summarize(app, chat_id)
+    if edit == "set":
+        app.chat_store.set_message("alice", chat_id, 3, {"role": "assistant", "content": "Changed"})
+    else:
+        app.chat_store.delete_message("alice", chat_id, 3)
+    assert app.chat_store.read_summary("alice", chat_id) is None
+
+
+def test_editing_a_recent_message_keeps_the_summary(app):
+    chat_id = make_chat(app)
+    summarize(app, chat_id)
+    app.chat_store.set_message("alice", chat_id, 10, {"role": "user", "content": "Changed"})
+    assert app.chat_store.read_summary("alice", chat_id)['end'] == 8
+
+
+def test_prompt_uses_the_summary(app, monkeypatch):
+    chat_id = make_chat(app)
+    summarize(app, chat_id)
+    summary = app.chat_store.read_summary("alice", chat_id)['summary']
+    monkeypatch.setattr(app, "SUMMARY_ENABLED", True)
+
+    turn, error = app.prepare_chat_turn({"character_id": "alice", "chat_id": chat_id, "message": "Hello again"})
+    assert error is None
+    messages = turn['payload']['messages']
+    assert messages[1] == {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+    # The summarized messages are left out; the recent ones follow the summary
+    assert [m['content'] for m in messages[2:]] == [f"Message number {i}" for i in range(8, 12)] + ["Hello again"]
+
+
+def test_prompt_without_summary_sends_the_whole_chat(app, monkeypatch):
+    chat_id = make_chat(app)
+    monkeypatch.setattr(app, "SUMMARY_ENABLED", True)
+
+    turn, error = app.prepare_chat_turn({"character_id": "alice", "chat_id": chat_id, "message": "Hello again"})
+    assert error is None
+    messages = turn['payload']['messages']
+    assert [m['content'] for m in messages[1:]] == [f"Message number {i}" for i in range(12)] + ["Hello again"]
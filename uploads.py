@@ -0,0 +1,165 @@
+import os
+import re
+import hashlib
+import tempfile
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it uploads are served full size
+    Image = None
+
+# --- Uploaded Images ---
+# Uploads are stored under the SHA-256 of their content (data/uploads/<hash>.<ext>), so
+# uploading the same avatar again reuses the file already on disk. The body is copied to
+# a temporary file in chunks while it is hashed, and never held in memory whole. The
+# extension comes from the file's leading bytes, not from the name the client sent.
+#
+# A file's name never changes its content, so it is served as immutable, with the hash
+# as its ETag. Smaller copies for thumbnails are made when an image is uploaded (and on
+# first request for older uploads) and served with ?size=<pixels>: the smallest
+# pre-generated size at least that large.
+
+CHUNK_SIZE = 64 * 1024
+THUMBNAIL_DIR = "thumbnails"
+THUMBNAIL_EXT = ".webp"
+
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+]
+_HASHED_NAME = re.compile(r'^([0-9a-f]{64})\.[a-z]+$')
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def sniff_extension(head):
+    """Returns the file extension for an image's leading bytes, or None if it isn't one we take."""
+    for signature, ext in _SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+class UploadStore:
+    def __init__(self, directory, max_bytes, thumbnail_sizes=()):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.thumbnail_sizes = sorted(thumbnail_sizes)
+        self.thumbnail_dir = os.path.join(directory, THUMBNAIL_DIR)
+        self._lock = threading.Lock()  # Serializes thumbnail generation
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+
+    # --- Saving ---
+
+    def save(self, stream, expected_name=None):
+        """Copies an uploaded image from a file-like stream and returns its stored name.
+
+        Raises UploadError if it is too large, not an image, or (with expected_name) stored
+        under another name; nothing is kept then.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".upload-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                head = stream.read(CHUNK_SIZE)
+                ext = sniff_extension(head)
+                if ext is None:
+                    raise UploadError("Only PNG, JPEG, GIF and WebP images can be uploaded", 415)
+                chunk = head
+                while chunk:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadError(f"Images can be at most {self.max_bytes // (1024 * 1024)} MB", 413)
+                    digest.update(chunk)
+                    f.write(chunk)
+                    chunk = stream.read(CHUNK_SIZE)
+            name = digest.hexdigest() + ext
+            if expected_name is not None and name != expected_name:
+                raise UploadError("The file doesn't match its content hash")
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(temp_path)  # Already uploaded before
+            else:
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        for thumbnail_size in self.thumbnail_sizes:
+            self.thumbnail(name, thumbnail_size)
+        return name
+
+    # --- Serving ---
+
+    def etag(self, name):
+        """Returns the content hash of a stored upload, or None for one saved under another name."""
+        match = _HASHED_NAME.match(name)
+        return match.group(1) if match else None
+
+    def resolve(self, name, size=None):
+        """Returns (directory, filename) to serve for an upload, at the smallest thumbnail
+        size that is at least size pixels if one can be made."""
+        if size is not None:
+            thumbnail_size = next((s for s in self.thumbnail_sizes if s >= size), None)
+            if thumbnail_size is not None:
+                thumbnail_name = self.thumbnail(name, thumbnail_size)
+                if thumbnail_name:
+                    return self.thumbnail_dir, thumbnail_name
+        return self.directory, name
+
+    def _thumbnail_current(self, name, source, path):
+        """Whether a thumbnail exists and is up to date. Hashed uploads never change; an
+        older upload may have been replaced in place since its thumbnail was made."""
+        try:
+            made = os.path.getmtime(path)
+        except OSError:
+            return False
+        if self.etag(name):
+            return True
+        try:
+            return made >= os.path.getmtime(source)
+        except OSError:
+            return True  # Source gone; the existing thumbnail is served as before
+
+    def thumbnail(self, name, size):
+        """Makes (once) a copy of an upload that fits in size x size pixels.
+
+        Returns its file name in the thumbnail directory, or None if it can't be made;
+        callers then serve the original.
+        """
+        if Image is None or os.path.basename(name) != name:
+            return None
+        base, _ = os.path.splitext(name)
+        thumbnail_name = f"{base}-{size}{THUMBNAIL_EXT}"
+        path = os.path.join(self.thumbnail_dir, thumbnail_name)
+        source = os.path.join(self.directory, name)
+        if self._thumbnail_current(name, source, path):
+            return thumbnail_name
+        if not os.path.isfile(source):
+            return None
+        with self._lock:
+            if self._thumbnail_current(name, source, path):
+                return thumbnail_name
+            try:
+                with Image.open(source) as image:
+                    image = ImageOps.exif_transpose(image)
+                    image.thumbnail((size, size))
+                    if image.mode not in ("RGB", "RGBA"):
+                        image = image.convert("RGBA")
+                    temp_path = path + ".tmp"
+                    image.save(temp_path, "WEBP", quality=85)
+                os.replace(temp_path, path)
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                print(f"Error making a {size}px thumbnail of {name}: {e}")
+                return None
+        return thumbnail_name